@@ -1,18 +1,20 @@
 from __future__ import annotations
 
+import json
 import traceback
 from dataclasses import dataclass, asdict
 from time import time
 
 import shutil
 
+import torch
 import torchaudio
 
 torchaudio.set_audio_backend("sox_io")
 from functools import partial
 
 from tqdm import tqdm
-from typing import Dict, List, NamedTuple, Tuple, Optional
+from typing import ClassVar, Dict, List, NamedTuple, Tuple, Optional
 
 from abc import abstractmethod
 
@@ -23,18 +25,23 @@ import os
 from util import data_io
 from util.util_methods import process_with_threadpool, exec_command
 
+from corpora.download_manager import DownloadJob, DownloadManager
+from data_related.audio_io import get_resampler
 from data_related.utils import unzip, ASRSample, folder_to_targz, COMPRESSION_SUFFIXES
 import multiprocessing
 
 num_cpus = multiprocessing.cpu_count()
 
 MANIFEST_FILE = "manifest.jsonl.gz"
+CHECKPOINT_FILE = "manifest_checkpoint.jsonl"
 
 
 @dataclass
 class SpeechCorpus:
     name: str
     url: Optional[str] = None
+    # only files with these suffixes get extracted from the raw archive, None -> all
+    extract_suffixes: ClassVar[Optional[Tuple[str, ...]]] = None
 
     @abstractmethod
     def build_audiofile2text(self, path) -> Dict[str, str]:
@@ -50,7 +57,7 @@ class SpeechCorpus:
 
     def maybe_extract_raw(self, raw_zipfile, processed_dir):
         raw_extracted_dir = f"{processed_dir}/raw"
-        maybe_extract(raw_zipfile, raw_extracted_dir, False)
+        maybe_extract(raw_zipfile, raw_extracted_dir, False, self.extract_suffixes)
         return raw_extracted_dir
 
 
@@ -78,11 +85,88 @@ def process_write_manifest(
     data_io.write_jsonl(f"{processed_dir}/{MANIFEST_FILE}", samples)
 
 
+def _build_sample_row(
+    audio_file_text: Tuple[str, str], raw_processed_dir: Tuple[str, str], ac: AudioConfig
+) -> Tuple[str, Optional[Dict]]:
+    audio_file, text = audio_file_text
+    s = process_build_sample(audio_file, text, raw_processed_dir, ac)
+    return audio_file, None if s is None else asdict(s)
+
+
+def read_checkpoint(checkpoint_file: str) -> Dict[str, Optional[Dict]]:
+    """
+    raw-audio-file -> sample (None if processing failed), later lines win (retries)
+    a line that got truncated by a crash is dropped and the file is repaired
+    """
+    if not os.path.isfile(checkpoint_file):
+        return {}
+    rows = []
+    with open(checkpoint_file) as f:
+        lines = f.readlines()
+    for l in lines:
+        try:
+            rows.append(json.loads(l))
+        except json.JSONDecodeError:
+            break
+    if len(rows) != len(lines) or (len(lines) > 0 and not lines[-1].endswith("\n")):
+        with open(checkpoint_file, "w") as f:
+            f.writelines(json.dumps(d) + "\n" for d in rows)
+    return {d["raw_audio_file"]: d["sample"] for d in rows}
+
+
+def process_write_manifest_resumable(
+    raw_processed_dir: Tuple[str, str],
+    file2utt: Dict[str, str],
+    audio_conf: AudioConfig,
+    num_workers: int = num_cpus,
+):
+    """
+    like process_write_manifest but with a process-pool, every processed file is
+    appended to a checkpoint-log, on restart successfully processed files are skipped
+    the checkpoint-log lies next to processed_dir (not in it -> not in the targz)
+    """
+    raw_dir, processed_dir = raw_processed_dir
+    os.makedirs(processed_dir, exist_ok=True)
+    checkpoint_file = f"{os.path.normpath(processed_dir)}_{CHECKPOINT_FILE}"
+    timings = {}
+
+    start = time()
+    done = {f: s for f, s in read_checkpoint(checkpoint_file).items() if s is not None}
+    todo = [(f, t) for f, t in file2utt.items() if f not in done]
+    timings["reading-checkpoint"] = time() - start
+    print(f"{len(done)} files already processed, {len(todo)} to go")
+
+    start = time()
+    with open(checkpoint_file, "a") as f, multiprocessing.Pool(num_workers) as pool:
+        rows = pool.imap_unordered(
+            partial(_build_sample_row, raw_processed_dir=raw_processed_dir, ac=audio_conf),
+            todo,
+            chunksize=16,
+        )
+        for audio_file, sample in tqdm(rows, total=len(todo)):
+            f.write(json.dumps({"raw_audio_file": audio_file, "sample": sample}) + "\n")
+            f.flush()
+    timings["processing"] = time() - start
+
+    start = time()
+    done = read_checkpoint(checkpoint_file)
+    samples = [s for f, s in done.items() if f in file2utt and s is not None]
+    data_io.write_jsonl(f"{processed_dir}/{MANIFEST_FILE}", samples)
+    timings["merging"] = time() - start
+    print(f"{len(file2utt) - len(samples)} of {len(file2utt)} files failed")
+    print(", ".join(f"{k}: {v:.1f} secs" for k, v in timings.items()))
+
+
 @dataclass(frozen=True, eq=True)
 class AudioConfig:
     format: str = "wav"
     bitrate: Optional[int] = None
     min_dur_secs: float = 0.5  # seconds
+    sample_rate: Optional[int] = None  # None -> keep original sample-rate
+    backend: str = "sox"  # "torchaudio" -> in-process for wav/flac, sox as fallback
+
+
+IN_PROCESS_FORMATS = ["wav", "flac"]
 
 
 def process_build_sample(
@@ -113,10 +197,29 @@ def process_audio(
         .replace(suffix, f".{ac.format}")
     )
     processed_audio_file = f"{processed_dir}/{file_name}"
-    if ac.bitrate is not None:
-        cmd = f"sox {audio_file} -C {ac.bitrate} {processed_audio_file}"
+    in_process = (
+        ac.backend == "torchaudio"
+        and ac.format in IN_PROCESS_FORMATS
+        and ac.bitrate is None
+    )
+    if in_process:
+        num_frames, sample_rate = transcode_in_process(
+            audio_file, processed_audio_file, ac.sample_rate
+        )
     else:
-        cmd = f"sox {audio_file} {processed_audio_file}"
+        num_frames, sample_rate = transcode_with_sox(
+            audio_file, processed_audio_file, ac
+        )
+    len_in_seconds = num_frames / sample_rate
+    return file_name, len_in_seconds, num_frames
+
+
+def transcode_with_sox(
+    audio_file: str, processed_audio_file: str, ac: AudioConfig
+) -> Tuple[int, int]:
+    bitrate = f" -C {ac.bitrate}" if ac.bitrate is not None else ""
+    rate = f" -r {ac.sample_rate}" if ac.sample_rate is not None else ""
+    cmd = f"sox {audio_file}{rate}{bitrate} {processed_audio_file}"
 
     out = exec_command(cmd)
     if len(out["stdout"]) > 0:
@@ -125,29 +228,78 @@ def process_audio(
         print(f"stderr: {out['stderr']}")
 
     info = torchaudio.info(processed_audio_file)
-    num_frames = info.num_frames
-    len_in_seconds = info.num_frames / info.sample_rate
-    return file_name, len_in_seconds, num_frames
+    return info.num_frames, info.sample_rate
 
 
-def maybe_download_compressed(local_filename, download_folder, url, verbose=False):
-    os.makedirs(download_folder, exist_ok=True)
+def transcode_in_process(
+    audio_file: str, processed_audio_file: str, target_rate: Optional[int] = None
+) -> Tuple[int, int]:
+    """
+    decode -> (resample) -> encode as 16bit, no subprocess and no re-reading of the
+    written file, num_frames come from the decoded buffer
+    """
+    waveform, sample_rate = torchaudio.load(audio_file)
+    if target_rate is not None and sample_rate != target_rate:
+        waveform = get_resampler(sample_rate, target_rate)(waveform)
+        sample_rate = target_rate
+    pcm16 = (waveform * (1 << 15)).clamp(-(1 << 15), (1 << 15) - 1).to(torch.int16)
+    torchaudio.save(processed_audio_file, pcm16, sample_rate)
+    return waveform.size(1), sample_rate
+
 
+def _compressed_local_file(local_filename, download_folder, url) -> str:
     suffs = [suff for suff in COMPRESSION_SUFFIXES if url.endswith(suff)]
     assert len(suffs) == 1
     suffix = suffs[0]
+    return os.path.join(download_folder, local_filename + suffix)
 
-    localfile = os.path.join(download_folder, local_filename + suffix)
 
+def maybe_download_compressed(local_filename, download_folder, url, verbose=False):
+    os.makedirs(download_folder, exist_ok=True)
+    localfile = _compressed_local_file(local_filename, download_folder, url)
     maybe_download(localfile, url, verbose)
     return localfile
 
 
 def maybe_download(localfile, url, verbose):
-    cmd = f"wget -c -N{' -q' if not verbose else ''} -O {localfile} {url}"
-    err_code = os.system(cmd)
-    if err_code != 0:
-        raise FileNotFoundError("could not downloaded %s" % url.split("/")[-1])
+    """
+    resumes partial downloads, skips files recorded as complete in downloads.json
+    """
+    manager = DownloadManager(os.path.dirname(os.path.abspath(localfile)), verbose=verbose)
+    manager.download(DownloadJob(url, localfile))
+
+
+def download_corpora(
+    corpora: List[SpeechCorpus],
+    download_folder: str,
+    max_workers: int = 4,
+    checksums_file: Optional[str] = None,
+) -> List[str]:
+    """
+    downloads the raw archives of all corpora concurrently (to where get_raw_zipfile expects them)
+    :param checksums_file: json of url -> "md5:<hex>" (or "sha256:<hex>") to verify against,
+        urls not yet in there get the checksum of their first download pinned
+    """
+    checksums = {}
+    if checksums_file is not None and os.path.isfile(checksums_file):
+        checksums = data_io.read_json(checksums_file)
+    jobs = [
+        DownloadJob(
+            c.url,
+            _compressed_local_file(c.name, download_folder, c.url),
+            checksums.get(c.url),
+        )
+        for c in corpora
+    ]
+    manager = DownloadManager(download_folder, max_workers)
+    local_files = manager.download_all(jobs)
+    if checksums_file is not None:
+        completed = manager.completed()
+        for job in jobs:
+            d = completed[os.path.basename(job.local_file)]
+            checksums.setdefault(job.url, d["checksum"])
+        data_io.write_json(checksums_file, checksums)
+    return local_files
 
 
 def get_extract_process_zip_data(
@@ -157,10 +309,12 @@ def get_extract_process_zip_data(
     work_dir: str,
     remove_raw_extract: bool = True,
     overwrite: bool = False,
+    num_workers: Optional[int] = None,
 ):
     """
     zip_dir: only zipped archives files here, NO unzipping/extracting! -> used for google-drive
     work_dir: extracting+processing here, but volatile! -> content-dir on colab compute machine
+    num_workers: if given, processing is done by process_write_manifest_resumable
     """
     raw_zipfile = corpus.get_raw_zipfile(zip_dir)
     ac = f"{audio_config.format}{'' if audio_config.bitrate is None else '_' + str(audio_config.bitrate)}"
@@ -173,9 +327,14 @@ def get_extract_process_zip_data(
         file2utt = corpus.build_audiofile2text(raw_data_dir)
         print("beginn processing")
         start = time()
-        process_write_manifest(
-            (raw_data_dir, processed_corpus_dir), file2utt, audio_config
-        )
+        if num_workers is not None:
+            process_write_manifest_resumable(
+                (raw_data_dir, processed_corpus_dir), file2utt, audio_config, num_workers
+            )
+        else:
+            process_write_manifest(
+                (raw_data_dir, processed_corpus_dir), file2utt, audio_config
+            )
         print(
             f"processing done in: {time()-start} secs; now targzipping {processed_corpus_dir}"
         )
@@ -189,12 +348,15 @@ def get_extract_process_zip_data(
 
 
 def maybe_extract(
-    raw_zipfile: str, raw_extracted_dir: str, overwrite_raw_extract=False
+    raw_zipfile: str,
+    raw_extracted_dir: str,
+    overwrite_raw_extract=False,
+    suffixes: Optional[Tuple[str, ...]] = None,
 ):
     if not os.path.isdir(raw_extracted_dir) or overwrite_raw_extract:
         if overwrite_raw_extract:
             shutil.rmtree(raw_extracted_dir)
-        unzip(raw_zipfile, raw_extracted_dir)
+        unzip(raw_zipfile, raw_extracted_dir, suffixes)
 
 
 def find_files_build_audio2text_openslr(
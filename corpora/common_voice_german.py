@@ -6,7 +6,12 @@ from typing import Dict
 
 import os
 
-from corpora.common import maybe_extract, AudioConfig, process_write_manifest
+from corpora.common import (
+    maybe_extract,
+    AudioConfig,
+    process_write_manifest_resumable,
+    num_cpus,
+)
 from corpora.common_voice import build_audiofile2text
 
 if __name__ == "__main__":
@@ -26,7 +31,9 @@ if __name__ == "__main__":
         file2utt = build_audiofile2text(raw_dir, split_name, "de")
         print(f"beginn processing {processed_corpus_dir}")
         start = time()
-        process_write_manifest((raw_dir, processed_corpus_dir), file2utt, audio_config)
+        process_write_manifest_resumable(
+            (raw_dir, processed_corpus_dir), file2utt, audio_config, num_workers=num_cpus
+        )
         print(f"processing done in: {time() - start} secs")
 
 """
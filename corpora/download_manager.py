@@ -0,0 +1,241 @@
+import fcntl
+import hashlib
+import http.client
+import json
+import os
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from time import sleep, time
+from typing import Dict, List, NamedTuple, Optional
+
+"""
+replacement for sequential "wget -c -N": several downloads in parallel, interrupted
+downloads resume via http-range-requests from their .part-file, checksums are verified
+completed downloads are recorded in downloads.json (per download-dir) -> skipped next time,
+the manifest is guarded by a file-lock cause several managers (threads or processes) may
+download into the same dir
+"""
+
+DOWNLOADS_MANIFEST = "downloads.json"
+CHUNK_SIZE = 1 << 20
+PART_SUFFIX = ".part"
+
+
+class DownloadJob(NamedTuple):
+    url: str
+    local_file: str
+    checksum: Optional[str] = None  # "md5:<hex>" or "sha256:<hex>"
+
+
+def file_checksum(file: str, algorithm: str = "sha256") -> str:
+    h = hashlib.new(algorithm)
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return f"{algorithm}:{h.hexdigest()}"
+
+
+@contextmanager
+def file_lock(lock_file: str):
+    with open(lock_file, "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def fetch_to_part_file(job: DownloadJob, timeout: float = 60.0) -> str:
+    """
+    continues the .part-file where it ends (range-request), starts from scratch if the
+    server does not support ranges
+    :return: the .part-file
+    """
+    part_file = job.local_file + PART_SUFFIX
+    offset = os.path.getsize(part_file) if os.path.isfile(part_file) else 0
+    request = urllib.request.Request(job.url)
+    if offset > 0:
+        request.add_header("Range", f"bytes={offset}-")
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code == 416 and offset > 0:  # range not satisfiable -> .part is complete
+            return part_file
+        raise
+
+    with response:
+        resumed = offset > 0 and response.status == 206
+        with open(part_file, "ab" if resumed else "wb") as f:
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                f.write(chunk)
+        expected_size = response.headers.get("Content-Length")
+    if expected_size is not None:
+        size = os.path.getsize(part_file) - (offset if resumed else 0)
+        if size != int(expected_size):
+            raise IOError(f"got {size} of {expected_size} bytes from {job.url}")
+    return part_file
+
+
+class DownloadManager:
+    def __init__(
+        self,
+        download_dir: str,
+        max_workers: int = 4,
+        num_retries: int = 5,
+        verbose: bool = True,
+    ):
+        self.download_dir = download_dir
+        self.max_workers = max_workers
+        self.num_retries = num_retries
+        self.verbose = verbose
+        self.manifest_file = f"{download_dir}/{DOWNLOADS_MANIFEST}"
+        os.makedirs(download_dir, exist_ok=True)
+
+    def completed(self) -> Dict[str, Dict]:
+        if not os.path.isfile(self.manifest_file):
+            return {}
+        with open(self.manifest_file) as f:
+            return json.load(f)
+
+    def _record(self, job: DownloadJob, checksum: str):
+        with file_lock(self.manifest_file + ".lock"):
+            completed = self.completed()
+            completed[os.path.basename(job.local_file)] = {
+                "url": job.url,
+                "size": os.path.getsize(job.local_file),
+                "checksum": checksum,
+            }
+            tmp_file = f"{self.manifest_file}.{os.getpid()}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(completed, f, indent=2)
+            os.replace(tmp_file, self.manifest_file)
+
+    def is_completed(self, job: DownloadJob) -> bool:
+        d = self.completed().get(os.path.basename(job.local_file))
+        return (
+            d is not None
+            and d["url"] == job.url
+            and os.path.isfile(job.local_file)
+            and os.path.getsize(job.local_file) == d["size"]
+            and (job.checksum is None or job.checksum == d["checksum"])
+        )
+
+    def download(self, job: DownloadJob) -> str:
+        if self.is_completed(job):
+            return job.local_file
+        start = time()
+        part_file = job.local_file + PART_SUFFIX
+        if os.path.isfile(job.local_file) and not os.path.isfile(part_file):
+            os.replace(job.local_file, part_file)  # not recorded (e.g. by wget) -> resume it
+        for attempt in range(self.num_retries):
+            try:
+                part_file = fetch_to_part_file(job)
+                break
+            except (urllib.error.URLError, http.client.HTTPException, IOError) as e:
+                if attempt == self.num_retries - 1:
+                    raise FileNotFoundError(f"could not download {job.url}: {e}")
+                print(f"retrying {job.url} after: {e}")
+                sleep(min(2 ** attempt, 30))
+
+        algorithm = "sha256" if job.checksum is None else job.checksum.split(":")[0]
+        checksum = file_checksum(part_file, algorithm)
+        if job.checksum is not None and checksum != job.checksum:
+            os.remove(part_file)
+            raise IOError(f"{job.url}: expected {job.checksum} but got {checksum}")
+        os.replace(part_file, job.local_file)
+        self._record(job, checksum)
+        if self.verbose:
+            mb = os.path.getsize(job.local_file) / (1 << 20)
+            print(f"downloaded {job.local_file}: {mb:.1f} MB in {time() - start:.1f} secs")
+        return job.local_file
+
+    def download_all(self, jobs: List[DownloadJob]) -> List[str]:
+        """
+        raises the first failure after all other downloads are done
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.download, job) for job in jobs]
+        return [f.result() for f in futures]
+
+
+def test_download_manager(tmp_path):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    files = {f"/corpus_{k}.tar.gz": os.urandom(300_000 + k) for k in range(3)}
+    requests = []
+
+    class RangeHandler(BaseHTTPRequestHandler):
+        fail_once = {"/corpus_1.tar.gz"}  # connection drops in the middle
+
+        def do_GET(self):
+            data = files[self.path]
+            range_header = self.headers.get("Range")
+            requests.append((self.path, range_header))
+            offset = int(range_header[6:-1]) if range_header is not None else 0
+            self.send_response(206 if offset > 0 else 200)
+            self.send_header("Content-Length", str(len(data) - offset))
+            self.end_headers()
+            if self.path in self.fail_once:
+                self.fail_once.remove(self.path)
+                self.wfile.write(data[offset : offset + 100_000])
+                return
+            self.wfile.write(data[offset:])
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        download_dir = f"{tmp_path}/downloads"
+        manager = DownloadManager(download_dir, num_retries=2, verbose=False)
+        jobs = [
+            DownloadJob(
+                base_url + path,
+                f"{download_dir}{path}",
+                "md5:" + hashlib.md5(data).hexdigest(),
+            )
+            for path, data in files.items()
+        ]
+        local_files = manager.download_all(jobs)
+        for local_file, data in zip(local_files, files.values()):
+            with open(local_file, "rb") as f:
+                assert f.read() == data
+        assert ("/corpus_1.tar.gz", "bytes=100000-") in requests  # resumed
+        assert len(manager.completed()) == 3
+
+        num_requests = len(requests)
+        manager.download_all(jobs)
+        assert len(requests) == num_requests  # nothing downloaded again
+
+        wrong = DownloadJob(base_url + "/corpus_0.tar.gz", f"{download_dir}/wrong", "md5:0")
+        try:
+            manager.download(wrong)
+            assert False
+        except IOError as e:
+            assert "expected md5:0" in str(e)
+        assert not os.path.exists(wrong.local_file + PART_SUFFIX)
+    finally:
+        server.shutdown()
+
+
+def test_managers_share_manifest(tmp_path):
+    download_dir = f"{tmp_path}/downloads"
+    jobs = []
+    for k in range(32):
+        job = DownloadJob(f"http://host/file_{k}", f"{download_dir}/file_{k}")
+        os.makedirs(download_dir, exist_ok=True)
+        with open(job.local_file, "wb") as f:
+            f.write(os.urandom(100))
+        jobs.append(job)
+
+    def record(job):  # one manager per download like maybe_download
+        DownloadManager(download_dir, verbose=False)._record(job, "md5:0")
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(record, jobs))
+    assert len(DownloadManager(download_dir).completed()) == len(jobs)
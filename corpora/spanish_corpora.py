@@ -12,10 +12,15 @@ from corpora.common import (
     find_files_build_audio2text_openslr,
     AudioConfig,
     get_extract_process_zip_data,
+    download_corpora,
 )
 
+OPENSLR_CHECKSUMS_FILE = os.path.join(os.path.dirname(__file__), "openslr_checksums.json")
+
 
 class SpanishDialect(SpeechCorpus):
+    extract_suffixes = (".wav", ".tsv")
+
     def build_audiofile2text(self, path) -> Dict[str, str]:
         audio_suffix = ".wav"
         transcript_suffix = ".tsv"
@@ -51,6 +56,8 @@ class SpanishDialect(SpeechCorpus):
 
 
 class TedxSpanish(SpeechCorpus):
+    extract_suffixes = (".wav", ".transcription")
+
     def build_audiofile2text(self, path) -> Dict[str, str]:
         audio_suffix = ".wav"
         transcript_suffix = ".transcription"
@@ -143,16 +150,19 @@ class HeroicoUSMA(SpeechCorpus):
 
 
 if __name__ == "__main__":
+    zip_dir = "/data"
 
-    # corpora = TedxSpanish.get_corpora() + SpanishDialect.get_corpora()
+    # concurrently, before the sequential processing
+    openslr_corpora = TedxSpanish.get_corpora() + SpanishDialect.get_corpora()
+    download_corpora(openslr_corpora, zip_dir, checksums_file=OPENSLR_CHECKSUMS_FILE)
 
-    corpora = CommonVoiceSpanish.get_corpora()
+    corpora = CommonVoiceSpanish.get_corpora()  # no url, see get_raw_zipfile
     audio_config = AudioConfig("mp3")
     for corpus in corpora:
         get_extract_process_zip_data(
             audio_config,
             corpus,
-            f"/data",
+            zip_dir,
             f"/data/SPANISH_CV",
             remove_raw_extract=False,
             overwrite=True,
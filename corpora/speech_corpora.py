@@ -19,6 +19,8 @@ from corpora.spanish_corpora import SpanishDialect, TedxSpanish
 
 
 class LibriSpeech(SpeechCorpus):
+    extract_suffixes = (".flac", ".trans.txt")
+
     def build_audiofile2text(self, path) -> Dict[str, str]:
         audio_suffix = ".flac"
         transcript_suffix = ".trans.txt"
@@ -6,7 +6,12 @@ import subprocess
 import unicodedata
 import io
 
+from dataclasses import asdict
+
 from tqdm import tqdm
+from util import data_io
+
+from data_related.utils import ASRSample
 
 # stolen from deepspeech.pytorch
 
@@ -27,6 +32,7 @@ parser = add_data_opts(parser)
 parser.add_argument("--target-dir", default='TEDLIUM_dataset/', type=str, help="Directory to store the dataset.")
 parser.add_argument("--tar-path", type=str, help="Path to the TEDLIUM_release tar if downloaded (Optional).")
 parser.add_argument("--format", type=str, default="mp3", help="audio format")
+parser.add_argument("--segments", action="store_true", help="write segment-manifests instead of cutting utterances into files")
 args = parser.parse_args()
 
 TED_LIUM_V2_DL_URL = "http://www.openslr.org/resources/19/TEDLIUM_release2.tar.gz"
@@ -104,6 +110,32 @@ def prepare_dir(ted_dir):
         counter += 1
 
 
+def build_segment_samples(ted_dir, sample_rate=16000):
+    """
+    utterances stay within the sph-files, audio_file is relative to ted_dir (like in manifests)
+    """
+    entries = sorted(os.listdir(os.path.join(ted_dir, "sph")))
+    for sph_file in tqdm(entries, total=len(entries)):
+        speaker_name = sph_file.split('.sph')[0]
+        stm_file_full = os.path.join(ted_dir, "stm", "{}.stm".format(speaker_name))
+        for utterance in filter(filter_short_utterances, get_utterances_from_stm(stm_file_full)):
+            start, end = utterance["start_time"], utterance["end_time"]
+            yield ASRSample(
+                audio_file=f"sph/{sph_file}",
+                text=_preprocess_transcript(utterance["transcript"]),
+                duration=end - start,
+                num_frames=int(round((end - start) * sample_rate)),
+                start=start,
+                end=end,
+            )
+
+
+def write_segment_manifest(ted_dir):
+    manifest_file = os.path.join(ted_dir, "manifest.jsonl.gz")
+    data_io.write_jsonl(manifest_file, (asdict(s) for s in build_segment_samples(ted_dir, args.sample_rate)))
+    print(f"wrote {manifest_file}")
+
+
 def main():
     target_dl_dir = args.target_dir
     if not os.path.exists(target_dl_dir):
@@ -129,9 +161,11 @@ def main():
     val_ted_dir = os.path.join(target_unpacked_dir, "dev")
     test_ted_dir = os.path.join(target_unpacked_dir, "test")
 
-    prepare_dir(train_ted_dir)
-    prepare_dir(val_ted_dir)
-    prepare_dir(test_ted_dir)
+    for ted_dir in [train_ted_dir, val_ted_dir, test_ted_dir]:
+        if args.segments:
+            write_segment_manifest(ted_dir)
+        else:
+            prepare_dir(ted_dir)
 
 if __name__ == "__main__":
     main()
@@ -4,37 +4,26 @@ from abc import abstractmethod
 
 import numpy
 from tempfile import NamedTemporaryFile
-from typing import List, NamedTuple
+from typing import List, NamedTuple, Tuple, Optional
 
 import scipy
 import torch
 import torchaudio
 
+from data_related.audio_io import load_audio
 from data_related.data_augmentation.signal_augment import augment_with_sox
 from data_related.data_augmentation.spec_augment import spec_augment
+from data_related.data_augmentation.waveform_augment import augment_waveform, get_rng
+from data_related.feature_cache import FeatureCache
 
 
-def load_audio(audio_file: str, target_rate=16_000) -> numpy.ndarray:
-    si, _ = torchaudio.info(audio_file)
-    normalize_denominator = 1 << si.precision
-    sound, sample_rate = torchaudio.load(
-        audio_file, normalization=normalize_denominator
-    )
-    if sample_rate != target_rate:
-        resampler = torchaudio.transforms.Resample(
-            orig_freq=sample_rate, new_freq=target_rate
-        )
-        sound = resampler(sound)
-
-    y = sound.squeeze().numpy()
-    return y
-
 class AudioFeaturesConfig(NamedTuple):
     sample_rate: int = 16_000
     feature_type: str = "stft"
     normalize: bool = True
     signal_augment: bool = False
     spec_augment: bool = False
+    signal_augment_backend: str = "numpy"  # or "sox"
 
     @property
     def feature_dim(self):
@@ -73,16 +62,38 @@ def augment_and_load(original_audio_file: str, audio_files: List[str]) -> numpy.
 
 
 class AudioFeatureExtractor:
-    def __init__(self, audio_conf: AudioFeaturesConfig, audio_files: List[str]):
+    def __init__(
+        self,
+        audio_conf: AudioFeaturesConfig,
+        audio_files: List[str],
+        cache: Optional[FeatureCache] = None,
+    ):
         self.audio_files = audio_files
         self.audio_conf = audio_conf
+        self.cache = cache
+
+    @property
+    def is_cacheable(self) -> bool:
+        return not (self.audio_conf.signal_augment or self.audio_conf.spec_augment)
 
     def process(self, audio_file: str) -> torch.Tensor:
+        if self.cache is not None and self.is_cacheable:
+            return self.cache.get_or_compute(audio_file, self._process)
+        return self._process(audio_file)
+
+    def _process(self, audio_file: str) -> torch.Tensor:
+        return self._extract_features(self.load_signal(audio_file))
+
+    def load_signal(self, audio_file: str) -> numpy.ndarray:
         if self.audio_conf.signal_augment:
-            y = augment_and_load(audio_file, self.audio_files)
+            if self.audio_conf.signal_augment_backend == "sox":
+                y = augment_and_load(audio_file, self.audio_files)
+            else:
+                interfere_file = self.audio_files[get_rng().integers(len(self.audio_files))]
+                y = augment_waveform(load_audio(audio_file), load_audio(interfere_file))
         else:
             y = load_audio(audio_file)
-        return self._extract_features(y)
+        return y
 
     @abstractmethod
     def _extract_features(self, sig: numpy.ndarray) -> torch.Tensor:
@@ -90,7 +101,12 @@ class AudioFeatureExtractor:
 
 
 class TorchAudioExtractor(AudioFeatureExtractor):
-    def __init__(self, audio_conf: AudioFeaturesConfig, audio_files: List[str]):
+    def __init__(
+        self,
+        audio_conf: AudioFeaturesConfig,
+        audio_files: List[str],
+        cache: Optional[FeatureCache] = None,
+    ):
         if audio_conf.feature_type == "mfcc":
             self.extractor = torchaudio.transforms.MFCC(
                 sample_rate=self.audio_conf.sample_rate,
@@ -102,7 +118,7 @@ class TorchAudioExtractor(AudioFeatureExtractor):
                 n_mels=self.audio_conf.feature_dim,
             )
 
-        super().__init__(audio_conf, audio_files)
+        super().__init__(audio_conf, audio_files, cache)
 
     def _extract_features(self, sig: numpy.ndarray) -> torch.Tensor:
         torch_tensor = torch.from_numpy(sig).unsqueeze(0)
@@ -120,6 +136,7 @@ def calc_stft_librosa(y,sample_rate,window_size,window_stride,window):
         hop_length=hop_length,
         win_length=win_length,
         window=window,
+        pad_mode="reflect",  # default before librosa 0.10
     )
     spect, phase = librosa.magphase(D)
     # S = log(S+1)
@@ -127,21 +144,87 @@ def calc_stft_librosa(y,sample_rate,window_size,window_stride,window):
     spect = torch.FloatTensor(spect)
     return spect
 
+NAME2WINDOWTYPE = {
+    "hamming": scipy.signal.hamming,
+    "hann": scipy.signal.hann,
+    "blackman": scipy.signal.blackman,
+    "bartlett": scipy.signal.bartlett,
+}
+WINDOW_SIZE: float = 0.02  # seconds
+WINDOW_STRIDE: float = 0.01  # seconds
+WINDOW_TYPE = "hamming"
+
+
+def calc_log_magnitude_frames(
+    padded: numpy.ndarray, num_frames: int, window: numpy.ndarray, hop_length: int
+) -> numpy.ndarray:
+    """
+    :param padded: B x L already padded signals, frame t starts at sample t*hop_length
+    :return: B x num_frames x (n_fft/2+1) log1p of STFT-magnitudes
+    """
+    frames = numpy.lib.stride_tricks.as_strided(
+        padded,
+        shape=(padded.shape[0], num_frames, len(window)),
+        strides=(padded.strides[0], hop_length * padded.strides[1], padded.strides[1]),
+        writeable=False,
+    )
+    return numpy.log1p(numpy.abs(numpy.fft.rfft(frames * window, axis=-1)))
+
+
+def calc_stft_batch(
+    signals: List[numpy.ndarray], window: numpy.ndarray, hop_length: int
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    same as calc_stft_librosa (center=True, reflect-padding, log1p of magnitude)
+    but for a whole minibatch with a single batched FFT
+    :param window: precomputed window of length n_fft
+    :return: spectrograms (B x F x T) zero-padded beyond each length, lengths (B)
+    """
+    n_fft = len(window)
+    pad = n_fft // 2
+    lengths = [1 + len(y) // hop_length for y in signals]
+    num_frames = max(lengths)
+    padded_len = max((num_frames - 1) * hop_length + n_fft, max(map(len, signals)) + 2 * pad)
+
+    padded = numpy.zeros((len(signals), padded_len), dtype=numpy.float32)
+    for k, y in enumerate(signals):
+        padded[k, : len(y) + 2 * pad] = numpy.pad(y, pad, mode="reflect")
+
+    spect = calc_log_magnitude_frames(padded, num_frames, window, hop_length)
+
+    lengths = torch.IntTensor(lengths)
+    spect = torch.from_numpy(spect.astype(numpy.float32)).transpose(1, 2)
+    is_padding = torch.arange(num_frames).unsqueeze(0) >= lengths.unsqueeze(1)
+    spect = spect.masked_fill(is_padding.unsqueeze(1), 0.0)
+    return spect.contiguous(), lengths
+
+
+class BatchStftExtractor:
+    """
+    featurizes a list of raw signals at once, numerically equivalent to LibrosaExtractor
+    (without spec_augment), window gets computed once and not per utterance
+    """
+
+    def __init__(self, audio_conf: AudioFeaturesConfig):
+        assert audio_conf.feature_type == "stft"
+        self.audio_conf = audio_conf
+        n_fft = int(audio_conf.sample_rate * WINDOW_SIZE)
+        self.hop_length = int(audio_conf.sample_rate * WINDOW_STRIDE)
+        # librosa calls a window-function like this -> symmetric window
+        self.window = NAME2WINDOWTYPE[WINDOW_TYPE](n_fft).astype(numpy.float32)
+
+    def __call__(
+        self, signals: List[numpy.ndarray]
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        return calc_stft_batch(signals, self.window, self.hop_length)
+
+
 class LibrosaExtractor(AudioFeatureExtractor):
     def _extract_features(self, sig: numpy.ndarray) -> torch.Tensor:
-        NAME2WINDOWTYPE = {
-            "hamming": scipy.signal.hamming,
-            "hann": scipy.signal.hann,
-            "blackman": scipy.signal.blackman,
-            "bartlett": scipy.signal.bartlett,
-        }
-
-        window_size: float = 0.02
-        window_stride: float = 0.01
-        window = NAME2WINDOWTYPE["hamming"]
+        window = NAME2WINDOWTYPE[WINDOW_TYPE]
 
         spect = calc_stft_librosa(
-            sig, self.audio_conf.sample_rate, window_size, window_stride, window
+            sig, self.audio_conf.sample_rate, WINDOW_SIZE, WINDOW_STRIDE, window
         )
         if self.audio_conf.spec_augment:
             spect = spec_augment(spect)
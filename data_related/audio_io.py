@@ -0,0 +1,107 @@
+from functools import lru_cache
+from typing import Optional
+
+import numpy as np
+import torch
+import torchaudio
+
+"""
+audio loading without probing: torchaudio.load (sox_io-api) returns normalized floats
+and the sample-rate in one go, so no torchaudio.info per file
+resamplers are cached per (orig_freq, new_freq) -> sinc-kernel is computed once per process
+
+signals are scaled to int16-range like the former torchaudio.load(normalization=1 << precision)
+-> same features as before, trained models get the inputs they were trained on
+"""
+
+INT16_SCALE = 1 << 15
+
+
+def _select_sox_io_backend():
+    """
+    the legacy "sox"-backend has another signature (normalization, offset) and scaling
+    torchaudio>=2.1 has no global backend anymore, load dispatches per file
+    """
+    if hasattr(torchaudio, "set_audio_backend"):
+        torchaudio.set_audio_backend("sox_io")
+        assert torchaudio.get_audio_backend() == "sox_io"
+
+
+_select_sox_io_backend()
+
+
+@lru_cache(maxsize=None)
+def get_resampler(orig_freq: int, new_freq: int) -> torchaudio.transforms.Resample:
+    return torchaudio.transforms.Resample(orig_freq=orig_freq, new_freq=new_freq)
+
+
+def resample(sound: torch.Tensor, sample_rate: int, target_rate: int) -> torch.Tensor:
+    if sample_rate == target_rate:
+        return sound
+    return get_resampler(sample_rate, target_rate)(sound)
+
+
+@lru_cache(maxsize=1024)
+def get_sample_rate(audio_file: str) -> int:
+    """
+    only needed to convert seconds into frames before reading a segment
+    """
+    return torchaudio.info(audio_file).sample_rate
+
+
+def load_audio(
+    audio_file: str,
+    target_rate=16_000,
+    frame_offset: int = 0,
+    num_frames: int = -1,
+) -> np.ndarray:
+    """
+    :param frame_offset, num_frames: in frames of the file's sample-rate, -1 -> till the end
+    """
+    sound, sample_rate = torchaudio.load(
+        audio_file, frame_offset=frame_offset, num_frames=num_frames
+    )
+    return resample(sound * INT16_SCALE, sample_rate, target_rate).squeeze().numpy()
+
+
+def load_audio_segment(
+    audio_file: str,
+    start: float,
+    end: float,
+    target_rate=16_000,
+    orig_rate: Optional[int] = None,
+) -> np.ndarray:
+    """
+    :param start, end: in seconds
+    :param orig_rate: sample-rate of the file if known (e.g. all files of a corpus have
+    the same format), otherwise it is probed (once per file)
+    """
+    orig_rate = orig_rate if orig_rate is not None else get_sample_rate(audio_file)
+    frame_offset = int(round(start * orig_rate))
+    num_frames = int(round(end * orig_rate)) - frame_offset
+    return load_audio(audio_file, target_rate, frame_offset, num_frames)
+
+
+def test_resampler_is_cached():
+    y = torch.sin(torch.arange(44_100, dtype=torch.float) * 0.05).unsqueeze(0)
+    assert get_resampler(44_100, 16_000) is get_resampler(44_100, 16_000)
+    resampled = resample(y, 44_100, 16_000)
+    assert resampled.shape == (1, 16_000)
+    assert torch.allclose(
+        resampled, torchaudio.transforms.Resample(44_100, 16_000)(y), atol=1e-6
+    )
+    assert resample(y, 16_000, 16_000) is y
+
+
+if __name__ == "__main__":
+    from time import time
+
+    y = torch.randn(1, 5 * 48_000)
+    for name, make_resampler in [
+        ("new Resample per call", torchaudio.transforms.Resample),
+        ("cached", get_resampler),
+    ]:
+        start = time()
+        for _ in range(20):
+            make_resampler(48_000, 16_000)(y)
+        print(f"{name}: {(time() - start) / 20 * 1000:.1f} ms per 5 seconds of 48kHz-audio")
@@ -1,11 +1,18 @@
 from torch.distributed import get_rank
 from torch.utils.data import Dataset
-from typing import NamedTuple, List
+from typing import NamedTuple, List, Optional, Union
 
 from data_related.audio_feature_extraction import (
     AudioFeaturesConfig,
     AudioFeatureExtractor,
     AUDIOFEATUREEXTRACTORS, )
+from data_related.audio_io import load_audio
+from data_related.data_augmentation.spec_augment import spec_augment
+from data_related.feature_cache import FeatureCache
+from data_related.feature_store import MemmapFeatureStore
+from data_related.data_augmentation.waveform_augment import augment_waveform, get_rng
+from data_related.manifest_index import ManifestIndex
+from data_related.segment_reader import SegmentReader
 from data_related.utils import ASRSample
 from utils import HOME
 
@@ -19,9 +26,15 @@ class DataConfig(NamedTuple):
 MILLISECONDS_TO_SECONDS = 0.001
 
 
-def sort_samples_in_corpus(samples: List[ASRSample], min_len, max_len) -> List[ASRSample]:
-    f_samples_g = filter(lambda s: s.duration > min_len and s.duration < max_len, samples)
-    s_samples: List[ASRSample] = sorted(f_samples_g, key=lambda s: s.duration)
+Samples = Union[List[ASRSample], ManifestIndex]
+
+
+def sort_samples_in_corpus(samples: Samples, min_len, max_len) -> Samples:
+    if isinstance(samples, ManifestIndex):
+        s_samples = samples.filter_and_sort(min_len, max_len)
+    else:
+        f_samples_g = filter(lambda s: s.duration > min_len and s.duration < max_len, samples)
+        s_samples: List[ASRSample] = sorted(f_samples_g, key=lambda s: s.duration)
     assert len(s_samples) > 0
     print("%d of %d samples are suitable for training" % (len(s_samples), len(samples)))
     return s_samples
@@ -30,25 +43,85 @@ def sort_samples_in_corpus(samples: List[ASRSample], min_len, max_len) -> List[A
 class CharSTTDataset(Dataset):
     def __init__(
         self,
-        samples: List[ASRSample],
+        samples: Samples,
         conf: DataConfig,
         audio_conf: AudioFeaturesConfig,
+        feature_store: Optional[MemmapFeatureStore] = None,
+        featurize_in_collate: bool = False,
+        feature_cache: Optional[FeatureCache] = None,
     ):
+        """
+        :param featurize_in_collate: return raw signals, features are calculated batch-wise
+         by BatchFeaturizingCollate
+        :param feature_cache: only used if there is no augmentation, useful for eval-sets
+        :param samples: a ManifestIndex is much cheaper to filter/sort and to send to workers
+        """
         self.conf = conf
+        self.audio_conf = audio_conf
+        if feature_store is not None:
+            assert not audio_conf.signal_augment, "precomputed features are not augmentable"
+            assert feature_store.audio_conf.feature_type == audio_conf.feature_type
+        self.feature_store = feature_store
+        self.featurize_in_collate = featurize_in_collate
+        self.segment_reader = SegmentReader()
         self.samples = sort_samples_in_corpus(samples, conf.min_len, conf.max_len)
 
+        if isinstance(self.samples, ManifestIndex):
+            audio_files = self.samples.audio_files
+        else:
+            audio_files = [s.audio_file for s in self.samples]
+
         self.char2idx = dict([(conf.labels[i], i) for i in range(len(conf.labels))])
         self.audio_fe: AudioFeatureExtractor = AUDIOFEATUREEXTRACTORS[
             audio_conf.feature_type
-        ](audio_conf, [s.audio_file for s in self.samples])
+        ](audio_conf, audio_files, feature_cache)
         super().__init__()
 
     def __getitem__(self, index):
         s: ASRSample = self.samples[index]
-        feat = self.audio_fe.process(s.audio_file)
+        feat = self._load_features(s)
         transcript = self.parse_transcript(s.text)
         return feat, transcript
 
+    def _load_features(self, s: ASRSample):
+        if s.start is not None:
+            return self._load_segment_features(s)
+        if self.featurize_in_collate:
+            feat = self.audio_fe.load_signal(s.audio_file)
+        elif self.feature_store is not None:
+            feat = self.feature_store.get(s.audio_file)  # float16 view on memmap
+            if self.audio_conf.spec_augment:
+                feat = spec_augment(feat.float())
+        else:
+            feat = self.audio_fe.process(s.audio_file)
+        return feat
+
+    def _read_segment(self, s: ASRSample):
+        if s.start is None:
+            return load_audio(s.audio_file, self.audio_conf.sample_rate)
+        return self.segment_reader.read(
+            s.audio_file, s.start, s.end, self.audio_conf.sample_rate
+        )
+
+    def _load_segment_features(self, s: ASRSample):
+        """
+        segments are not cut into files -> no feature-store/cache, interference for
+        signal-augmentation is another segment (not another whole recording)
+        """
+        return self._signal_to_features(self._read_segment(s))
+
+    def _signal_to_features(self, y):
+        """
+        for signals not loaded by audio_fe (segments, prefetched audio-bytes):
+        numpy signal-augmentation with another sample as interference
+        """
+        if self.audio_conf.signal_augment:
+            interfere = self.samples[get_rng().integers(len(self.samples))]
+            y = augment_waveform(y, self._read_segment(interfere))
+        if self.featurize_in_collate:
+            return y
+        return self.audio_fe._extract_features(y)
+
     def parse_transcript(self, transcript: str) -> List[int]:
         transcript = list(
             filter(None, [self.char2idx.get(x) for x in list(transcript)])
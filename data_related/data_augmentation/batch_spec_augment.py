@@ -0,0 +1,142 @@
+from typing import Optional
+
+import torch
+
+"""
+SpecAugment on a whole padded batch (B x F x T), vectorized and on the device of the batch
+time warp: piecewise-linear resampling of the time-axis (instead of sparse_image_warp),
+masks are drawn within each utterance's true length, padding stays zero
+"""
+
+
+def _randint(high: torch.Tensor, generator=None) -> torch.Tensor:
+    """
+    uniform integers in [0, high) elementwise, high may be 0 -> 0
+    """
+    r = torch.rand(high.shape, device=high.device, generator=generator)
+    return (r * high.float()).long()
+
+
+def time_warp_batch(
+    spects: torch.Tensor, lengths: torch.Tensor, W: int = 5, generator=None
+) -> torch.Tensor:
+    """
+    within each utterance the frame at point p is moved to p+d (d in [-W,W)), frames left
+    and right of it are linearly stretched/squeezed, utterances shorter than 2W+1 are not warped
+    """
+    B, F, T = spects.shape
+    device = spects.device
+    lengths = lengths.to(device).long()
+    warpable = lengths > 2 * W
+    point = W + _randint((lengths - 2 * W).clamp(min=1), generator)
+    dist = _randint(torch.full_like(lengths, 2 * W), generator) - W
+    dist = torch.where(warpable, dist, torch.zeros_like(dist))
+    dest = (point + dist).float()[:, None]
+    point, length = point.float()[:, None], lengths.float()[:, None]
+
+    t = torch.arange(T, device=device, dtype=torch.float)[None, :].expand(B, T)
+    left = t * point / dest
+    right = point + (t - dest) * (length - 1 - point) / (length - 1 - dest).clamp(min=1)
+    src = torch.where(t < dest, left, right)
+    src = torch.where(t < length, src, t)  # padding maps onto itself
+    src = torch.where(warpable[:, None], src, t)
+
+    i0 = src.floor().long().clamp(0, T - 1)
+    i1 = (i0 + 1).clamp(max=T - 1)
+    w = (src - i0.float())[:, None, :]
+    x0 = spects.gather(2, i0[:, None, :].expand(B, F, T))
+    x1 = spects.gather(2, i1[:, None, :].expand(B, F, T))
+    return x0 * (1 - w) + x1 * w
+
+
+def _band_masks(
+    size: int, max_width: int, num_masks: int, limits: torch.Tensor, generator=None
+) -> torch.Tensor:
+    """
+    :param limits: B, masks lie within [0, limit)
+    :return: B x size boolean, True where masked
+    """
+    B = limits.size(0)
+    limits = limits[:, None].expand(B, num_masks)
+    width = torch.minimum(_randint(torch.full_like(limits, max_width), generator), limits)
+    start = _randint(limits - width + 1, generator)
+    steps = torch.arange(size, device=limits.device)[None, None, :]
+    in_band = (steps >= start[:, :, None]) & (steps < (start + width)[:, :, None])
+    return in_band.any(dim=1)
+
+
+def batch_spec_augment(
+    spects: torch.Tensor,
+    lengths: torch.Tensor,
+    time_warping_para=5,
+    frequency_masking_para=27,
+    time_masking_para=30,
+    frequency_mask_num=1,
+    time_mask_num=1,
+    generator: Optional[torch.Generator] = None,
+) -> torch.Tensor:
+    """
+    same parameters as spec_augment
+    :param spects: B x F x T or B x 1 x F x T (like _collate_fn output)
+    :param lengths: number of valid frames per utterance
+    """
+    is_4d = spects.dim() == 4
+    if is_4d:
+        spects = spects.squeeze(1)
+    B, F, T = spects.shape
+    lengths = lengths.to(spects.device).long()
+
+    if time_warping_para > 0:
+        spects = time_warp_batch(spects, lengths, time_warping_para, generator)
+
+    mask = torch.zeros(B, F, T, dtype=torch.bool, device=spects.device)
+    if frequency_mask_num > 0:
+        freq_mask = _band_masks(
+            F,
+            frequency_masking_para,
+            frequency_mask_num,
+            torch.full_like(lengths, F),
+            generator,
+        )
+        mask |= freq_mask[:, :, None]
+    if time_mask_num > 0:
+        time_mask = _band_masks(
+            T, time_masking_para, time_mask_num, lengths, generator
+        )
+        mask |= time_mask[:, None, :]
+    spects = spects.masked_fill(mask, 0.0)
+
+    return spects.unsqueeze(1) if is_4d else spects
+
+
+def test_batch_spec_augment():
+    g = torch.Generator().manual_seed(0)
+    lengths = torch.IntTensor([200, 120, 8])
+    spects = torch.rand(3, 161, 200) + 1.0
+    for b, l in enumerate(lengths):
+        spects[b, :, l:] = 0.0
+
+    augmented = batch_spec_augment(spects, lengths, generator=g)
+    assert augmented.shape == spects.shape
+    for b, l in enumerate(lengths):
+        assert torch.all(augmented[b, :, l:] == 0.0)  # padding stays padding
+        masked_rows = (augmented[b, :, :l] == 0).all(dim=1).sum()
+        assert masked_rows < 27 or l <= 30  # short ones can be fully time-masked
+
+    # no masks -> warp only; shortest utterance is not warped
+    warped = batch_spec_augment(
+        spects, lengths, frequency_mask_num=0, time_mask_num=0, generator=g
+    )
+    assert torch.equal(warped[2], spects[2])
+    assert torch.allclose(warped[:, :, 0], spects[:, :, 0])  # endpoints stay fixed
+    assert torch.allclose(warped[1, :, 119], spects[1, :, 119])
+
+    # 4d-input like _collate_fn, masks restricted to valid frames
+    masked = batch_spec_augment(
+        spects.unsqueeze(1), lengths, time_warping_para=0, frequency_mask_num=0,
+        time_masking_para=50, time_mask_num=2, generator=g,
+    ).squeeze(1)
+    is_masked_frame = (masked == 0).all(dim=1)
+    for b, l in enumerate(lengths):
+        assert is_masked_frame[b, :l].sum() <= 100
+        assert is_masked_frame[b, l:].all()
@@ -75,65 +75,80 @@ def add_signals_trim_to_len(original, signals, augmented):
     return sox_cmd
 
 
-def build_random_bandpass(min_low=50, min_band_width=100, max_high=1000) -> Dict:
+def build_random_bandpass(
+    min_low=50, min_band_width=100, max_high=1000, rng=np.random
+) -> Dict:
     d = {}
     max_high_cutoff = MAX_FREQ
-    if np.random.choice([True, False], p=[0.5, 0.5]):
-        lowpass = int(round(np.random.uniform(low=min_low, high=MAX_FREQ)))
+    if rng.choice([True, False], p=[0.5, 0.5]):
+        lowpass = int(round(rng.uniform(low=min_low, high=MAX_FREQ)))
         d["lowpass"] = lowpass
         max_high_cutoff = lowpass - min_band_width
 
-    if np.random.choice([True, False], p=[0.5, 0.5]):
-        highpass = int(
-            round(np.random.uniform(low=1, high=min(max_high, max_high_cutoff)))
-        )
+    if rng.choice([True, False], p=[0.5, 0.5]):
+        highpass = int(round(rng.uniform(low=1, high=min(max_high, max_high_cutoff))))
         d["highpass"] = highpass
 
     return d
 
 
-def augment_with_sox(original_file, audio_files, augmented_file):
-    interfere_file = np.random.choice(audio_files)
+def sample_augmentation_params(rng=np.random) -> Dict[str, Dict]:
+    """
+    :param rng: np.random or a np.random.Generator
+    """
     min_SNR = 20  # normal:20, less:30, evenless:40
     min_SIR = 5  # normal:10, less:20, evenless:30
 
-    signal_gain = round(np.random.uniform(low=-10, high=0), 2)
+    signal_gain = round(rng.uniform(low=-10, high=0), 2)
     signal_params = {
-        "tempo": round(np.random.triangular(left=0.7, mode=1.0, right=1.3), 2),
+        "tempo": round(rng.triangular(left=0.7, mode=1.0, right=1.3), 2),
         "pitch": int(
-            round(np.random.triangular(left=-200, mode=0, right=200))
+            round(rng.triangular(left=-200, mode=0, right=200))
         ),  # normal 100, less: 50, evenless: 30
-        "reverb": (int(round(np.random.uniform(low=0, high=50))), 50, 100, 100, 0, 0,),
+        "reverb": (int(round(rng.uniform(low=0, high=50))), 50, 100, 100, 0, 0,),
         "gain -n": signal_gain,
     }
-    signal_params.update(build_random_bandpass(1000, 1000, 100))
+    signal_params.update(build_random_bandpass(1000, 1000, 100, rng))
 
     interfere_params = {
-        "tempo": round(np.random.uniform(low=0.6, high=1.4), 2),
-        "pitch": int(round(np.random.uniform(low=-500, high=500))),
-        "reverb": (int(round(np.random.uniform(low=0, high=100))), 50, 100, 100, 0, 0),
-        "gain -n": round(np.random.uniform(low=-50, high=signal_gain - min_SIR), 2),
+        "tempo": round(rng.uniform(low=0.6, high=1.4), 2),
+        "pitch": int(round(rng.uniform(low=-500, high=500))),
+        "reverb": (int(round(rng.uniform(low=0, high=100))), 50, 100, 100, 0, 0),
+        "gain -n": round(rng.uniform(low=-50, high=signal_gain - min_SIR), 2),
+    }
+    interfere_params.update(build_random_bandpass(50, 100, 1000, rng))
+
+    noise_power = round(rng.uniform(-60, signal_gain - min_SNR), 2)
+    lowpass = int(round(rng.uniform(low=100, high=MAX_FREQ)))
+    highpass = int(round(rng.uniform(low=1, high=lowpass)))
+    noise_params = {
+        "amod_lowpass_cutoff": rng.uniform(0.1, 2),
+        "lowpass_cutoff": lowpass,
+        "highpass_cutoff": highpass,
+        "noise_gain": noise_power,
+    }
+    interference_params = {
+        "lowpass_cutoff": rng.uniform(0.5, 2),
+        "ac_gain": int(round(rng.uniform(-9, -3))),
+    }
+    return {
+        "signal": signal_params,
+        "interfere": interfere_params,
+        "noise": noise_params,
+        "interference": interference_params,
     }
-    interfere_params.update(build_random_bandpass(50, 100, 1000))
-
-    # params = {'signal_params':signal_params,'interfere_params':interfere_params,'noise_power':noise_power}
-    # pprint(params)
 
-    signal = build_sox_distortions(original_file, signal_params)
-    interfere_signal = build_sox_distortions(interfere_file, interfere_params)
 
-    noise_power = round(np.random.uniform(-60, signal_gain - min_SNR), 2)
-    lowpass = int(round(np.random.uniform(low=100, high=MAX_FREQ)))
-    highpass = int(round(np.random.uniform(low=1, high=lowpass)))
-    noise = build_sox_noise(
-        original_file, np.random.uniform(0.1, 2), lowpass, highpass, noise_power
-    )
+def augment_with_sox(original_file, audio_files, augmented_file):
+    interfere_file = audio_files[np.random.randint(len(audio_files))]
+    params = sample_augmentation_params()
+    # pprint(params)
 
+    signal = build_sox_distortions(original_file, params["signal"])
+    interfere_signal = build_sox_distortions(interfere_file, params["interfere"])
+    noise = build_sox_noise(original_file, **params["noise"])
     interf = build_sox_interference(
-        interfere_file,
-        interfere_signal,
-        lowpass_cutoff=np.random.uniform(0.5, 2),
-        ac_gain=int(round(np.random.uniform(-9, -3))),
+        interfere_file, interfere_signal, **params["interference"]
     )
 
     sox_cmd = add_signals_trim_to_len(
@@ -12,45 +12,44 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ==============================================================================
-# import torch
-# import numpy as np
-# from torch.autograd import Variable
-# import librosa
 import random
-import numpy as np
+from functools import lru_cache
 
-# import scipy.signal
+import numpy as np
 import torch
 
-# import torchaudio
-# from torchaudio import transforms
-# import math
-# from torch.utils.data import DataLoader
-# from torch.utils.data import Dataset
+"""
+torch port of tensorflow_addons sparse_image_warp, images are B x H x W (no channel-dim)
+dense grids are cached per (height, width, device), control points are batched (B x n x 2)
+horizontal flows (all control points move along the width-axis only, like in time_warp)
+take a fast path: only the x-component of the spline is evaluated and images are
+interpolated linearly along the width instead of bilinearly
+"""
+
+EPSILON = 1e-10
 
 
 def time_warp(spec, W=5):
+    """
+    one random horizontal warp around the center-row, borders pinned by one
+    boundary-point per edge (like SpecAugment with tensorflow_addons)
+    :param spec: F x T
+    """
     spec = spec.view(1, spec.shape[0], spec.shape[1])
     num_rows = spec.shape[1]
     spec_len = spec.shape[2]
 
     y = num_rows // 2
-    horizontal_line_at_ctr = spec[0][y]
-    assert len(horizontal_line_at_ctr) == spec_len
-
-    point_to_warp = horizontal_line_at_ctr[random.randrange(W, spec_len - W)]
-    assert isinstance(point_to_warp, torch.Tensor)
+    point_to_warp = random.randrange(W, spec_len - W)
 
     # Uniform distribution from (0,W) with chance to be up to W negative
     dist_to_warp = random.randrange(-W, W)
-    src_pts, dest_pts = (
-        torch.tensor([[[y, point_to_warp]]]),
-        torch.tensor([[[y, point_to_warp + dist_to_warp]]]),
+    src_pts = torch.tensor([[[y, point_to_warp]]], dtype=torch.float)
+    dest_pts = torch.tensor([[[y, point_to_warp + dist_to_warp]]], dtype=torch.float)
+    warped_spectro, dense_flows = sparse_image_warp(
+        spec, src_pts, dest_pts, num_boundary_points=1
     )
-    warped_spectro, dense_flows = SparseImageWarp.sparse_image_warp(
-        spec, src_pts, dest_pts
-    )
-    return warped_spectro.squeeze(3)
+    return warped_spectro.squeeze(0)
 
 
 def freq_mask(spec, F=15, num_masks=1, replace_with_zero=False):
@@ -100,49 +99,79 @@ def sparse_image_warp(
     dest_control_point_locations,
     interpolation_order=2,
     regularization_weight=0.0,
-    num_boundaries_points=0,
+    num_boundary_points=0,
 ):
-    control_point_flows = dest_control_point_locations - source_control_point_locations
-
+    """
+    :param img_tensor: B x H x W
+    :param source_control_point_locations: B x n x 2 (y, x)
+    :param dest_control_point_locations: B x n x 2 (y, x)
+    :param num_boundary_points: per image-edge, zero-flow points that pin the borders
+    :return: warped image (B x H x W), dense flows (B x H x W x 2)
+    """
     batch_size, image_height, image_width = img_tensor.shape
-    grid_locations = get_grid_locations(image_height, image_width)
-    flattened_grid_locations = torch.tensor(
-        flatten_grid_locations(grid_locations, image_height, image_width)
-    )
-
-    flattened_flows = interpolate_spline(
-        dest_control_point_locations,
+    device = img_tensor.device
+    src = source_control_point_locations.to(device).float()
+    dest = dest_control_point_locations.to(device).float()
+    if num_boundary_points > 0:
+        boundary = get_boundary_locations(
+            image_height, image_width, num_boundary_points, str(device)
+        ).expand(batch_size, -1, -1)
+        src = torch.cat([src, boundary], 1)
+        dest = torch.cat([dest, boundary], 1)
+    control_point_flows = dest - src
+
+    if bool((control_point_flows[:, :, 0] == 0).all()):
+        flows_x = interpolate_spline_on_grid(
+            dest,
+            control_point_flows[:, :, 1:],
+            image_height,
+            image_width,
+            interpolation_order,
+            regularization_weight,
+        ).squeeze(3)
+        warped_image = horizontal_image_warp(img_tensor, flows_x)
+        dense_flows = torch.stack([torch.zeros_like(flows_x), flows_x], -1)
+        return warped_image, dense_flows
+
+    dense_flows = interpolate_spline_on_grid(
+        dest,
         control_point_flows,
-        flattened_grid_locations,
+        image_height,
+        image_width,
         interpolation_order,
         regularization_weight,
     )
-
-    dense_flows = create_dense_flows(
-        flattened_flows, batch_size, image_height, image_width
-    )
-
     warped_image = dense_image_warp(img_tensor, dense_flows)
-
     return warped_image, dense_flows
 
 
-def get_grid_locations(image_height, image_width):
-    """Wrapper for np.meshgrid."""
-
-    y_range = np.linspace(0, image_height - 1, image_height)
-    x_range = np.linspace(0, image_width - 1, image_width)
-    y_grid, x_grid = np.meshgrid(y_range, x_range, indexing="ij")
-    return np.stack((y_grid, x_grid), -1)
-
-
-def flatten_grid_locations(grid_locations, image_height, image_width):
-    return np.reshape(grid_locations, [image_height * image_width, 2])
+@lru_cache(maxsize=16)
+def get_flattened_grid_locations(image_height, image_width, device="cpu"):
+    """
+    :return: (H*W) x 2 locations (y, x), cached -> do not modify in place
+    """
+    y_range = torch.arange(image_height, dtype=torch.float, device=device)
+    x_range = torch.arange(image_width, dtype=torch.float, device=device)
+    y_grid = y_range[:, None].expand(image_height, image_width)
+    x_grid = x_range[None, :].expand(image_height, image_width)
+    return torch.stack((y_grid, x_grid), -1).reshape(image_height * image_width, 2)
 
 
-def create_dense_flows(flattened_flows, batch_size, image_height, image_width):
-    # possibly .view
-    return torch.reshape(flattened_flows, [batch_size, image_height, image_width, 2])
+@lru_cache(maxsize=16)
+def get_boundary_locations(image_height, image_width, num_points_per_edge, device="cpu"):
+    """
+    like tensorflow_addons _get_boundary_locations
+    :return: 1 x n x 2
+    """
+    y_range = np.linspace(0, image_height - 1, num_points_per_edge + 2)
+    x_range = np.linspace(0, image_width - 1, num_points_per_edge + 2)
+    ys, xs = np.meshgrid(y_range, x_range, indexing="ij")
+    is_boundary = np.logical_or(
+        np.logical_or(xs == 0, xs == image_width - 1),
+        np.logical_or(ys == 0, ys == image_height - 1),
+    )
+    locations = np.stack([ys[is_boundary], xs[is_boundary]], axis=-1)
+    return torch.tensor(locations, dtype=torch.float, device=device).unsqueeze(0)
 
 
 def interpolate_spline(
@@ -156,53 +185,73 @@ def interpolate_spline(
     return query_values
 
 
-def solve_interpolation(train_points, train_values, order, regularization_weight):
-    b, n, d = train_points.shape
-    k = train_values.shape[-1]
+def interpolate_spline_on_grid(
+    train_points, train_values, height, width, order, regularization_weight=0.0
+):
+    """
+    same as interpolate_spline with all pixel-locations as query-points, squared distances
+    are separable on a grid: (y-c_y)^2 + (x-c_x)^2 -> no (H*W) x n matmul
+    :return: B x H x W x k
+    """
+    w, v = solve_interpolation(train_points, train_values, order, regularization_weight)
+    device = train_points.device
+    ys = torch.arange(height, dtype=torch.float, device=device)
+    xs = torch.arange(width, dtype=torch.float, device=device)
+    dist_y = (ys[None, :, None] - train_points[:, None, :, 0]) ** 2  # [b, H, n]
+    dist_x = (xs[None, :, None] - train_points[:, None, :, 1]) ** 2  # [b, W, n]
+    pairwise_dists = dist_y[:, :, None, :] + dist_x[:, None, :, :]  # [b, H, W, n]
+    rbf_term = torch.matmul(phi(pairwise_dists, order), w.unsqueeze(1))  # [b, H, W, k]
 
-    # First, rename variables so that the notation (c, f, w, v, A, B, etc.)
-    # follows https://en.wikipedia.org/wiki/Polyharmonic_spline.
-    # To account for python style guidelines we use
-    # matrix_a for A and matrix_b for B.
+    linear_y = ys[None, :, None] * v[:, None, 0, :]  # [b, H, k]
+    linear_x = xs[None, :, None] * v[:, None, 1, :] + v[:, None, 2, :]  # [b, W, k]
+    return rbf_term + linear_y[:, :, None, :] + linear_x[:, None, :, :]
 
-    c = train_points
-    f = train_values.float()
 
-    matrix_a = phi(cross_squared_distance_matrix(c, c), order).unsqueeze(0)  # [b, n, n]
-    #     if regularization_weight > 0:
-    #         batch_identity_matrix = array_ops.expand_dims(
-    #           linalg_ops.eye(n, dtype=c.dtype), 0)
-    #         matrix_a += regularization_weight * batch_identity_matrix
+def _solve(lhs, rhs):
+    if hasattr(torch, "linalg") and hasattr(torch.linalg, "solve"):
+        return torch.linalg.solve(lhs, rhs)
+    return torch.solve(rhs, lhs)[0]  # torch < 1.8
 
-    # Append ones to the feature values for the bias term in the linear model.
-    ones = torch.ones(1, dtype=train_points.dtype).view([-1, 1, 1])
-    matrix_b = torch.cat((c, ones), 2).float()  # [b, n, d + 1]
 
-    # [b, n + d + 1, n]
-    left_block = torch.cat((matrix_a, torch.transpose(matrix_b, 2, 1)), 1)
+def solve_interpolation(train_points, train_values, order, regularization_weight):
+    """
+    see https://en.wikipedia.org/wiki/Polyharmonic_spline for notation (c, f, w, v, A, B)
+    the (small) system is solved in float64
+    """
+    b, n, d = train_points.shape
+    k = train_values.shape[-1]
+
+    c = train_points.double()
+    f = train_values.double()
 
-    num_b_cols = matrix_b.shape[2]  # d + 1
+    matrix_a = phi(cross_squared_distance_matrix(c, c), order)  # [b, n, n]
+    if regularization_weight > 0:
+        matrix_a = matrix_a + regularization_weight * torch.eye(
+            n, dtype=c.dtype, device=c.device
+        )
 
-    # In Tensorflow, zeros are used here. Pytorch gesv fails with zeros for some reason we don't understand.
-    # So instead we use very tiny randn values (variance of one, zero mean) on one side of our multiplication.
-    lhs_zeros = torch.randn((b, num_b_cols, num_b_cols)) / 1e10
-    right_block = torch.cat((matrix_b, lhs_zeros), 1)  # [b, n + d + 1, d + 1]
+    # Append ones to the feature values for the bias term in the linear model.
+    ones = torch.ones(b, n, 1, dtype=c.dtype, device=c.device)
+    matrix_b = torch.cat((c, ones), 2)  # [b, n, d + 1]
+
+    left_block = torch.cat((matrix_a, matrix_b.transpose(2, 1)), 1)  # [b, n+d+1, n]
+    # tiny diagonal instead of zeros keeps the system solvable for degenerate point-sets
+    # (e.g. a single control point)
+    lower_right = EPSILON * torch.eye(d + 1, dtype=c.dtype, device=c.device)
+    right_block = torch.cat((matrix_b, lower_right.expand(b, -1, -1)), 1)
     lhs = torch.cat((left_block, right_block), 2)  # [b, n + d + 1, n + d + 1]
 
-    rhs_zeros = torch.zeros((b, d + 1, k), dtype=train_points.dtype).float()
+    rhs_zeros = torch.zeros((b, d + 1, k), dtype=c.dtype, device=c.device)
     rhs = torch.cat((f, rhs_zeros), 1)  # [b, n + d + 1, k]
 
-    # Then, solve the linear system and unpack the results.
-    X, LU = torch.solve(rhs, lhs)
-    w = X[:, :n, :]
-    v = X[:, n:, :]
-
+    X = _solve(lhs, rhs)
+    w = X[:, :n, :].float()
+    v = X[:, n:, :].float()
     return w, v
 
 
 def cross_squared_distance_matrix(x, y):
     """Pairwise squared distance between two (batch) matrices' rows (2nd dim).
-        Computes the pairwise distances between rows of x and rows of y
         Args:
         x: [batch_size, n, d] float `Tensor`
         y: [batch_size, m, d] float `Tensor`
@@ -210,15 +259,11 @@ def cross_squared_distance_matrix(x, y):
         squared_dists: [batch_size, n, m] float `Tensor`, where
         squared_dists[b,i,j] = ||x[b,i,:] - y[b,j,:]||^2
     """
-    x_norm_squared = torch.sum(torch.mul(x, x))
-    y_norm_squared = torch.sum(torch.mul(y, y))
-
-    x_y_transpose = torch.matmul(x.squeeze(0), y.squeeze(0).transpose(0, 1))
-
-    # squared_dists[b,i,j] = ||x_bi - y_bj||^2 = x_bi'x_bi- 2x_bi'x_bj + x_bj'x_bj
+    x_norm_squared = torch.sum(x * x, dim=2, keepdim=True)  # [b, n, 1]
+    y_norm_squared = torch.sum(y * y, dim=2).unsqueeze(1)  # [b, 1, m]
+    x_y_transpose = torch.matmul(x, y.transpose(1, 2))
     squared_dists = x_norm_squared - 2 * x_y_transpose + y_norm_squared
-
-    return squared_dists.float()
+    return squared_dists.clamp(min=0)
 
 
 def phi(r, order):
@@ -230,193 +275,174 @@ def phi(r, order):
     Returns:
     phi_k evaluated coordinate-wise on r, for k = r
     """
-    EPSILON = torch.tensor(1e-10)
     # using EPSILON prevents log(0), sqrt0), etc.
     # sqrt(0) is well-defined, but its gradient is not
     if order == 1:
-        r = torch.max(r, EPSILON)
-        r = torch.sqrt(r)
-        return r
+        return torch.sqrt(r.clamp(min=EPSILON))
     elif order == 2:
-        return 0.5 * r * torch.log(torch.max(r, EPSILON))
+        return torch.log(r.clamp(min=EPSILON)).mul_(r).mul_(0.5)  # fewer temporaries
     elif order == 4:
-        return 0.5 * torch.square(r) * torch.log(torch.max(r, EPSILON))
+        return torch.log(r.clamp(min=EPSILON)).mul_(r).mul_(r).mul_(0.5)
     elif order % 2 == 0:
-        r = torch.max(r, EPSILON)
+        r = r.clamp(min=EPSILON)
         return 0.5 * torch.pow(r, 0.5 * order) * torch.log(r)
     else:
-        r = torch.max(r, EPSILON)
-        return torch.pow(r, 0.5 * order)
+        return torch.pow(r.clamp(min=EPSILON), 0.5 * order)
 
 
 def apply_interpolation(query_points, train_points, w, v, order):
     """Apply polyharmonic interpolation model to data.
-    Given coefficients w and v for the interpolation model, we evaluate
-    interpolated function values at query_points.
     Args:
     query_points: `[b, m, d]` x values to evaluate the interpolation at
     train_points: `[b, n, d]` x values that act as the interpolation centers
-                    ( the c variables in the wikipedia article)
     w: `[b, n, k]` weights on each interpolation center
-    v: `[b, d, k]` weights on each input dimension
+    v: `[b, d + 1, k]` weights on each input dimension and bias
     order: order of the interpolation
     Returns:
     Polyharmonic interpolation evaluated at points defined in query_points.
     """
-    query_points = query_points.unsqueeze(0)
-    # First, compute the contribution from the rbf term.
-    pairwise_dists = cross_squared_distance_matrix(
-        query_points.float(), train_points.float()
-    )
-    phi_pairwise_dists = phi(pairwise_dists, order)
-
-    rbf_term = torch.matmul(phi_pairwise_dists, w)
+    pairwise_dists = cross_squared_distance_matrix(query_points, train_points)
+    rbf_term = torch.matmul(phi(pairwise_dists, order), w)
+    # linear term, v[:, -1] is the bias
+    linear_term = torch.matmul(query_points, v[:, :-1, :]) + v[:, -1:, :]
+    return rbf_term + linear_term
 
-    # Then, compute the contribution from the linear term.
-    # Pad query_points with ones, for the bias term in the linear model.
-    ones = torch.ones_like(query_points[..., :1])
-    query_points_pad = torch.cat((query_points, ones), 2).float()
-    linear_term = torch.matmul(query_points_pad, v)
 
-    return rbf_term + linear_term
+def horizontal_image_warp(image, flows_x):
+    """
+    output[b, j, i] = image[b, j, i - flows_x[b, j, i]] linearly interpolated along i,
+    beyond the borders the nearest pixel is used
+    """
+    batch_size, height, width = image.shape
+    x = get_flattened_grid_locations(height, width, str(image.device))[:, 1]
+    queries = x.view(1, height, width) - flows_x
+    floor = torch.floor(queries).clamp(0, width - 2)
+    alpha = (queries - floor).clamp(0.0, 1.0).to(image.dtype)
+    int_floor = floor.long()
+    left = image.gather(2, int_floor)
+    right = image.gather(2, int_floor + 1)
+    return left + alpha * (right - left)
 
 
 def dense_image_warp(image, flow):
     """Image warping using per-pixel flow vectors.
-    Apply a non-linear warp to the image, where the warp is specified by a dense
-    flow field of offset vectors that define the correspondences of pixel values
-    in the output image back to locations in the  source image. Specifically, the
-    pixel value at output[b, j, i, c] is
-    images[b, j - flow[b, j, i, 0], i - flow[b, j, i, 1], c].
-    The locations specified by this formula do not necessarily map to an int
-    index. Therefore, the pixel value is obtained by bilinear
-    interpolation of the 4 nearest pixels around
-    (b, j - flow[b, j, i, 0], i - flow[b, j, i, 1]). For locations outside
-    of the image, we use the nearest pixel values at the image boundary.
+    the pixel value at output[b, j, i] is image[b, j - flow[b, j, i, 0], i - flow[b, j, i, 1]]
+    bilinearly interpolated, for locations outside of the image the nearest pixel values
+    at the image boundary are used
     Args:
-    image: 4-D float `Tensor` with shape `[batch, height, width, channels]`.
-    flow: A 4-D float `Tensor` with shape `[batch, height, width, 2]`.
-    name: A name for the operation (optional).
-    Note that image and flow can be of type tf.half, tf.float32, or tf.float64,
-    and do not necessarily have to be the same type.
+    image: [batch, height, width]
+    flow: [batch, height, width, 2]
     Returns:
-    A 4-D float `Tensor` with shape`[batch, height, width, channels]`
-    and same type as input image.
-    Raises:
-    ValueError: if height < 2 or width < 2 or the inputs have the wrong number
-    of dimensions.
+    [batch, height, width]
     """
-    image = image.unsqueeze(3)  # add a single channel dimension to image tensor
-    batch_size, height, width, channels = image.shape
-
-    # The flow is defined on the image grid. Turn the flow into a list of query
-    # points in the grid space.
-    grid_x, grid_y = torch.meshgrid(torch.arange(width), torch.arange(height))
-
-    stacked_grid = torch.stack((grid_y, grid_x), dim=2).float()
-
-    batched_grid = stacked_grid.unsqueeze(-1).permute(3, 1, 0, 2)
-
-    query_points_on_grid = batched_grid - flow
-    query_points_flattened = torch.reshape(
-        query_points_on_grid, [batch_size, height * width, 2]
-    )
-    # Compute values at the query points, then reshape the result back to the
-    # image grid.
-    interpolated = interpolate_bilinear(image, query_points_flattened)
-    interpolated = torch.reshape(interpolated, [batch_size, height, width, channels])
-    return interpolated
+    batch_size, height, width = image.shape
+    grid = get_flattened_grid_locations(height, width, str(image.device))
+    query_points = grid.unsqueeze(0) - flow.reshape(batch_size, height * width, 2)
+    interpolated = interpolate_bilinear(image, query_points)
+    return interpolated.view(batch_size, height, width)
 
 
-def interpolate_bilinear(
-    grid, query_points, name="interpolate_bilinear", indexing="ij"
-):
+def interpolate_bilinear(grid, query_points):
     """Similar to Matlab's interp2 function.
-    Finds values for query points on a grid using bilinear interpolation.
     Args:
-    grid: a 4-D float `Tensor` of shape `[batch, height, width, channels]`.
-    query_points: a 3-D float `Tensor` of N points with shape `[batch, N, 2]`.
-    name: a name for the operation (optional).
-    indexing: whether the query points are specified as row and column (ij),
-      or Cartesian coordinates (xy).
+    grid: [batch, height, width]
+    query_points: [batch, N, 2] (row, column)
     Returns:
-    values: a 3-D `Tensor` with shape `[batch, N, channels]`
-    Raises:
-    ValueError: if the indexing mode is invalid, or if the shape of the inputs
-      invalid.
+    values: [batch, N]
     """
-    if indexing != "ij" and indexing != "xy":
-        raise ValueError("Indexing mode must be 'ij' or 'xy'")
-
-    shape = grid.shape
-    if len(shape) != 4:
-        msg = "Grid must be 4 dimensional. Received size: "
-        raise ValueError(msg + str(grid.shape))
-
-    batch_size, height, width, channels = grid.shape
-
-    shape = [batch_size, height, width, channels]
-    query_type = query_points.dtype
-    grid_type = grid.dtype
-
-    num_queries = query_points.shape[1]
-
-    alphas = []
-    floors = []
-    ceils = []
-    index_order = [0, 1] if indexing == "ij" else [1, 0]
-    unstacked_query_points = query_points.unbind(2)
-
-    for dim in index_order:
-        queries = unstacked_query_points[dim]
-
-        size_in_indexing_dimension = shape[dim + 1]
-
-        # max_floor is size_in_indexing_dimension - 2 so that max_floor + 1
-        # is still a valid index into the grid.
-        max_floor = torch.tensor(size_in_indexing_dimension - 2, dtype=query_type)
-        min_floor = torch.tensor(0.0, dtype=query_type)
-        maxx = torch.max(min_floor, torch.floor(queries))
-        floor = torch.min(maxx, max_floor)
-        int_floor = floor.long()
-        floors.append(int_floor)
-        ceil = int_floor + 1
-        ceils.append(ceil)
-
-        # alpha has the same type as the grid, as we will directly use alpha
-        # when taking linear combinations of pixel values from the image.
-        alpha = torch.tensor(queries - floor, dtype=grid_type)
-        min_alpha = torch.tensor(0.0, dtype=grid_type)
-        max_alpha = torch.tensor(1.0, dtype=grid_type)
-        alpha = torch.min(torch.max(min_alpha, alpha), max_alpha)
-
-        # Expand alpha to [b, n, 1] so we can use broadcasting
-        # (since the alpha values don't depend on the channel).
-        alpha = torch.unsqueeze(alpha, 2)
-        alphas.append(alpha)
-
-    flattened_grid = torch.reshape(grid, [batch_size * height * width, channels])
-    batch_offsets = torch.reshape(
-        torch.arange(batch_size) * height * width, [batch_size, 1]
-    )
+    batch_size, height, width = grid.shape
 
-    # This wraps array_ops.gather. We reshape the image data such that the
-    # batch, y, and x coordinates are pulled into the first dimension.
-    # Then we gather. Finally, we reshape the output back. It's possible this
-    # code would be made simpler by using array_ops.gather_nd.
-    def gather(y_coords, x_coords, name):
-        linear_coordinates = batch_offsets + y_coords * width + x_coords
-        gathered_values = torch.gather(flattened_grid.t(), 1, linear_coordinates)
-        return torch.reshape(gathered_values, [batch_size, num_queries, channels])
+    alphas, floors = [], []
+    for dim, size in enumerate([height, width]):
+        queries = query_points[:, :, dim]
+        # max_floor is size - 2 so that max_floor + 1 is still a valid index into the grid.
+        floor = torch.floor(queries).clamp(0, size - 2)
+        floors.append(floor.long())
+        alphas.append((queries - floor).clamp(0.0, 1.0).to(grid.dtype))
+
+    flattened_grid = grid.reshape(batch_size, height * width)
+
+    def gather(y_coords, x_coords):
+        return flattened_grid.gather(1, y_coords * width + x_coords)
 
     # grab the pixel values in the 4 corners around each query point
-    top_left = gather(floors[0], floors[1], "top_left")
-    top_right = gather(floors[0], ceils[1], "top_right")
-    bottom_left = gather(ceils[0], floors[1], "bottom_left")
-    bottom_right = gather(ceils[0], ceils[1], "bottom_right")
+    top_left = gather(floors[0], floors[1])
+    top_right = gather(floors[0], floors[1] + 1)
+    bottom_left = gather(floors[0] + 1, floors[1])
+    bottom_right = gather(floors[0] + 1, floors[1] + 1)
 
     interp_top = alphas[1] * (top_right - top_left) + top_left
     interp_bottom = alphas[1] * (bottom_right - bottom_left) + bottom_left
-    interp = alphas[0] * (interp_bottom - interp_top) + interp_top
+    return alphas[0] * (interp_bottom - interp_top) + interp_top
+
+
+def _random_time_warp_points(batch_size, height, width, W=5):
+    y = height // 2
+    points = torch.randint(W, width - W, (batch_size, 1, 1)).float()
+    dists = torch.randint(-W, W, (batch_size, 1, 1)).float()
+    src = torch.cat([torch.full_like(points, y), points], 2)
+    dest = torch.cat([torch.full_like(points, y), points + dists], 2)
+    return src, dest
 
-    return interp
+
+def test_sparse_image_warp():
+    torch.manual_seed(0)
+    image = torch.rand(3, 40, 120)
+    src, dest = _random_time_warp_points(3, 40, 120)
+
+    fast, fast_flows = sparse_image_warp(image, src, dest, num_boundary_points=2)
+    # tiny vertical move disables the fast path, nearly same result
+    dest_general = dest.clone()
+    dest_general[:, :, 0] += 1e-4
+    general, general_flows = sparse_image_warp(
+        image, src, dest_general, num_boundary_points=2
+    )
+    assert torch.allclose(fast, general, atol=1e-3)
+    assert torch.allclose(fast_flows, general_flows, atol=1e-3)
+
+    # spline interpolates the flows at the control points, boundary is not moved
+    for b in range(3):
+        y, x = dest[b, 0].long()
+        assert torch.allclose(fast_flows[b, y, x], dest[b, 0] - src[b, 0], atol=1e-3)
+    assert torch.allclose(fast_flows[:, 0, 0], torch.zeros(3, 2), atol=1e-3)
+
+    # batched control points == one image at a time
+    for b in range(3):
+        single, _ = sparse_image_warp(
+            image[b : b + 1], src[b : b + 1], dest[b : b + 1], num_boundary_points=2
+        )
+        assert torch.allclose(single[0], fast[b], atol=1e-5)
+
+
+def test_time_warp():
+    random.seed(0)
+    spec = torch.rand(40, 120)
+    warped = time_warp(spec)
+    assert warped.shape == spec.shape
+    # corners are pinned
+    for y in [0, 39]:
+        for x in [0, 119]:
+            assert torch.allclose(warped[y, x], spec[y, x], atol=1e-3)
+
+
+def benchmark_sparse_image_warp(height=161, width=2000, num_runs=5):
+    from time import time
+
+    for batch_size in [1, 8]:
+        image = torch.rand(batch_size, height, width)
+        src, dest = _random_time_warp_points(batch_size, height, width)
+        dest_general = dest.clone()
+        dest_general[:, :, 0] += 1.0
+        for name, d in [("horizontal", dest), ("general", dest_general)]:
+            sparse_image_warp(image, src, d, num_boundary_points=2)  # warm-up
+            start = time()
+            for _ in range(num_runs):
+                sparse_image_warp(image, src, d, num_boundary_points=2)
+            duration = (time() - start) / num_runs
+            print(
+                f"{height}x{width} batch_size {batch_size} {name}: {duration * 1000:.1f} ms"
+            )
+
+
+if __name__ == "__main__":
+    benchmark_sparse_image_warp()
@@ -37,29 +37,9 @@ SS : Switchboard strong
 import numpy as np
 import random
 
-# from tensorflow_addons.image import sparse_image_warp
-
 import torch
 
-
-def time_warp(spec, W=5):
-    num_rows = spec.shape[1]
-    spec_len = spec.shape[2]
-
-    y = num_rows // 2
-    # horizontal_line_at_ctr = spec[0][y] # TODO(tilo): what for?
-    # assert len(horizontal_line_at_ctr) == spec_len
-
-    point_to_warp = random.randrange(W, spec_len - W)
-    # assert isinstance(point_to_warp, torch.Tensor)
-
-    # Uniform distribution from (0,W) with chance to be up to W negative
-    dist_to_warp = random.randrange(-W, W)
-    src_pts = np.array([[[y, point_to_warp]]],dtype=np.float)
-    dest_pts = np.array([[[y, point_to_warp + dist_to_warp]]],dtype=np.float)
-    warped_spectro, dense_flows = sparse_image_warp(spec.numpy(), src_pts, dest_pts,num_boundary_points=1)
-    warped_spectro = torch.from_numpy(warped_spectro.numpy())
-    return warped_spectro.squeeze(3)
+from data_related.data_augmentation.sparse_image_warp import time_warp
 
 
 def spec_augment(
@@ -89,13 +69,12 @@ def spec_augment(
     # Returns
       mel_spectrogram(numpy array): warped and masked mel spectrogram.
     """
-    mel_spectrogram = mel_spectrogram.unsqueeze(0).unsqueeze(-1)
-
-    v = mel_spectrogram.shape[1]
-    tau = mel_spectrogram.shape[2]
+    v = mel_spectrogram.shape[0]
+    tau = mel_spectrogram.shape[1]
 
     # Step 1 : Time warping
     warped_mel_spectrogram = time_warp(mel_spectrogram, W=time_warping_para)
+    warped_mel_spectrogram = warped_mel_spectrogram.unsqueeze(0)
     # warped_mel_spectrogram = mel_spectrogram
 
     # Step 2 : Frequency masking
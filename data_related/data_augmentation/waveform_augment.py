@@ -0,0 +1,237 @@
+import os
+from typing import Dict, Optional
+
+import numpy as np
+import scipy.signal
+import torch
+
+from data_related.audio_io import INT16_SCALE
+from data_related.data_augmentation.signal_augment import (
+    sample_augmentation_params,
+    MAX_FREQ,
+)
+
+"""
+in-memory version of augment_with_sox: same effects, same parameter-distributions
+(sample_augmentation_params), but on numpy-waveforms -> no bash, no sox-processes,
+no temp-files
+    tempo+pitch: one WSOLA time-stretch followed by linear-interpolation resampling
+    reverb: convolution with exponentially decaying noise
+    gain -n: peak-normalization to dB
+    lowpass/highpass: 2-pole butterworth (like sox)
+"""
+
+SAMPLE_RATE = 16_000
+WSOLA_FRAME = 512  # 32ms
+WSOLA_TOLERANCE = 128
+ENVELOPE_RATE = 100  # sample-rate of slowly varying amplitude-envelopes
+
+_rng: Optional[np.random.Generator] = None
+_rng_key = None
+
+
+def get_rng() -> np.random.Generator:
+    """
+    lazily seeded per process/DataLoader-worker: forked workers would otherwise all
+    produce the same "random" augmentations; worker_info.seed derives from torch's seed
+    -> reproducible with torch.manual_seed
+    """
+    global _rng, _rng_key
+    worker_info = torch.utils.data.get_worker_info()
+    seed = worker_info.seed if worker_info is not None else torch.initial_seed()
+    key = (os.getpid(), seed)
+    if _rng is None or _rng_key != key:
+        _rng = np.random.default_rng(seed % (1 << 32))
+        _rng_key = key
+    return _rng
+
+
+def wsola(y: np.ndarray, rate: float, frame_len=WSOLA_FRAME, tolerance=WSOLA_TOLERANCE):
+    """
+    waveform-similarity overlap-add: changes duration by 1/rate, keeps the pitch
+    """
+    if rate == 1.0 or len(y) < frame_len:
+        return y
+    hop = frame_len // 2
+    window = scipy.signal.windows.hann(frame_len, sym=False)  # sums to 1 at 50% overlap
+    num_out = int(len(y) / rate)
+    num_frames = num_out // hop + 1
+    padded = np.pad(y, (tolerance, frame_len + tolerance + hop + int(rate * hop)))
+
+    fft_len = 1 << int(np.ceil(np.log2(frame_len + 2 * tolerance)))
+    out = np.zeros(num_frames * hop + frame_len, dtype=np.float32)
+    pos = tolerance
+    for k in range(num_frames):
+        ideal = int(k * hop * rate) + tolerance
+        if k > 0:
+            natural = padded[pos + hop : pos + hop + frame_len]
+            region = padded[ideal - tolerance : ideal + tolerance + frame_len]
+            # cross-correlation via fft, no wrap-around cause fft_len >= len(region)
+            corr = np.fft.irfft(
+                np.fft.rfft(region, fft_len) * np.conj(np.fft.rfft(natural, fft_len)),
+                fft_len,
+            )
+            pos = ideal - tolerance + int(np.argmax(corr[: 2 * tolerance + 1]))
+        else:
+            pos = ideal
+        out[k * hop : k * hop + frame_len] += window * padded[pos : pos + frame_len]
+    return out[:num_out]
+
+
+def resample_linear(y: np.ndarray, num_out: int) -> np.ndarray:
+    x_out = np.linspace(0, len(y) - 1, num_out)
+    return np.interp(x_out, np.arange(len(y)), y).astype(np.float32)
+
+
+def change_tempo_and_pitch(y: np.ndarray, tempo: float, cents: int) -> np.ndarray:
+    pitch_factor = 2 ** (cents / 1200)
+    stretched = wsola(y, tempo / pitch_factor)
+    return resample_linear(stretched, int(len(y) / tempo))
+
+
+def reverb(y: np.ndarray, reverberance: float, rng: np.random.Generator, sr=SAMPLE_RATE):
+    """
+    :param reverberance: 0-100 like sox
+    """
+    if reverberance <= 0:
+        return y
+    rt60 = 0.05 + reverberance / 100  # seconds
+    t = np.arange(int(rt60 * sr)) / sr
+    impulse_response = rng.standard_normal(len(t)) * np.exp(-6.9 * t / rt60)
+    impulse_response *= 0.5 * reverberance / 100 / np.sqrt(np.sum(impulse_response ** 2))
+    impulse_response[0] = 1.0  # dry signal
+    return scipy.signal.fftconvolve(y, impulse_response)[: len(y)].astype(np.float32)
+
+
+def normalize_gain(y: np.ndarray, db: float) -> np.ndarray:
+    peak = np.max(np.abs(y)) if len(y) > 0 else 0.0
+    if peak == 0:
+        return y
+    return (y * (10 ** (db / 20) / peak)).astype(np.float32)
+
+
+def filter_pass(y: np.ndarray, cutoff: float, btype: str, sr=SAMPLE_RATE) -> np.ndarray:
+    cutoff = min(max(cutoff, 1.0), MAX_FREQ)
+    sos = scipy.signal.butter(2, cutoff, btype=btype, fs=sr, output="sos")
+    return scipy.signal.sosfilt(sos, y).astype(np.float32)
+
+
+def lowpassed_noise_envelope(
+    num_samples: int, cutoff: float, rng: np.random.Generator, sr=SAMPLE_RATE
+) -> np.ndarray:
+    """
+    very low cutoffs (0.1-2 Hz) -> noise is filtered at ENVELOPE_RATE and then interpolated
+    """
+    num_low = num_samples * ENVELOPE_RATE // sr + 2
+    sos = scipy.signal.butter(
+        2, min(cutoff, ENVELOPE_RATE / 2 - 1), fs=ENVELOPE_RATE, output="sos"
+    )
+    warmup = 4 * int(ENVELOPE_RATE / cutoff)  # skip filter transient
+    envelope = scipy.signal.sosfilt(sos, rng.standard_normal(num_low + warmup))[warmup:]
+    return resample_linear(envelope, num_samples)
+
+
+def apply_distortions(y: np.ndarray, params: Dict, rng: np.random.Generator):
+    y = change_tempo_and_pitch(y, params.get("tempo", 1.0), params.get("pitch", 0))
+    if "reverb" in params:
+        y = reverb(y, params["reverb"][0], rng)
+    if "lowpass" in params:
+        y = filter_pass(y, params["lowpass"], "lowpass")
+    if "highpass" in params:
+        y = filter_pass(y, params["highpass"], "highpass")
+    return normalize_gain(y, params["gain -n"])
+
+
+def modulated_noise(
+    num_samples: int,
+    rng: np.random.Generator,
+    amod_lowpass_cutoff=0.1,
+    lowpass_cutoff=MAX_FREQ,
+    highpass_cutoff=1,
+    noise_gain=-4,
+):
+    """
+    like build_sox_noise: white noise amplitude-modulated by low-passed white noise
+    """
+    envelope = lowpassed_noise_envelope(num_samples, amod_lowpass_cutoff, rng)
+    noise = rng.standard_normal(num_samples).astype(np.float32) * envelope
+    noise = filter_pass(noise, lowpass_cutoff, "lowpass")
+    noise = filter_pass(noise, highpass_cutoff, "highpass")
+    return normalize_gain(noise, noise_gain)
+
+
+def amplitude_factor(num_samples: int, rng, lowpass_cutoff=1, ac_gain=-9):
+    """
+    like build_varying_amplitude_factor: 0.5 + low-frequency fluctuation
+    """
+    ac = normalize_gain(lowpassed_noise_envelope(num_samples, lowpass_cutoff, rng), ac_gain)
+    return ac + 0.5
+
+
+def fit_to_length(y: np.ndarray, num_samples: int) -> np.ndarray:
+    if len(y) >= num_samples:
+        return y[:num_samples]
+    return np.pad(y, (0, num_samples - len(y)))
+
+
+def augment_waveform(
+    y: np.ndarray,
+    interfere: np.ndarray,
+    rng: Optional[np.random.Generator] = None,
+    params: Optional[Dict[str, Dict]] = None,
+) -> np.ndarray:
+    """
+    effects work on [-1, 1] (gains are relative to full scale like in sox)
+    :param y: waveform as returned by load_audio (int16-range)
+    :param interfere: waveform of some other utterance
+    :return: augmented waveform in int16-range, same length as y (like "trim 0 $(soxi -D original)")
+    """
+    rng = rng if rng is not None else get_rng()
+    params = params if params is not None else sample_augmentation_params(rng)
+    num_samples = len(y)
+    y, interfere = y / INT16_SCALE, interfere / INT16_SCALE
+
+    signal = fit_to_length(apply_distortions(y, params["signal"], rng), num_samples)
+    noise = modulated_noise(num_samples, rng, **params["noise"])
+    interfere = fit_to_length(
+        apply_distortions(interfere, params["interfere"], rng), num_samples
+    )
+    interference = interfere * amplitude_factor(
+        num_samples, rng, **params["interference"]
+    )
+    augmented = np.clip(signal + noise + interference, -1.0, 1.0) * INT16_SCALE
+    return augmented.astype(np.float32)
+
+
+def test_augment_waveform():
+    rng = np.random.default_rng(0)
+    t = np.arange(3 * SAMPLE_RATE) / SAMPLE_RATE
+    y = (0.5 * INT16_SCALE * np.sin(2 * np.pi * 220 * t)).astype(np.float32)
+    interfere = rng.standard_normal(SAMPLE_RATE).astype(np.float32) * 0.1 * INT16_SCALE
+
+    for _ in range(5):
+        augmented = augment_waveform(y, interfere, rng)
+        assert augmented.shape == y.shape and augmented.dtype == np.float32
+        assert np.all(np.isfinite(augmented)) and np.max(np.abs(augmented)) <= INT16_SCALE
+        assert np.max(np.abs(augmented)) > 0.1 * INT16_SCALE  # not scaled down to [-1, 1]
+
+    stretched = change_tempo_and_pitch(y, tempo=1.25, cents=0)
+    assert len(stretched) == int(len(y) / 1.25)
+    spectrum = np.abs(np.fft.rfft(stretched))
+    peak_freq = np.argmax(spectrum) * SAMPLE_RATE / len(stretched)
+    assert abs(peak_freq - 220) < 5  # tempo does not change pitch
+
+    shifted = change_tempo_and_pitch(y, tempo=1.0, cents=1200)
+    spectrum = np.abs(np.fft.rfft(shifted))
+    assert abs(np.argmax(spectrum) * SAMPLE_RATE / len(shifted) - 440) < 10
+
+
+if __name__ == "__main__":
+    from time import time
+
+    y = np.random.randn(10 * SAMPLE_RATE).astype(np.float32) * 0.1 * INT16_SCALE
+    start = time()
+    num_runs = 20
+    for _ in range(num_runs):
+        augment_waveform(y, y[: 7 * SAMPLE_RATE])
+    print(f"{(time() - start) / num_runs * 1000:.0f} ms per 10 seconds of audio")
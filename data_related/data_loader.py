@@ -1,6 +1,10 @@
+import warnings
+from itertools import chain
+from typing import List, Optional
+
 from torch.distributed import get_rank
 from torch.distributed import get_world_size
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, get_worker_info
 from torch.utils.data.sampler import Sampler
 
 import numpy as np
@@ -8,6 +12,14 @@ import torch
 import math
 from tqdm import tqdm
 
+from data_related.audio_feature_extraction import (
+    AudioFeaturesConfig,
+    BatchStftExtractor,
+    WINDOW_STRIDE,
+)
+from data_related.data_augmentation.batch_spec_augment import batch_spec_augment
+from data_related.manifest_index import ManifestIndex
+
 
 
 # def load_audio(path):
@@ -50,13 +62,125 @@ def _collate_fn(batch):
     return inputs, targets, input_len_proportion, target_sizes
 
 
+class BatchFeaturizingCollate:
+    """
+    collate for CharSTTDataset(featurize_in_collate=True), featurizes all raw signals of
+    a batch at once, output is same as _collate_fn
+    """
+
+    def __init__(self, audio_conf: AudioFeaturesConfig):
+        self.audio_conf = audio_conf
+        self.extractor = BatchStftExtractor(audio_conf)
+
+    def __call__(self, batch):
+        batch = sorted(batch, key=lambda sample: len(sample[0]), reverse=True)
+        signals, transcripts = zip(*batch)
+        spects, lengths = self.extractor(signals)
+        if self.audio_conf.spec_augment:
+            spects = batch_spec_augment(spects, lengths)
+
+        inputs = spects.unsqueeze(1)
+        input_len_proportion = lengths.float() / float(spects.size(2))
+        target_sizes = torch.IntTensor([len(t) for t in transcripts])
+        targets = torch.IntTensor([i for t in transcripts for i in t])
+        return inputs, targets, input_len_proportion, target_sizes
+
+
+class BufferRingCollate:
+    """
+    same output as _collate_fn, but inputs are views on a ring of preallocated buffers
+    -> no allocation per batch, padding is zeroed only where needed
+    in the main process (num_workers=0) buffers are pinned -> inputs.to(device, non_blocking=True)
+    in DataLoader-workers they are in shared memory -> handed to main process without copy
+    a buffer gets overwritten num_buffers batches later, so num_buffers must exceed the
+    number of batches in flight (prefetch_factor + the one being consumed + pin-thread)
+    """
+
+    def __init__(
+        self,
+        feature_dim: int,
+        max_frames_per_batch: int,
+        num_buffers: int = 4,
+        pin_memory: bool = torch.cuda.is_available(),
+    ):
+        """
+        :param max_frames_per_batch: max of batch_size * longest utterance (in feature-frames)
+        """
+        self.feature_dim = feature_dim
+        self.capacity = max_frames_per_batch * feature_dim
+        self.num_buffers = num_buffers
+        self.pin_memory = pin_memory
+        self._buffers: Optional[List[torch.Tensor]] = None
+        self._next = 0
+        self.num_growths = 0  # per process, > 0 -> max_frames_per_batch too small
+
+    def __getstate__(self):
+        # every worker allocates its own ring
+        state = self.__dict__.copy()
+        state["_buffers"] = None
+        return state
+
+    def _allocate(self, num_elements: int) -> torch.Tensor:
+        buffer = torch.empty(num_elements)
+        if get_worker_info() is not None:
+            return buffer.share_memory_()
+        return buffer.pin_memory() if self.pin_memory else buffer
+
+    def _next_buffer(self, num_elements: int) -> torch.Tensor:
+        if self._buffers is None:
+            self._buffers = [self._allocate(self.capacity) for _ in range(self.num_buffers)]
+        k = self._next
+        self._next = (self._next + 1) % self.num_buffers
+        if self._buffers[k].numel() < num_elements:
+            if self.num_growths == 0:
+                warnings.warn(
+                    f"batch of {num_elements} elements exceeds buffer-capacity, growing"
+                )
+            self.num_growths += 1
+            self._buffers[k] = self._allocate(num_elements)
+        return self._buffers[k][:num_elements]
+
+    def __call__(self, batch):
+        batch = sorted(batch, key=lambda sample: sample[0].size(1), reverse=True)
+        spects, transcripts = zip(*batch)
+        batch_size, max_seqlength = len(batch), spects[0].size(1)
+
+        inputs = self._next_buffer(
+            batch_size * self.feature_dim * max_seqlength
+        ).view(batch_size, 1, self.feature_dim, max_seqlength)
+        lengths = torch.IntTensor([s.size(1) for s in spects])
+        for x, spect in enumerate(spects):
+            seq_length = spect.size(1)
+            inputs[x, 0, :, :seq_length].copy_(spect)
+            inputs[x, 0, :, seq_length:].zero_()
+
+        input_len_proportion = lengths.float() / float(max_seqlength)
+        target_sizes = torch.IntTensor([len(t) for t in transcripts])
+        targets = torch.from_numpy(
+            np.fromiter(
+                chain.from_iterable(transcripts),
+                dtype=np.int32,
+                count=int(target_sizes.sum()),
+            )
+        )
+        return inputs, targets, input_len_proportion, target_sizes
+
+
+def max_frames_per_batch(batch_sampler, data_source) -> int:
+    """
+    feature-frames of the biggest batch the sampler yields (ASRSample.num_frames are audio-samples)
+    """
+    hop_length = int(WINDOW_STRIDE * data_source.audio_conf.sample_rate)
+    feature_frames = _num_frames(data_source) // hop_length + 1
+    return int(max(len(b) * feature_frames[b].max() for b in batch_sampler.bins))
+
+
 class AudioDataLoader(DataLoader):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, collate_fn=_collate_fn, **kwargs):
         """
         Creates a data loader for AudioDatasets.
         """
-        super(AudioDataLoader, self).__init__(*args, **kwargs)
-        self.collate_fn = _collate_fn
+        super(AudioDataLoader, self).__init__(*args, collate_fn=collate_fn, **kwargs)
 
 
 class BucketingSampler(Sampler):
@@ -123,6 +247,133 @@ class DistributedBucketingSampler(Sampler):
         self.bins = [self.bins[i] for i in bin_ids]
 
 
+def _num_frames(data_source) -> np.ndarray:
+    if isinstance(data_source.samples, ManifestIndex):
+        return data_source.samples.num_frames.astype(np.int64)
+    return np.array([s.num_frames for s in data_source.samples], dtype=np.int64)
+
+
+def pack_by_num_frames(num_frames: np.ndarray, max_frames: int, max_batch_size=None):
+    """
+    greedily packs length-sorted ids into batches whose padded size
+    (batch_size * longest utterance) stays below max_frames
+    """
+    ids = np.argsort(num_frames, kind="stable")
+    batches, batch, longest = [], [], 0
+    for i in ids:
+        longest_with_i = max(longest, num_frames[i])
+        too_big = longest_with_i * (len(batch) + 1) > max_frames
+        too_many = max_batch_size is not None and len(batch) >= max_batch_size
+        if len(batch) > 0 and (too_big or too_many):
+            batches.append(batch)
+            batch, longest_with_i = [], num_frames[i]
+        batch.append(int(i))
+        longest = longest_with_i
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+class FrameBudgetBatchSampler(Sampler):
+    def __init__(self, data_source, max_frames: int, max_batch_size=None):
+        """
+        batches with (nearly) constant number of padded audio-frames instead of constant
+        number of utterances, only uses ASRSample.num_frames, no audio is loaded
+        """
+        super(FrameBudgetBatchSampler, self).__init__(data_source)
+        self.data_source = data_source
+        self.num_frames = _num_frames(data_source)
+        assert self.num_frames.max() <= max_frames, "max_frames < longest utterance"
+        self.bins = pack_by_num_frames(self.num_frames, max_frames, max_batch_size)
+        self.epoch_bins = self.bins
+
+    def __iter__(self):
+        return iter(self.epoch_bins)
+
+    def __len__(self):
+        return len(self.bins)
+
+    def shuffle(self, epoch):
+        # deterministically shuffle based on epoch
+        rng = np.random.RandomState(epoch)
+        self.epoch_bins = [self.bins[i] for i in rng.permutation(len(self.bins))]
+
+
+class DistributedFrameBudgetBatchSampler(FrameBudgetBatchSampler):
+    def __init__(
+        self, data_source, max_frames: int, max_batch_size=None, num_replicas=None, rank=None
+    ):
+        """
+        every rank gets the same number of batches (DDP needs that) and roughly the same
+        number of padded frames: batches are sorted by cost, cut into chunks of num_replicas
+        and dealt out snake-wise (0,1,..,n-1,n-1,..,1,0,..)
+        """
+        super(DistributedFrameBudgetBatchSampler, self).__init__(
+            data_source, max_frames, max_batch_size
+        )
+        if num_replicas is None:
+            num_replicas = get_world_size()
+        if rank is None:
+            rank = get_rank()
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = int(math.ceil(len(self.bins) * 1.0 / self.num_replicas))
+        self.total_size = self.num_samples * self.num_replicas
+        self.shuffle(0)
+
+    def batch_cost(self, batch) -> int:
+        return len(batch) * int(self.num_frames[batch].max())
+
+    def assign_to_ranks(self):
+        # add extra batches to make it evenly divisible
+        bins = self.bins + self.bins[: (self.total_size - len(self.bins))]
+        bins = sorted(bins, key=self.batch_cost, reverse=True)
+        rank2bins = [[] for _ in range(self.num_replicas)]
+        for k in range(self.num_samples):
+            chunk = bins[k * self.num_replicas : (k + 1) * self.num_replicas]
+            if k % 2 == 1:
+                chunk = chunk[::-1]
+            for rank, batch in enumerate(chunk):
+                rank2bins[rank].append(batch)
+        return rank2bins
+
+    def __len__(self):
+        return self.num_samples
+
+    def shuffle(self, epoch):
+        # same permutation on every rank -> at each step all ranks get batches of same chunk
+        rank_bins = self.assign_to_ranks()[self.rank]
+        rng = np.random.RandomState(epoch)
+        self.epoch_bins = [rank_bins[i] for i in rng.permutation(self.num_samples)]
+
+
+def test_buffer_ring_collate():
+    batch = [(torch.rand(161, T), [1, 2, 3][: T % 3 + 1]) for T in [50, 120, 7, 99]]
+    collate = BufferRingCollate(161, max_frames_per_batch=4 * 120, num_buffers=2)
+    for _ in range(3):  # wraps around the ring
+        for expected, got in zip(_collate_fn(batch), collate(batch)):
+            assert torch.equal(expected, got)
+    assert collate.num_growths == 0
+    bigger = batch + batch
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        for _ in range(2):
+            assert torch.equal(_collate_fn(bigger)[0], collate(bigger)[0])  # grows buffer
+    assert collate.num_growths == 2 and len(caught) == 1
+
+
+def test_max_frames_per_batch():
+    from types import SimpleNamespace
+
+    for sample_rate in [8_000, 16_000]:
+        samples = [SimpleNamespace(num_frames=n * sample_rate) for n in [1, 2, 3]]
+        data_source = SimpleNamespace(
+            samples=samples, audio_conf=AudioFeaturesConfig(sample_rate=sample_rate)
+        )
+        batch_sampler = SimpleNamespace(bins=[[0, 1], [2]])
+        assert max_frames_per_batch(batch_sampler, data_source) == 2 * 201
+
+
 if __name__ == "__main__":
     # fmt: off
     labels = ["_", "'","A","B","C","D","E","F","G","H","I","J","K","L","M","N","O","P","Q","R","S","T","U","V","W","X","Y","Z"," "]
@@ -145,10 +396,15 @@ if __name__ == "__main__":
 
     train_dataset = CharSTTDataset(samples, conf=conf, audio_conf=audio_conf)
 
-    train_sampler = BucketingSampler(train_dataset, batch_size=32)
+    train_sampler = FrameBudgetBatchSampler(train_dataset, max_frames=32 * 16_000 * 20)
 
     train_loader = AudioDataLoader(
-        train_dataset, num_workers=0, batch_sampler=train_sampler
+        train_dataset,
+        num_workers=0,
+        batch_sampler=train_sampler,
+        collate_fn=BufferRingCollate(
+            audio_conf.feature_dim, max_frames_per_batch(train_sampler, train_dataset)
+        ),
     )
 
     for d in tqdm(train_loader):
@@ -0,0 +1,139 @@
+import hashlib
+import multiprocessing
+import os
+from collections import OrderedDict
+from tempfile import NamedTemporaryFile
+from typing import Callable, Dict, Optional
+
+import numpy as np
+import torch
+
+"""
+cache for features of not-augmented audio: (audio_file, mtime, AudioFeaturesConfig) -> features
+in-memory LRU with a byte-budget (per process) in front of an optional content-addressed
+on-disk cache, the on-disk cache is shared by all DataLoader-workers (and runs),
+put it on /dev/shm to share it in RAM
+"""
+
+STATS_FIELDS = ["hits", "disk_hits", "misses", "evictions"]
+
+
+def config_hash(audio_conf) -> str:
+    from data_related.audio_feature_extraction import (
+        WINDOW_SIZE,
+        WINDOW_STRIDE,
+        WINDOW_TYPE,
+    )
+
+    s = repr(
+        (sorted(audio_conf._asdict().items()), WINDOW_SIZE, WINDOW_STRIDE, WINDOW_TYPE)
+    )
+    return hashlib.sha1(s.encode("utf-8")).hexdigest()
+
+
+class FeatureCache:
+    def __init__(
+        self,
+        audio_conf,
+        max_bytes: int = 1 << 30,
+        cache_dir: Optional[str] = None,
+    ):
+        self.config_hash = config_hash(audio_conf)
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        self._lru: "OrderedDict[str, torch.Tensor]" = OrderedDict()
+        self._num_bytes = 0
+        # shared memory -> counts of all DataLoader-workers
+        self._counters = multiprocessing.Array("q", len(STATS_FIELDS))
+
+    def key(self, audio_file: str) -> str:
+        mtime = os.stat(audio_file).st_mtime_ns
+        s = f"{os.path.abspath(audio_file)}|{mtime}|{self.config_hash}"
+        return hashlib.sha1(s.encode("utf-8")).hexdigest()
+
+    def _count(self, field: str):
+        with self._counters.get_lock():
+            self._counters[STATS_FIELDS.index(field)] += 1
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        d = {k: self._counters[i] for i, k in enumerate(STATS_FIELDS)}
+        d["memory_bytes"] = self._num_bytes  # of this process
+        return d
+
+    def _disk_file(self, key: str) -> str:
+        return f"{self.cache_dir}/{key[:2]}/{key}.npy"
+
+    def _read_disk(self, key: str) -> Optional[torch.Tensor]:
+        if self.cache_dir is None or not os.path.isfile(self._disk_file(key)):
+            return None
+        return torch.from_numpy(np.load(self._disk_file(key)))
+
+    def _write_disk(self, key: str, feat: torch.Tensor):
+        file = self._disk_file(key)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        # written to temp-file + rename -> other workers never read half-written files
+        with NamedTemporaryFile(dir=os.path.dirname(file), suffix=".tmp", delete=False) as f:
+            np.save(f, feat.numpy())
+        os.replace(f.name, file)
+
+    def _put_memory(self, key: str, feat: torch.Tensor):
+        num_bytes = feat.numel() * feat.element_size()
+        if num_bytes > self.max_bytes:
+            return
+        self._lru[key] = feat
+        self._num_bytes += num_bytes
+        while self._num_bytes > self.max_bytes:
+            _, evicted = self._lru.popitem(last=False)
+            self._num_bytes -= evicted.numel() * evicted.element_size()
+            self._count("evictions")
+
+    def get_or_compute(
+        self, audio_file: str, compute: Callable[[str], torch.Tensor]
+    ) -> torch.Tensor:
+        key = self.key(audio_file)
+        feat = self._lru.get(key)
+        if feat is not None:
+            self._lru.move_to_end(key)
+            self._count("hits")
+            return feat
+
+        feat = self._read_disk(key)
+        if feat is not None:
+            self._count("disk_hits")
+        else:
+            self._count("misses")
+            feat = compute(audio_file)
+            if self.cache_dir is not None:
+                self._write_disk(key, feat)
+        self._put_memory(key, feat)
+        return feat
+
+
+def test_feature_cache(tmp_path):
+    from collections import namedtuple
+
+    Conf = namedtuple("Conf", ["feature_type"])
+    audio_files = []
+    for k in range(3):
+        audio_files.append(f"{tmp_path}/{k}.wav")
+        with open(audio_files[-1], "w") as f:
+            f.write(str(k))
+
+    def compute(audio_file):
+        return torch.full((10, 10), float(os.path.basename(audio_file)[0]))
+
+    cache = FeatureCache(Conf("stft"), max_bytes=2 * 400, cache_dir=f"{tmp_path}/cache")
+    for f in audio_files + audio_files[-2:]:
+        assert torch.equal(cache.get_or_compute(f, compute), compute(f))
+    assert cache.stats["misses"] == 3 and cache.stats["hits"] == 2
+    assert cache.stats["evictions"] == 1
+
+    assert torch.equal(cache.get_or_compute(audio_files[0], compute), compute(audio_files[0]))
+    assert cache.stats["disk_hits"] == 1
+
+    other_config = FeatureCache(Conf("mfcc"), cache_dir=f"{tmp_path}/cache")
+    other_config.get_or_compute(audio_files[0], compute)
+    assert other_config.stats["misses"] == 1
@@ -0,0 +1,186 @@
+import argparse
+import os
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+from tqdm import tqdm
+from typing import List, Dict, Optional, Iterator, Tuple
+from util import data_io
+
+from data_related.audio_feature_extraction import (
+    AudioFeaturesConfig,
+    AUDIOFEATUREEXTRACTORS,
+)
+from data_related.utils import ASRSample
+
+"""
+offline "featurize"-mode: spectrograms of a whole corpus are written into a few large
+float16 shard-files, CharSTTDataset then serves slices of these via numpy.memmap
+-> no audio-decoding and no STFT in the DataLoader-workers
+"""
+
+FEATURE_STORE_META = "feature_store.json"
+FEATURE_STORE_INDEX = "index.npz"
+FEATURE_STORE_DTYPE = np.float16
+
+
+def _shard_file_name(shard_id: int) -> str:
+    return f"shard_{shard_id:05d}.bin"
+
+
+def _calc_features(audio_file: str, audio_conf: AudioFeaturesConfig) -> np.ndarray:
+    audio_fe = AUDIOFEATUREEXTRACTORS[audio_conf.feature_type](audio_conf, [])
+    feat = audio_fe.process(audio_file)
+    # stored time-major (T x F) so that one utterance is one contiguous chunk of rows
+    return feat.t().numpy().astype(FEATURE_STORE_DTYPE)
+
+
+def featurize_corpus(
+    samples: List[ASRSample],
+    audio_conf: AudioFeaturesConfig,
+    store_dir: str,
+    max_shard_bytes: int = 1 << 30,
+    num_workers: int = 4,
+):
+    """
+    store_dir gets: shard_00000.bin, shard_00001.bin, ... + index.npz (shard_id,offset,length per utterance)
+    augmentation is switched off, precomputed features are the "clean" ones
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    audio_conf = audio_conf._replace(signal_augment=False, spec_augment=False)
+    audio_files = [s.audio_file for s in samples]
+
+    shard_ids = np.zeros(len(audio_files), dtype=np.int32)
+    offsets = np.zeros(len(audio_files), dtype=np.int64)
+    lengths = np.zeros(len(audio_files), dtype=np.int32)
+    shards: List[Dict] = []
+
+    shard_id, shard_frames, shard_bytes = 0, 0, 0
+    shard = open(f"{store_dir}/{_shard_file_name(shard_id)}", "wb")
+    with Pool(processes=num_workers) as pool:
+        feats_g = pool.imap(
+            partial(_calc_features, audio_conf=audio_conf), audio_files, chunksize=8
+        )
+        for k, feat in tqdm(enumerate(feats_g), total=len(audio_files)):
+            if shard_bytes > 0 and shard_bytes + feat.nbytes > max_shard_bytes:
+                shard.close()
+                shards.append({"file": _shard_file_name(shard_id), "num_frames": shard_frames})
+                shard_id, shard_frames, shard_bytes = shard_id + 1, 0, 0
+                shard = open(f"{store_dir}/{_shard_file_name(shard_id)}", "wb")
+
+            shard.write(feat.tobytes())
+            shard_ids[k] = shard_id
+            offsets[k] = shard_frames
+            lengths[k] = feat.shape[0]
+            shard_frames += feat.shape[0]
+            shard_bytes += feat.nbytes
+    shard.close()
+    shards.append({"file": _shard_file_name(shard_id), "num_frames": shard_frames})
+
+    np.savez(
+        f"{store_dir}/{FEATURE_STORE_INDEX}",
+        shard_ids=shard_ids,
+        offsets=offsets,
+        lengths=lengths,
+    )
+    data_io.write_json(
+        f"{store_dir}/{FEATURE_STORE_META}",
+        {
+            "audio_conf": audio_conf._asdict(),
+            "feature_dim": audio_conf.feature_dim,
+            "dtype": np.dtype(FEATURE_STORE_DTYPE).name,
+            "shards": shards,
+            "audio_files": audio_files,
+        },
+    )
+    print(f"wrote {len(shards)} shards with {len(audio_files)} utterances to {store_dir}")
+
+
+class MemmapFeatureStore:
+    """
+    serves features written by featurize_corpus, returned tensors are views on the
+    memory-mapped shards (no copies), the collate-fn casts them to float32 when padding
+    """
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        meta = data_io.read_json(f"{store_dir}/{FEATURE_STORE_META}")
+        self.audio_conf = AudioFeaturesConfig(**meta["audio_conf"])
+        self.feature_dim: int = meta["feature_dim"]
+        self.dtype = np.dtype(meta["dtype"])
+        self.shards: List[Dict] = meta["shards"]
+        self.file2idx = {f: k for k, f in enumerate(meta["audio_files"])}
+
+        index = np.load(f"{store_dir}/{FEATURE_STORE_INDEX}")
+        self.shard_ids = index["shard_ids"]
+        self.offsets = index["offsets"]
+        self.lengths = index["lengths"]
+        self._memmaps: Optional[List[np.memmap]] = None
+
+    def _open_shards(self) -> List[np.memmap]:
+        # mode "c" (copy-on-write) cause torch.from_numpy complains about read-only arrays
+        return [
+            np.memmap(
+                f"{self.store_dir}/{s['file']}",
+                dtype=self.dtype,
+                mode="c",
+                shape=(s["num_frames"], self.feature_dim),
+            )
+            for s in self.shards
+        ]
+
+    def __getstate__(self):
+        # DataLoader-workers open their own memmaps
+        state = self.__dict__.copy()
+        state["_memmaps"] = None
+        return state
+
+    def __contains__(self, audio_file: str) -> bool:
+        return audio_file in self.file2idx
+
+    def __len__(self):
+        return len(self.file2idx)
+
+    def get(self, audio_file: str) -> torch.Tensor:
+        if self._memmaps is None:
+            self._memmaps = self._open_shards()
+        k = self.file2idx[audio_file]
+        offset, length = self.offsets[k], self.lengths[k]
+        rows = self._memmaps[self.shard_ids[k]][offset : offset + length]
+        return torch.from_numpy(rows).t()  # F x T
+
+
+def read_manifest(manifest_file: str) -> Iterator[ASRSample]:
+    audio_dir = os.path.dirname(manifest_file)
+    for d in data_io.read_jsonl(manifest_file):
+        d["audio_file"] = os.path.join(audio_dir, d["audio_file"])
+        yield ASRSample(**d)
+
+
+# fmt: off
+parser = argparse.ArgumentParser(description="featurize a corpus into memory-mappable shards")
+parser.add_argument("--manifest", type=str, required=True)
+parser.add_argument("--store-dir", type=str, required=True)
+parser.add_argument("--feature-type", type=str, default="stft")
+parser.add_argument("--max-shard-gb", type=float, default=1.0)
+parser.add_argument("--num-workers", type=int, default=os.cpu_count())
+# fmt: on
+
+if __name__ == "__main__":
+    """
+    python data_related/feature_store.py --manifest $HOME/data/asr_data/ENGLISH/LibriSpeech/dev-other/manifest.jsonl.gz --store-dir /tmp/feature_store
+    """
+    args = parser.parse_args()
+    samples = list(read_manifest(args.manifest))
+    featurize_corpus(
+        samples,
+        AudioFeaturesConfig(feature_type=args.feature_type),
+        args.store_dir,
+        max_shard_bytes=int(args.max_shard_gb * (1 << 30)),
+        num_workers=args.num_workers,
+    )
+    store = MemmapFeatureStore(args.store_dir)
+    feat = store.get(samples[0].audio_file)
+    print(f"{samples[0].audio_file}: {tuple(feat.shape)} {feat.dtype}")
@@ -0,0 +1,285 @@
+import argparse
+import os
+import struct
+import zipfile
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from data_related.utils import ASRSample
+
+"""
+columnar manifest: duration/num_frames as numpy-arrays, audio-files and texts as one
+utf-8 blob each (+ offsets), saved as uncompressed .npz whose members get memory-mapped
+-> no python-objects per utterance, filtering/sorting is vectorized, pickling a
+ManifestIndex (to DataLoader-workers) only sends the file-name and the selected row-ids
+"""
+
+MANIFEST_INDEX_SUFFIX = "_index.npz"
+ZIP_LOCAL_HEADER_SIZE = 30
+
+
+def _to_blob(strings: List[str]):
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def _nan_if_none(x: Optional[float]) -> float:
+    return np.nan if x is None else x
+
+
+def _none_if_nan(x: float) -> Optional[float]:
+    return None if np.isnan(x) else float(x)
+
+
+def _mmap_npz(npz_file: str) -> Dict[str, np.ndarray]:
+    """
+    np.load ignores mmap_mode for .npz, but members written by np.savez are stored
+    (not compressed) -> every .npy lies contiguously in the zip-file
+    """
+    arrays = {}
+    with zipfile.ZipFile(npz_file) as zf, open(npz_file, "rb") as f:
+        for info in zf.infolist():
+            assert info.compress_type == zipfile.ZIP_STORED, f"{info.filename} is compressed"
+            f.seek(info.header_offset)
+            local_header = f.read(ZIP_LOCAL_HEADER_SIZE)
+            name_len, extra_len = struct.unpack("<HH", local_header[26:30])
+            f.seek(info.header_offset + ZIP_LOCAL_HEADER_SIZE + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            name = os.path.splitext(info.filename)[0]
+            if int(np.prod(shape)) == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+                continue
+            arrays[name] = np.memmap(
+                npz_file,
+                dtype=dtype,
+                mode="r",
+                offset=f.tell(),
+                shape=shape,
+                order="F" if fortran_order else "C",
+            )
+    return arrays
+
+
+class _AudioFiles:
+    """
+    lazy list of audio-files, for AudioFeatureExtractor (picking interference-files)
+    """
+
+    def __init__(self, index: "ManifestIndex"):
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, k: int) -> str:
+        return self.index.audio_file(k)
+
+
+class ManifestIndex:
+    """
+    can be used instead of a List[ASRSample]: len, index-access and iteration return ASRSamples
+    """
+
+    def __init__(
+        self,
+        columns: Optional[Dict[str, np.ndarray]] = None,
+        rows: Optional[np.ndarray] = None,
+        npz_file: Optional[str] = None,
+    ):
+        assert columns is not None or npz_file is not None
+        self.npz_file = npz_file
+        self._columns = columns
+        num_rows = len(self.columns["duration"])
+        self.rows = rows if rows is not None else np.arange(num_rows, dtype=np.int64)
+
+    @property
+    def columns(self) -> Dict[str, np.ndarray]:
+        if self._columns is None:
+            self._columns = _mmap_npz(self.npz_file)
+        return self._columns
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.npz_file is not None:
+            state["_columns"] = None  # every worker maps the file itself
+        return state
+
+    @classmethod
+    def from_samples(cls, samples: Iterable[ASRSample]) -> "ManifestIndex":
+        samples = list(samples)
+        audio_blob, audio_offsets = _to_blob([s.audio_file for s in samples])
+        text_blob, text_offsets = _to_blob([s.text for s in samples])
+        columns = {
+            "duration": np.array([s.duration for s in samples], dtype=np.float64),
+            "num_frames": np.array([s.num_frames for s in samples], dtype=np.int64),
+            # NaN -> whole file
+            "start": np.array([_nan_if_none(s.start) for s in samples], dtype=np.float64),
+            "end": np.array([_nan_if_none(s.end) for s in samples], dtype=np.float64),
+            "audio_blob": audio_blob,
+            "audio_offsets": audio_offsets,
+            "text_blob": text_blob,
+            "text_offsets": text_offsets,
+        }
+        return cls(columns)
+
+    @classmethod
+    def load(cls, npz_file: str) -> "ManifestIndex":
+        return cls(npz_file=npz_file)
+
+    def save(self, npz_file: str):
+        """
+        only the selected rows are saved, into a tmp-file that is renamed when complete
+        -> readers never map a half-written index
+        """
+        index = self.from_samples(self) if len(self) < len(self.columns["duration"]) else self
+        tmp_file = f"{npz_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as f:
+            np.savez(f, **index.columns)
+        os.replace(tmp_file, npz_file)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _string(self, name: str, row: int) -> str:
+        offsets = self.columns[f"{name}_offsets"]
+        blob = self.columns[f"{name}_blob"]
+        return blob[offsets[row] : offsets[row + 1]].tobytes().decode("utf-8")
+
+    def audio_file(self, k: int) -> str:
+        return self._string("audio", self.rows[k])
+
+    @property
+    def audio_files(self) -> _AudioFiles:
+        return _AudioFiles(self)
+
+    @property
+    def duration(self) -> np.ndarray:
+        return self.columns["duration"][self.rows]
+
+    @property
+    def num_frames(self) -> np.ndarray:
+        return self.columns["num_frames"][self.rows]
+
+    def __getitem__(self, k: int) -> ASRSample:
+        row = self.rows[k]
+        return ASRSample(
+            self._string("audio", row),
+            self._string("text", row),
+            float(self.columns["duration"][row]),
+            int(self.columns["num_frames"][row]),
+            *self._segment(row),
+        )
+
+    def _segment(self, row: int) -> Tuple[Optional[float], Optional[float]]:
+        if "start" not in self.columns:  # index built before segments existed
+            return None, None
+        return (
+            _none_if_nan(self.columns["start"][row]),
+            _none_if_nan(self.columns["end"][row]),
+        )
+
+    def __iter__(self):
+        return (self[k] for k in range(len(self)))
+
+    def select(self, rows: np.ndarray) -> "ManifestIndex":
+        """
+        :param rows: positions within this index
+        """
+        return ManifestIndex(self._columns, self.rows[rows], self.npz_file)
+
+    def filter_and_sort(self, min_len: float, max_len: float) -> "ManifestIndex":
+        """
+        same as sort_samples_in_corpus
+        """
+        duration = self.duration
+        suitable = np.nonzero((duration > min_len) & (duration < max_len))[0]
+        order = suitable[np.argsort(duration[suitable], kind="stable")]
+        return self.select(order)
+
+
+def index_file(manifest_file: str) -> str:
+    """
+    next to the manifest, named after it: train.jsonl.gz -> train_index.npz
+    """
+    name = os.path.basename(manifest_file).split(".")[0]
+    return os.path.join(os.path.dirname(manifest_file), name + MANIFEST_INDEX_SUFFIX)
+
+
+def build_or_load_index(manifest_file: str) -> ManifestIndex:
+    """
+    index is (re)built if missing or older than the manifest, under DDP only by rank 0
+    (the other ranks wait at a barrier)
+    """
+    import torch.distributed as dist
+    from data_related.feature_store import read_manifest
+
+    distributed = dist.is_available() and dist.is_initialized()
+    npz_file = index_file(manifest_file)
+    if not distributed or dist.get_rank() == 0:
+        if (
+            not os.path.isfile(npz_file)
+            or os.path.getmtime(npz_file) < os.path.getmtime(manifest_file)
+        ):
+            ManifestIndex.from_samples(read_manifest(manifest_file)).save(npz_file)
+    if distributed:
+        dist.barrier()
+    return ManifestIndex.load(npz_file)
+
+
+def test_manifest_index(tmp_path):
+    import pickle
+
+    samples = [
+        ASRSample(f"/some/dir/{k}.mp3", f"text nr. {k} ü", d, int(d * 16_000))
+        for k, d in enumerate([3.0, 0.5, 12.0, 7.5, 25.0, 7.5])
+    ]
+    samples.append(ASRSample("/some/talk.sph", "segment", 4.5, 72_000, 10.0, 14.5))
+    index = ManifestIndex.from_samples(samples)
+    assert list(index) == samples
+    npz_file = index_file(f"{tmp_path}/train.jsonl.gz")
+    assert npz_file == f"{tmp_path}/train_index.npz"
+    assert index_file(f"{tmp_path}/dev.jsonl") != npz_file
+    index.save(npz_file)
+    assert os.listdir(tmp_path) == ["train_index.npz"]  # no tmp-file left
+
+    loaded = ManifestIndex.load(npz_file)
+    assert isinstance(loaded.columns["duration"], np.memmap)
+    assert list(loaded) == samples
+
+    selected = loaded.filter_and_sort(1, 20)
+    expected = sorted([s for s in samples if 1 < s.duration < 20], key=lambda s: s.duration)
+    assert list(selected) == expected
+    assert selected.audio_files[1] == expected[1].audio_file
+
+    unpickled = pickle.loads(pickle.dumps(selected))
+    assert unpickled._columns is None and list(unpickled) == expected
+
+    selected.save(f"{tmp_path}/selected.npz")
+    assert list(ManifestIndex.load(f"{tmp_path}/selected.npz")) == expected
+
+
+# fmt: off
+parser = argparse.ArgumentParser(description="build columnar index of a manifest")
+parser.add_argument("--manifest", type=str, required=True)
+# fmt: on
+
+if __name__ == "__main__":
+    """
+    python data_related/manifest_index.py --manifest $HOME/data/asr_data/ENGLISH/LibriSpeech/dev-other/manifest.jsonl.gz
+    """
+    from time import time
+
+    args = parser.parse_args()
+    start = time()
+    index = build_or_load_index(args.manifest)
+    print(f"{len(index)} samples in {time() - start:.2f} secs")
+    start = time()
+    index.filter_and_sort(1, 20)
+    print(f"filter+sort took {time() - start:.4f} secs")
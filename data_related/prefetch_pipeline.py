@@ -0,0 +1,350 @@
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from time import sleep, time
+from typing import Callable, Dict, Iterable, List, Optional
+
+import torch
+
+from data_related.data_loader import _collate_fn
+from data_related.sharded_corpus import decode_audio
+
+"""
+staged replacement for AudioDataLoader: every stage has its own pool and hands its
+output to the next stage via a bounded queue
+    read:    thread-pool reads the (encoded) audio-bytes
+    process: process-pool decodes, resamples, featurizes
+    collate: thread in main process, batches get padded (pinned with BufferRingCollate)
+    device:  copies N batches ahead (non_blocking, on a separate cuda-stream)
+each queue records its depth and how long producer/consumer had to wait on it, queues
+only hold finished outputs (pooled work is submitted by one thread and awaited by another,
+connected by a bounded in-flight queue that is not part of the stats)
+-> the most upstream queue with long consumer-waits: the stage in front of it is the bottleneck
+"""
+
+_END = "end-of-pipeline"
+
+
+class _StageError:
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+class InstrumentedQueue:
+    def __init__(self, name: str, maxsize: int):
+        self.name = name
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.lock = threading.Lock()
+        self.num_items = 0
+        self.put_wait = 0.0  # producer blocked -> downstream too slow
+        self.get_wait = 0.0  # consumer starved -> upstream too slow
+        self.depth_sum = 0
+        self.max_depth = 0
+
+    def put(self, item, stop: threading.Event) -> bool:
+        start = time()
+        while not stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        with self.lock:
+            self.put_wait += time() - start
+        return not stop.is_set()
+
+    def get(self, stop: threading.Event):
+        start = time()
+        depth = self.queue.qsize()
+        item = _END
+        while not stop.is_set():
+            try:
+                item = self.queue.get(timeout=0.1)
+                break
+            except queue.Empty:
+                pass
+        with self.lock:
+            self.get_wait += time() - start
+            self.num_items += int(item is not _END)
+            self.depth_sum += depth
+            self.max_depth = max(self.max_depth, depth)
+        return item
+
+    def items(self, stop: threading.Event):
+        while True:
+            item = self.get(stop)
+            if item is _END:
+                return
+            yield item
+
+    def summary(self) -> Dict[str, float]:
+        with self.lock:
+            return {
+                "num_items": self.num_items,
+                "avg_depth": self.depth_sum / max(1, self.num_items),
+                "max_depth": self.max_depth,
+                "producer_wait_secs": self.put_wait,
+                "consumer_wait_secs": self.get_wait,
+            }
+
+
+_process_fn: Optional[Callable] = None
+
+
+def _init_process(process_fn: Callable):
+    # process_fn (holding the dataset) is pickled once per process, not per sample
+    global _process_fn
+    _process_fn = process_fn
+
+
+def _run_process_fn(raw):
+    return _process_fn(raw)
+
+
+class DevicePrefetcher:
+    """
+    keeps num_prefetch batches in flight to the device, on cuda the copies run on a
+    side-stream and overlap with the compute of the current batch
+    """
+
+    def __init__(self, batches: Iterable, device: torch.device, num_prefetch: int = 2):
+        self.batches = batches
+        self.device = device
+        self.num_prefetch = num_prefetch
+        self.use_cuda = device.type == "cuda"
+        self.stream = torch.cuda.Stream(device) if self.use_cuda else None
+
+    def _to_device(self, batch):
+        if not self.use_cuda:
+            return batch
+        with torch.cuda.stream(self.stream):
+            return [
+                t.to(self.device, non_blocking=True) if isinstance(t, torch.Tensor) else t
+                for t in batch
+            ]
+
+    def __iter__(self):
+        in_flight = []
+        for batch in self.batches:
+            in_flight.append(self._to_device(batch))
+            if len(in_flight) > self.num_prefetch:
+                yield self._ready(in_flight.pop(0))
+        while len(in_flight) > 0:
+            yield self._ready(in_flight.pop(0))
+
+    def _ready(self, batch):
+        if self.use_cuda:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(self.stream)
+            for t in batch:
+                if isinstance(t, torch.Tensor):
+                    t.record_stream(current)  # memory of side-stream is used by current
+        return batch
+
+
+class PrefetchPipeline:
+    def __init__(
+        self,
+        read_fn: Callable,
+        process_fn: Callable,
+        batch_sampler: Iterable[List[int]],
+        collate_fn: Callable = _collate_fn,
+        num_io_threads: int = 8,
+        num_processes: int = 4,
+        queue_size: int = 4,
+        num_prefetch: int = 2,
+        device: torch.device = torch.device("cpu"),
+    ):
+        """
+        :param read_fn: index -> raw (bytes), runs in threads
+        :param process_fn: raw -> sample, runs in processes, must be picklable
+        :param collate_fn: a BufferRingCollate needs num_buffers > queue_size + num_prefetch + 1
+        """
+        self.read_fn = read_fn
+        self.process_fn = process_fn
+        self.batch_sampler = batch_sampler
+        self.collate_fn = collate_fn
+        self.num_io_threads = num_io_threads
+        self.num_processes = num_processes
+        self.queue_size = queue_size
+        self.num_prefetch = num_prefetch
+        self.device = device
+        self.queues: Dict[str, InstrumentedQueue] = {}
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {name: q.summary() for name, q in self.queues.items()}
+
+    def _stage(self, work: Callable, source, sink: InstrumentedQueue, stop: threading.Event):
+        """
+        source is an iterable (first stage) or an InstrumentedQueue
+        """
+        try:
+            items = source.items(stop) if isinstance(source, InstrumentedQueue) else source
+            for item in items:
+                if isinstance(item, _StageError):
+                    sink.put(item, stop)
+                    return
+                if not sink.put(work(item), stop):
+                    return
+        except BaseException as e:
+            sink.put(_StageError(e), stop)
+            return
+        sink.put(_END, stop)
+
+    def __iter__(self):
+        names = ["read", "process", "collate"]
+        self.queues = {n: InstrumentedQueue(n, self.queue_size) for n in names}
+        stop = threading.Event()
+        io_pool = ThreadPoolExecutor(self.num_io_threads)
+        process_pool = multiprocessing.Pool(
+            self.num_processes, initializer=_init_process, initargs=(self.process_fn,)
+        )
+
+        in_flight = {n: InstrumentedQueue(n, self.queue_size) for n in ["read", "process"]}
+
+        def submit_reads(batch):
+            return [io_pool.submit(self.read_fn, i) for i in batch]
+
+        def finish_reads(read_futures):
+            return [f.result() for f in read_futures]
+
+        def submit_processing(raws):
+            return [process_pool.apply_async(_run_process_fn, (raw,)) for raw in raws]
+
+        def finish_processing(process_results):
+            return [r.get() for r in process_results]
+
+        stages = [
+            (submit_reads, self.batch_sampler, in_flight["read"]),
+            (finish_reads, in_flight["read"], self.queues["read"]),
+            (submit_processing, self.queues["read"], in_flight["process"]),
+            (finish_processing, in_flight["process"], self.queues["process"]),
+            (self.collate_fn, self.queues["process"], self.queues["collate"]),
+        ]
+        threads = [
+            threading.Thread(target=self._stage, args=(*s, stop), daemon=True)
+            for s in stages
+        ]
+        for t in threads:
+            t.start()
+
+        def batches():
+            for batch in self.queues["collate"].items(stop):
+                if isinstance(batch, _StageError):
+                    raise batch.exception
+                yield batch
+
+        try:
+            yield from DevicePrefetcher(batches(), self.device, self.num_prefetch)
+        finally:
+            stop.set()
+            for t in threads:
+                t.join()
+            io_pool.shutdown(wait=False)
+            process_pool.terminate()
+
+
+def read_audio_bytes(dataset, index: int):
+    s = dataset.samples[index]
+    assert s.start is None, "segments are read by CharSTTDataset, not as bytes"
+    with open(s.audio_file, "rb") as f:
+        data = f.read()
+    return data, os.path.splitext(s.audio_file)[1][1:], s.text
+
+
+def featurize_audio_bytes(dataset, raw):
+    """
+    CharSTTDataset.__getitem__ for an already read whole audio-file: decoded here,
+    then augmented/featurized like a segment (raw signal if featurize_in_collate)
+    """
+    data, suffix, text = raw
+    y = decode_audio(data, suffix, dataset.audio_conf.sample_rate)
+    return dataset._signal_to_features(y), dataset.parse_transcript(text)
+
+
+def build_stt_pipeline(dataset, batch_sampler, **kwargs) -> PrefetchPipeline:
+    """
+    :param dataset: CharSTTDataset, with featurize_in_collate pass a BatchFeaturizingCollate
+    """
+    audio_conf = dataset.audio_conf
+    assert not (
+        audio_conf.signal_augment and audio_conf.signal_augment_backend == "sox"
+    ), "sox needs files"
+    assert dataset.feature_store is None, "precomputed features, no audio to prefetch"
+    assert dataset.audio_fe.cache is None, "feature-cache is keyed by files, not bytes"
+    return PrefetchPipeline(
+        partial(read_audio_bytes, dataset),
+        partial(featurize_audio_bytes, dataset),
+        batch_sampler,
+        **kwargs,
+    )
+
+
+def _square(x):
+    return x * x
+
+
+def _slow_square(x):
+    sleep(0.05)
+    return x * x
+
+
+def test_prefetch_pipeline():
+    batches = [list(range(k, k + 3)) for k in range(0, 30, 3)]
+
+    def collate(samples):
+        return [torch.tensor(samples)]
+
+    pipeline = PrefetchPipeline(
+        lambda i: float(i), _square, batches, collate, num_io_threads=2, num_processes=2
+    )
+    outputs = [b[0].tolist() for b in pipeline]
+    assert outputs == [[float(i * i) for i in b] for b in batches]
+    stats = pipeline.stats()
+    assert [stats[n]["num_items"] for n in ["read", "process", "collate"]] == [10] * 3
+
+    pipeline = PrefetchPipeline(
+        lambda i: float(i), _slow_square, batches, collate, num_io_threads=2, num_processes=2
+    )
+    list(pipeline)
+    stats = pipeline.stats()
+    # process is the bottleneck: collate starves on "process", finished reads are waiting
+    assert stats["process"]["consumer_wait_secs"] > 0.3
+    assert stats["read"]["consumer_wait_secs"] < 0.1
+
+    def broken_read(i):
+        raise ValueError(f"can't read {i}")
+
+    pipeline = PrefetchPipeline(broken_read, _square, batches, collate, num_processes=1)
+    try:
+        list(pipeline)
+        assert False
+    except ValueError:
+        pass
+
+
+if __name__ == "__main__":
+    """
+    python data_related/prefetch_pipeline.py $HOME/data/asr_data/ENGLISH/LibriSpeech/dev-other/manifest.jsonl.gz
+    """
+    import sys
+    from pprint import pprint
+
+    from data_related.audio_feature_extraction import AudioFeaturesConfig
+    from data_related.char_stt_dataset import CharSTTDataset, DataConfig
+    from data_related.data_loader import FrameBudgetBatchSampler
+    from data_related.datasets.librispeech import LIBRI_VOCAB
+    from data_related.feature_store import read_manifest
+
+    dataset = CharSTTDataset(
+        list(read_manifest(sys.argv[1])), DataConfig(LIBRI_VOCAB), AudioFeaturesConfig()
+    )
+    sampler = FrameBudgetBatchSampler(dataset, max_frames=32 * 16_000 * 20)
+    pipeline = build_stt_pipeline(dataset, sampler, num_processes=os.cpu_count())
+    start = time()
+    num_utterances = sum(len(batch[3]) for batch in pipeline)
+    print(f"{num_utterances / (time() - start):.1f} utterances per second")
+    pprint(pipeline.stats())
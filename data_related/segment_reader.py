@@ -0,0 +1,157 @@
+import os
+import struct
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+import numpy as np
+import torch
+
+from data_related.audio_io import get_sample_rate, load_audio_segment, resample
+
+"""
+reads (start,end)-segments of long recordings (TED-talks, Tuda-sessions) instead of
+pre-cutting them into small files
+    wav/sphere with plain pcm: the samples are memory-mapped, a segment is a slice
+    other formats: torchaudio seeks to the frame-offset (sample-rate probed once per file)
+the memory-maps are kept in an LRU (per process)
+"""
+
+PCM_SUFFIXES = [".wav", ".WAV", ".sph", ".SPH"]
+
+
+class PcmSource(NamedTuple):
+    samples: np.ndarray  # num_frames x num_channels
+    sample_rate: int
+
+
+def _open_wav(audio_file: str) -> Optional[PcmSource]:
+    with open(audio_file, "rb") as f:
+        riff, _, wave = struct.unpack("<4sI4s", f.read(12))
+        assert riff == b"RIFF" and wave == b"WAVE", f"{audio_file} is no wav-file"
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+            chunk_id, chunk_size = struct.unpack("<4sI", header)
+            if chunk_id == b"fmt ":
+                fmt = struct.unpack("<HHIIHH", f.read(16))
+                f.seek(chunk_size - 16 + chunk_size % 2, os.SEEK_CUR)
+            elif chunk_id == b"data":
+                data_offset = f.tell()
+                break
+            else:
+                f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+    format_tag, num_channels, sample_rate, _, _, bits = fmt
+    if format_tag != 1 or bits != 16:  # only 16bit-pcm
+        return None
+    num_frames = chunk_size // (2 * num_channels)
+    samples = np.memmap(
+        audio_file, dtype="<i2", mode="r", offset=data_offset, shape=(num_frames, num_channels)
+    )
+    return PcmSource(samples, sample_rate)
+
+
+def _open_sphere(audio_file: str) -> Optional[PcmSource]:
+    with open(audio_file, "rb") as f:
+        assert f.readline().strip() == b"NIST_1A", f"{audio_file} is no sphere-file"
+        header_size = int(f.readline().strip())
+        fields = {}
+        for line in f.read(header_size - f.tell()).decode("ascii", "ignore").splitlines():
+            tokens = line.split()
+            if len(tokens) == 3:
+                fields[tokens[0]] = tokens[2]
+
+    if fields.get("sample_coding", "pcm") != "pcm" or fields.get("sample_n_bytes") != "2":
+        return None  # shorten-compressed ("pcm,embedded-shorten-v2.00") or mu-law
+    num_channels = int(fields.get("channel_count", 1))
+    dtype = "<i2" if fields.get("sample_byte_format", "01") == "01" else ">i2"
+    num_frames = int(fields["sample_count"])
+    samples = np.memmap(
+        audio_file, dtype=dtype, mode="r", offset=header_size, shape=(num_frames, num_channels)
+    )
+    return PcmSource(samples, int(fields["sample_rate"]))
+
+
+def open_pcm(audio_file: str) -> Optional[PcmSource]:
+    """
+    :return: None if samples can't be memory-mapped
+    """
+    suffix = os.path.splitext(audio_file)[1].lower()
+    if suffix == ".wav":
+        return _open_wav(audio_file)
+    elif suffix == ".sph":
+        return _open_sphere(audio_file)
+    return None
+
+
+class SegmentReader:
+    def __init__(self, max_open_files: int = 64):
+        self.max_open_files = max_open_files
+        self._sources: "OrderedDict[str, Optional[PcmSource]]" = OrderedDict()
+
+    def __getstate__(self):
+        # DataLoader-workers open their own memory-maps
+        state = self.__dict__.copy()
+        state["_sources"] = OrderedDict()
+        return state
+
+    def _get_source(self, audio_file: str) -> Optional[PcmSource]:
+        if audio_file in self._sources:
+            self._sources.move_to_end(audio_file)
+            return self._sources[audio_file]
+        source = open_pcm(audio_file)
+        self._sources[audio_file] = source
+        if len(self._sources) > self.max_open_files:
+            self._sources.popitem(last=False)
+        return source
+
+    def read(self, audio_file: str, start: float, end: float, target_rate=16_000) -> np.ndarray:
+        """
+        :param start, end: in seconds
+        :return: mono float32-signal like load_audio (int16-range)
+        """
+        source = self._get_source(audio_file)
+        if source is None:
+            orig_rate = get_sample_rate(audio_file)
+            return load_audio_segment(audio_file, start, end, target_rate, orig_rate)
+
+        first = max(0, int(round(start * source.sample_rate)))
+        last = min(len(source.samples), int(round(end * source.sample_rate)))
+        pcm = np.asarray(source.samples[first:last], dtype=np.float32)
+        sound = torch.from_numpy(pcm.mean(axis=1)).unsqueeze(0)
+        return resample(sound, source.sample_rate, target_rate).squeeze(0).numpy()
+
+
+def test_segment_reader(tmp_path):
+    import scipy.io.wavfile
+
+    sample_rate = 8_000
+    pcm = (np.arange(3 * sample_rate) % 1000 - 500).astype(np.int16)
+    wav_file = f"{tmp_path}/long.wav"
+    scipy.io.wavfile.write(wav_file, sample_rate, np.stack([pcm, pcm], axis=1))
+
+    sph_file = f"{tmp_path}/long.sph"
+    header = (
+        f"NIST_1A\n   1024\nsample_count -i {len(pcm)}\nchannel_count -i 1\n"
+        f"sample_rate -i {sample_rate}\nsample_n_bytes -i 2\n"
+        "sample_byte_format -s2 01\nsample_coding -s3 pcm\nend_head\n"
+    ).encode("ascii")
+    with open(sph_file, "wb") as f:
+        f.write(header.ljust(1024, b" ") + pcm.astype("<i2").tobytes())
+
+    reader = SegmentReader(max_open_files=1)
+    expected = pcm[4_000:12_000].astype(np.float32)
+    for audio_file in [wav_file, sph_file, wav_file]:
+        y = reader.read(audio_file, 0.5, 1.5, target_rate=sample_rate)
+        assert np.allclose(y, expected)
+    assert list(reader._sources.keys()) == [wav_file]
+
+    y = reader.read(sph_file, 2.5, 4.0, target_rate=16_000)  # end beyond file, upsampled
+    assert len(y) == 8_000
+
+    shorten_file = f"{tmp_path}/shorten.sph"
+    with open(shorten_file, "wb") as f:
+        f.write(header.replace(b"-s3 pcm\n", b"-s26 pcm,embedded-shorten-v2.00\n"))
+    assert open_pcm(shorten_file) is None  # -> torchaudio decodes it
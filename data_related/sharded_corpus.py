@@ -0,0 +1,357 @@
+import argparse
+import io
+import json
+import os
+import tarfile
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import torch
+import torchaudio
+from torch.utils.data import IterableDataset, get_worker_info
+from tqdm import tqdm
+from util import data_io
+
+from data_related.audio_feature_extraction import (
+    AudioFeaturesConfig,
+    AUDIOFEATUREEXTRACTORS,
+)
+from data_related.audio_io import INT16_SCALE, resample
+from data_related.char_stt_dataset import DataConfig
+from data_related.data_augmentation.waveform_augment import augment_waveform
+from data_related.utils import ASRSample
+
+"""
+corpus as a few large uncompressed tar-shards (webdataset-like): per utterance two
+consecutive members "<key>.<audio-suffix>" (encoded audio as is) and "<key>.json" (manifest-row)
+-> reading is sequential, no extraction, no small-file reads on network-storage
+ShardedAudioDataset streams the shards, shuffling is on shard-level (+ a small in-memory buffer)
+every (rank, worker) yields the same number of samples -> same number of batches on all
+ranks (DDP would hang otherwise): splits with too many samples hand the tail of their
+shards to splits with too few -> at most num_splits - 1 samples are skipped per epoch
+"""
+
+SHARDS_META = "shards.json"
+
+
+def _shard_file_name(shard_id: int) -> str:
+    return f"shard_{shard_id:05d}.tar"
+
+
+def _add_bytes(tar: tarfile.TarFile, name: str, data: bytes):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def write_shards(
+    samples: Iterable[ASRSample], shard_dir: str, max_shard_bytes: int = 1 << 28
+) -> List[Dict]:
+    """
+    shard_dir gets: shard_00000.tar, shard_00001.tar, ... + shards.json
+    shards are written to .tmp-files and renamed when complete
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    shards: List[Dict] = []
+    tar, shard_bytes, durations = None, 0, []
+
+    def close_shard():
+        tar.close()
+        file = _shard_file_name(len(shards))
+        os.replace(f"{shard_dir}/{file}.tmp", f"{shard_dir}/{file}")
+        # durations -> number of samples passing the duration-filter is known before reading
+        shards.append({"file": file, "num_samples": len(durations), "durations": durations})
+
+    for k, s in tqdm(enumerate(samples)):
+        assert s.start is None, "segments can't be sharded, whole files are packed"
+        audio_size = os.path.getsize(s.audio_file)
+        if tar is not None and shard_bytes + audio_size > max_shard_bytes:
+            close_shard()
+            tar = None
+        if tar is None:
+            file = _shard_file_name(len(shards))
+            tar = tarfile.open(f"{shard_dir}/{file}.tmp", mode="w")
+            shard_bytes, durations = 0, []
+
+        key = f"{k:09d}"
+        suffix = os.path.splitext(s.audio_file)[1]
+        tar.add(s.audio_file, arcname=f"{key}{suffix}")
+        row = {
+            "audio_file": os.path.basename(s.audio_file),
+            "text": s.text,
+            "duration": s.duration,
+            "num_frames": s.num_frames,
+        }
+        _add_bytes(tar, f"{key}.json", json.dumps(row).encode("utf-8"))
+        shard_bytes += audio_size
+        durations.append(s.duration)
+    if tar is not None:
+        close_shard()
+
+    data_io.write_json(f"{shard_dir}/{SHARDS_META}", {"shards": shards})
+    print(f"wrote {sum(s['num_samples'] for s in shards)} samples into {len(shards)} shards")
+    return shards
+
+
+def iterate_shard(shard_file: str) -> Iterator[Tuple[Dict, str, bytes]]:
+    """
+    streaming read ("r|"), no seeking
+    :return: (manifest-row, audio-suffix, audio-bytes)
+    """
+    with tarfile.open(shard_file, mode="r|") as tar:
+        audio: Optional[Tuple[str, str, bytes]] = None
+        for member in tar:
+            if not member.isfile():
+                continue
+            key, suffix = member.name.split(".", 1)
+            data = tar.extractfile(member).read()
+            if suffix == "json":
+                assert audio is not None and audio[0] == key, f"no audio for {member.name}"
+                yield json.loads(data), audio[1], audio[2]
+                audio = None
+            else:
+                audio = (key, suffix, data)
+
+
+def _rank_and_world_size() -> Tuple[int, int]:
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return 0, 1
+
+
+class ShardPiece(NamedTuple):
+    shard: int  # index into shard-files
+    skip: int  # samples (passing the duration-filter) skipped at the start of the shard
+    take: int  # samples read after those
+
+
+def split_shards(
+    shard_sizes: List[int], num_splits: int, shuffle_seed: Optional[int] = None
+) -> List[List[int]]:
+    """
+    same permutation on all ranks -> every shard goes to exactly one split, largest shards
+    first (stable, so equally sized ones stay permuted) each shard is given to the split
+    with the fewest samples so far
+    :return: shard-indices per split, split of (rank, worker) is rank * num_workers + worker
+    """
+    order = np.arange(len(shard_sizes))
+    if shuffle_seed is not None:
+        order = np.random.RandomState(shuffle_seed).permutation(len(shard_sizes))
+    order = order[np.argsort(-np.asarray(shard_sizes)[order], kind="stable")]
+    splits: List[List[int]] = [[] for _ in range(num_splits)]
+    loads = np.zeros(num_splits, dtype=np.int64)
+    for i in order:
+        k = int(np.argmin(loads))
+        splits[k].append(int(i))
+        loads[k] += shard_sizes[i]
+    return splits
+
+
+def plan_epoch(
+    shard_sizes: List[int], num_splits: int, shuffle_seed: Optional[int] = None
+) -> List[List[ShardPiece]]:
+    """
+    every split gets sum(shard_sizes) // num_splits samples: its shards from split_shards
+    up to that quota, the samples beyond it (surplus) fill up the splits below the quota
+    :return: pieces of shards per split
+    """
+    quota = sum(shard_sizes) // num_splits
+    plan: List[List[ShardPiece]] = []
+    surplus: List[ShardPiece] = []
+    for split in split_shards(shard_sizes, num_splits, shuffle_seed):
+        pieces, remaining = [], quota
+        for i in split:
+            take = min(shard_sizes[i], remaining)
+            if take > 0:
+                pieces.append(ShardPiece(i, 0, take))
+            if take < shard_sizes[i]:
+                surplus.append(ShardPiece(i, take, shard_sizes[i] - take))
+            remaining -= take
+        plan.append(pieces)
+
+    for pieces in plan:
+        missing = quota - sum(p.take for p in pieces)
+        while missing > 0:
+            p = surplus.pop()
+            take = min(p.take, missing)
+            pieces.append(ShardPiece(p.shard, p.skip, take))
+            if take < p.take:
+                surplus.append(ShardPiece(p.shard, p.skip + take, p.take - take))
+            missing -= take
+    return plan
+
+
+def decode_audio(data: bytes, suffix: str, target_rate=16_000) -> np.ndarray:
+    sound, sample_rate = torchaudio.load(io.BytesIO(data), format=suffix)
+    return resample(sound * INT16_SCALE, sample_rate, target_rate).squeeze().numpy()
+
+
+class ShardedAudioDataset(IterableDataset):
+    """
+    yields (features, transcript) like CharSTTDataset, but in shard-order
+    use with batch_size (no sampler), call set_epoch every epoch to reshuffle
+    num_workers has to be the same on all ranks
+    signal-augmentation (numpy-backend only) takes the previous utterance as interference
+    """
+
+    def __init__(
+        self,
+        shard_dir: str,
+        conf: DataConfig,
+        audio_conf: AudioFeaturesConfig,
+        shuffle: bool = True,
+        shuffle_buffer: int = 100,
+        seed: int = 0,
+    ):
+        meta = data_io.read_json(f"{shard_dir}/{SHARDS_META}")
+        self.shard_files = [f"{shard_dir}/{s['file']}" for s in meta["shards"]]
+        # samples per shard passing the duration-filter
+        self.shard_sizes = [
+            sum(conf.min_len < d < conf.max_len for d in s["durations"])
+            for s in meta["shards"]
+        ]
+        self.num_samples = sum(self.shard_sizes)
+        self.conf = conf
+        self.audio_conf = audio_conf
+        assert not (
+            audio_conf.signal_augment and audio_conf.signal_augment_backend == "sox"
+        ), "sox needs files"
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        self.char2idx = dict([(conf.labels[i], i) for i in range(len(conf.labels))])
+        self.audio_fe = AUDIOFEATUREEXTRACTORS[audio_conf.feature_type](audio_conf, [])
+        super().__init__()
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def _split_id(self) -> Tuple[int, int]:
+        """
+        :return: (split of this rank+worker, number of splits)
+        """
+        rank, world_size = _rank_and_world_size()
+        worker_info = get_worker_info()
+        worker_id, num_workers = (
+            (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        )
+        return rank * num_workers + worker_id, world_size * num_workers
+
+    def _my_pieces(self) -> List[ShardPiece]:
+        split_id, num_splits = self._split_id()
+        plan = plan_epoch(
+            self.shard_sizes,
+            num_splits,
+            shuffle_seed=self.seed + self.epoch if self.shuffle else None,
+        )
+        return plan[split_id]
+
+    def _samples(self) -> Iterator[Tuple[Dict, np.ndarray]]:
+        for piece in self._my_pieces():
+            yield from self._read_piece(piece)
+
+    def _read_piece(self, piece: ShardPiece) -> Iterator[Tuple[Dict, np.ndarray]]:
+        num_suitable = 0
+        for row, suffix, data in iterate_shard(self.shard_files[piece.shard]):
+            if not self.conf.min_len < row["duration"] < self.conf.max_len:
+                continue
+            num_suitable += 1
+            if num_suitable <= piece.skip:
+                continue
+            yield row, decode_audio(data, suffix, self.audio_conf.sample_rate)
+            if num_suitable == piece.skip + piece.take:
+                return
+
+    def _shuffled(self, samples: Iterator) -> Iterator:
+        if not self.shuffle or self.shuffle_buffer <= 1:
+            yield from samples
+            return
+        split_id, _ = self._split_id()
+        rng = np.random.RandomState(self.seed + self.epoch + split_id)
+        buffer = []
+        for s in samples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(s)
+                continue
+            k = rng.randint(len(buffer))
+            yield buffer[k]
+            buffer[k] = s
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self):
+        previous = None
+        for row, y in self._shuffled(self._samples()):
+            sig = y
+            if self.audio_conf.signal_augment and previous is not None:
+                sig = augment_waveform(y, previous)
+            previous = y
+            yield self.audio_fe._extract_features(sig), self.parse_transcript(row["text"])
+
+    def parse_transcript(self, transcript: str) -> List[int]:
+        return list(filter(None, [self.char2idx.get(x) for x in list(transcript)]))
+
+
+def test_write_and_split_shards(tmp_path):
+    samples = []
+    for k in range(10):
+        audio_file = f"{tmp_path}/audio_{k}.wav"
+        with open(audio_file, "wb") as f:
+            f.write(bytes([k]) * (100 + k))
+        samples.append(ASRSample(audio_file, f"text {k}", 1.0 + k, 16_000 + k))
+
+    shards = write_shards(samples, f"{tmp_path}/shards", max_shard_bytes=300)
+    assert [s["num_samples"] for s in shards] == [2, 2, 2, 2, 2]
+    assert shards[1]["durations"] == [3.0, 4.0]
+
+    rows = [
+        (row, suffix, data)
+        for s in shards
+        for row, suffix, data in iterate_shard(f"{tmp_path}/shards/{s['file']}")
+    ]
+    assert [r["text"] for r, _, _ in rows] == [s.text for s in samples]
+    assert all(suffix == "wav" for _, suffix, _ in rows)
+    assert all(data == bytes([k]) * (100 + k) for k, (_, _, data) in enumerate(rows))
+
+    splits = split_shards([s["num_samples"] for s in shards], 4, shuffle_seed=3)
+    assert sorted(i for split in splits for i in split) == list(range(len(shards)))
+
+    shard_sizes = [7, 1, 1, 1, 1, 1, 1, 1, 6]
+    splits = split_shards(shard_sizes, 2)
+    assert splits == [[0, 2, 4, 6], [8, 1, 3, 5, 7]]  # 10 vs. 10, strided: 16 vs. 4
+    for seed in range(5):
+        loads = [
+            sum(shard_sizes[i] for i in split)
+            for split in split_shards(shard_sizes, 3, shuffle_seed=seed)
+        ]
+        assert max(loads) - min(loads) <= max(shard_sizes)
+
+    rng = np.random.RandomState(0)
+    for num_shards, num_splits in [(240, 64), (100, 64), (9, 2), (3, 8)]:
+        shard_sizes = list(rng.randint(2_900, 3_100, size=num_shards))
+        plan = plan_epoch(shard_sizes, num_splits, shuffle_seed=1)
+        quota = sum(shard_sizes) // num_splits
+        assert all(sum(p.take for p in pieces) == quota for pieces in plan)
+        read = {i: np.zeros(n, dtype=np.int64) for i, n in enumerate(shard_sizes)}
+        for p in (p for pieces in plan for p in pieces):
+            read[p.shard][p.skip : p.skip + p.take] += 1
+        assert all(np.all(r <= 1) for r in read.values())  # nothing twice
+        assert sum(r.sum() for r in read.values()) > sum(shard_sizes) - num_splits
+
+
+# fmt: off
+parser = argparse.ArgumentParser(description="pack a corpus into uncompressed tar-shards")
+parser.add_argument("--manifest", type=str, required=True)
+parser.add_argument("--shard-dir", type=str, required=True)
+parser.add_argument("--max-shard-mb", type=int, default=256)
+# fmt: on
+
+if __name__ == "__main__":
+    """
+    python data_related/sharded_corpus.py --manifest $HOME/data/asr_data/ENGLISH/LibriSpeech/dev-other/manifest.jsonl.gz --shard-dir /tmp/shards
+    """
+    from data_related.feature_store import read_manifest
+
+    args = parser.parse_args()
+    write_shards(read_manifest(args.manifest), args.shard_dir, args.max_shard_mb << 20)
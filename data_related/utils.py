@@ -1,12 +1,18 @@
+from contextlib import contextmanager
 from dataclasses import dataclass
 
 import os
+import shutil
+import signal
+import subprocess
+import threading
+import zlib
 
 import tarfile
 
 from zipfile import ZipFile
 
-from typing import List, Dict, Callable, Iterable, NamedTuple
+from typing import List, Dict, Callable, Iterable, NamedTuple, Optional, Tuple, Iterator, BinaryIO
 
 
 @dataclass(frozen=True, eq=True)
@@ -15,40 +21,121 @@ class ASRSample:
     text: str
     duration: float  # in seconds
     num_frames:int
+    # segment of a long recording, in seconds, None -> whole file
+    start: Optional[float] = None
+    end: Optional[float] = None
 
 ZIP_SUFFIXES = [".zip", ".ZIP"]
 TAR_GZ_SUFFIXES = [".tar.gz", ".TAR.GZ",".tgz"]
 COMPRESSION_SUFFIXES = ZIP_SUFFIXES + TAR_GZ_SUFFIXES
+GUNZIP_CHUNK_SIZE = 1 << 20
 
-def unzip(zipfile: str, dest_dir: str) -> None:
+def is_within_directory(directory: str, target: str) -> bool:
+    abs_directory = os.path.abspath(directory)
+    abs_target = os.path.abspath(target)
+    return os.path.commonpath([abs_directory, abs_target]) == abs_directory
 
+
+def _keep(name: str, suffixes: Optional[Tuple[str, ...]]) -> bool:
+    return suffixes is None or name.endswith(suffixes)
+
+
+def _gunzip_in_thread(compressed_file: str, pipe_w: int, errors: List[Exception]):
+    """
+    zlib releases the GIL -> decompression runs in parallel with untarring+writing
+    :param errors: gets the exception, re-raised by open_gunzip_stream after joining
+    """
+    decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    try:
+        with open(compressed_file, "rb") as f, os.fdopen(pipe_w, "wb") as out:
+            while True:
+                chunk = f.read(GUNZIP_CHUNK_SIZE)
+                if not chunk:
+                    break
+                out.write(decompressor.decompress(chunk))
+                while decompressor.eof and decompressor.unused_data:
+                    # concatenated gzip-members (pigz/bgzip)
+                    rest = decompressor.unused_data
+                    decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+                    out.write(decompressor.decompress(rest))
+            out.write(decompressor.flush())
+            if not decompressor.eof:
+                raise EOFError(f"{compressed_file} is truncated")
+    except BrokenPipeError:
+        pass  # reader stopped early
+    except Exception as e:
+        errors.append(e)
+
+
+@contextmanager
+def open_gunzip_stream(compressed_file: str) -> Iterator[BinaryIO]:
+    """
+    decompressed stream of a .gz-file, by pigz if installed, otherwise by zlib in a thread
+    """
+    if shutil.which("pigz") is not None:
+        process = subprocess.Popen(
+            ["pigz", "-dc", compressed_file],
+            stdout=subprocess.PIPE,
+            bufsize=GUNZIP_CHUNK_SIZE,
+        )
+        try:
+            yield process.stdout
+        finally:
+            process.stdout.close()
+            assert process.wait() in [0, -signal.SIGPIPE], f"pigz failed on {compressed_file}"
+    else:
+        pipe_r, pipe_w = os.pipe()
+        errors: List[Exception] = []
+        thread = threading.Thread(
+            target=_gunzip_in_thread, args=(compressed_file, pipe_w, errors), daemon=True
+        )
+        thread.start()
+        try:
+            with os.fdopen(pipe_r, "rb", buffering=GUNZIP_CHUNK_SIZE) as stream:
+                yield stream
+        finally:
+            thread.join()
+            if len(errors) > 0:
+                raise errors[0]
+
+
+def extract_tar_stream(
+    stream: BinaryIO, dest_dir: str, suffixes: Optional[Tuple[str, ...]] = None
+) -> int:
+    """
+    single pass over the members ("r|"), path-traversal is checked per member,
+    only regular files are written (no links, no permissions/mtimes)
+    :param suffixes: only files with these suffixes are written, the others are skipped
+    :return: number of extracted files
+    """
+    num_extracted = 0
+    with tarfile.open(fileobj=stream, mode="r|") as tar:
+        for member in tar:
+            target = os.path.join(dest_dir, member.name)
+            if not is_within_directory(dest_dir, target):
+                raise Exception(f"Attempted Path Traversal in Tar File: {member.name}")
+            if not member.isfile() or not _keep(member.name, suffixes):
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, "wb") as f:
+                shutil.copyfileobj(tar.extractfile(member), f, GUNZIP_CHUNK_SIZE)
+            num_extracted += 1
+    return num_extracted
+
+
+def unzip(zipfile: str, dest_dir: str, suffixes: Optional[Tuple[str, ...]] = None) -> None:
+    """
+    :param suffixes: only extract files with these suffixes (e.g. audio+transcripts)
+    """
     os.makedirs(dest_dir, exist_ok=True)
 
     if any([zipfile.endswith(s) for s in ZIP_SUFFIXES ]):
         with ZipFile(zipfile, "r") as zipObj:
-            zipObj.extractall(dest_dir)
+            members = [n for n in zipObj.namelist() if _keep(n, suffixes)]
+            zipObj.extractall(dest_dir, members)
     elif any([zipfile.endswith(s) for s in TAR_GZ_SUFFIXES]):
-        with tarfile.open(zipfile, mode="r:gz") as tar:
-            def is_within_directory(directory, target):
-                
-                abs_directory = os.path.abspath(directory)
-                abs_target = os.path.abspath(target)
-            
-                prefix = os.path.commonprefix([abs_directory, abs_target])
-                
-                return prefix == abs_directory
-            
-            def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-            
-                for member in tar.getmembers():
-                    member_path = os.path.join(path, member.name)
-                    if not is_within_directory(path, member_path):
-                        raise Exception("Attempted Path Traversal in Tar File")
-            
-                tar.extractall(path, members, numeric_owner=numeric_owner) 
-                
-            
-            safe_extract(tar, dest_dir)
+        with open_gunzip_stream(zipfile) as stream:
+            extract_tar_stream(stream, dest_dir, suffixes)
     else:
         raise NotImplementedError
 
@@ -57,3 +144,46 @@ def folder_to_targz(source_dir, destination_path):
     folder_name = os.path.basename(source_dir)
     with tarfile.open(f"{destination_path}/{folder_name}.tar.gz", "w:gz") as tar:
         tar.add(source_dir, arcname=folder_name)
+
+
+def test_unzip(tmp_path):
+    import io
+
+    src_dir = f"{tmp_path}/corpus"
+    os.makedirs(f"{src_dir}/speaker", exist_ok=True)
+    for name, content in [("a.flac", b"audio"), ("a.trans.txt", b"text"), ("README", b"x")]:
+        with open(f"{src_dir}/speaker/{name}", "wb") as f:
+            f.write(content * 1000)
+    folder_to_targz(src_dir, str(tmp_path))
+
+    unzip(f"{tmp_path}/corpus.tar.gz", f"{tmp_path}/all")
+    assert sorted(os.listdir(f"{tmp_path}/all/corpus/speaker")) == ["README", "a.flac", "a.trans.txt"]
+
+    unzip(f"{tmp_path}/corpus.tar.gz", f"{tmp_path}/some", suffixes=(".flac", ".trans.txt"))
+    assert sorted(os.listdir(f"{tmp_path}/some/corpus/speaker")) == ["a.flac", "a.trans.txt"]
+    with open(f"{tmp_path}/some/corpus/speaker/a.flac", "rb") as f:
+        assert f.read() == b"audio" * 1000
+
+    with open(f"{tmp_path}/corpus.tar.gz", "rb") as f:
+        compressed = f.read()
+    with open(f"{tmp_path}/truncated.tar.gz", "wb") as f:
+        f.write(compressed[: len(compressed) // 2])
+    try:
+        with open_gunzip_stream(f"{tmp_path}/truncated.tar.gz") as stream:
+            stream.read()
+        assert False
+    except (EOFError, AssertionError) as e:  # AssertionError: pigz failed
+        assert "truncated" in str(e) or "pigz" in str(e)
+
+    evil = io.BytesIO()
+    with tarfile.open(fileobj=evil, mode="w") as tar:
+        info = tarfile.TarInfo("../evil.txt")
+        info.size = 4
+        tar.addfile(info, io.BytesIO(b"evil"))
+    evil.seek(0)
+    try:
+        extract_tar_stream(evil, f"{tmp_path}/evil")
+        assert False
+    except Exception as e:
+        assert "Path Traversal" in str(e)
+    assert not os.path.exists(f"{tmp_path}/evil.txt")
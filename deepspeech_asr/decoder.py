@@ -16,9 +16,10 @@
 # Modified to support pytorch Tensors
 
 import Levenshtein as Lev
+import numpy
 import torch
 from six.moves import xrange
-from typing import Dict, NamedTuple
+from typing import Dict, NamedTuple, List, Tuple
 
 from utils import BLANK_SYMBOL, SPACE
 
@@ -44,6 +45,18 @@ class Decoder(object):
         """
         raise NotImplementedError
 
+    def close(self):
+        """
+        frees resources like worker-processes, nothing to free by default
+        """
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 
 class DecoderConfig(NamedTuple):
     lm_path: str = None
@@ -175,6 +188,36 @@ def convert_to_strings(
         return strings
 
 
+def greedy_decode_batch(
+    idx2char: Dict[int, str], blank_index: int, sequences: torch.Tensor, sizes=None
+) -> Tuple[List[List[str]], List[List[torch.Tensor]]]:
+    """
+    vectorized version of convert_to_strings with remove_repetitions=True:
+    repetitions, blanks and padding are masked out on the whole B x T argmax-matrix at once,
+    strings are build by a single join per utterance
+    """
+    sequences = sequences.cpu()
+    batch_size, max_len = sequences.shape
+    previous = torch.cat(
+        [torch.full_like(sequences[:, :1], -1), sequences[:, :-1]], dim=1
+    )
+    keep = (sequences != blank_index) & (sequences != previous)
+    if sizes is not None:
+        lengths = torch.as_tensor(sizes).cpu().view(-1, 1)
+        keep &= torch.arange(max_len).unsqueeze(0) < lengths
+
+    vocab = numpy.array([""] * (max(idx2char.keys()) + 1), dtype=object)
+    for i, c in idx2char.items():
+        vocab[i] = c
+    sequences, keep = sequences.numpy(), keep.numpy()
+
+    strings, offsets = [], []
+    for b in range(batch_size):
+        strings.append(["".join(vocab[sequences[b][keep[b]]])])
+        offsets.append([torch.from_numpy(keep[b].nonzero()[0]).int()])
+    return strings, offsets
+
+
 class GreedyDecoder(Decoder):
     def __init__(self, char2idx):
         super(GreedyDecoder, self).__init__(char2idx)
@@ -209,10 +252,40 @@ class GreedyDecoder(Decoder):
             offsets: time step per character predicted
         """
         _, max_probs = torch.max(probs, 2)
-        strings, offsets = self.convert_to_strings(
+        strings, offsets = greedy_decode_batch(
+            self.idx2char,
+            self.blank_index,
             max_probs.view(max_probs.size(0), max_probs.size(1)),
             sizes,
-            remove_repetitions=True,
-            return_offsets=True,
         )
         return strings, offsets
+
+
+def benchmark_greedy_decoding(batch_size=32, max_len=1000, num_runs=10):
+    from time import time
+    from utils import BLANK_SYMBOL, SPACE
+
+    labels = [BLANK_SYMBOL, "'"] + [chr(ord("A") + k) for k in range(26)] + [SPACE]
+    decoder = GreedyDecoder({l: k for k, l in enumerate(labels)})
+    probs = torch.softmax(torch.randn(batch_size, max_len, len(labels)) * 3, dim=-1)
+    sizes = torch.randint(max_len // 2, max_len + 1, (batch_size,)).int()
+
+    def loop_decode():
+        _, max_probs = torch.max(probs, 2)
+        return decoder.convert_to_strings(
+            max_probs, sizes, remove_repetitions=True, return_offsets=True
+        )
+
+    for name, fun in [("loop", loop_decode), ("vectorized", lambda: decoder.decode(probs, sizes))]:
+        start = time()
+        for _ in range(num_runs):
+            strings, offsets = fun()
+        print(f"{name}: {(time() - start) / num_runs * 1000:.1f} ms per batch")
+
+    loop_strings, loop_offsets = loop_decode()
+    assert strings == loop_strings
+    assert all(torch.equal(a[0], b[0]) for a, b in zip(offsets, loop_offsets))
+
+
+if __name__ == "__main__":
+    benchmark_greedy_decoding()
@@ -50,19 +50,27 @@ class MaskConv(nn.Module):
         :param lengths: The actual length of each sequence in the batch
         :return: Masked output from the module
         """
+        mask = None
+        device_lengths = lengths.to(x.device)  # DeepSpeech.forward passes cpu-lengths
         for module in self.seq_module:
             x = module(x)
-            mask = torch.BoolTensor(x.size()).fill_(0)
-            if x.is_cuda:
-                mask = mask.cuda()
-            for i, length in enumerate(lengths):
-                length = length.item()
-                if (mask[i].size(2) - length) > 0:
-                    mask[i].narrow(2, length, mask[i].size(2) - length).fill_(1)
+            if mask is None or mask.size(3) != x.size(3):
+                mask = padding_mask(device_lengths, x.size(3), x.device)
             x = x.masked_fill(mask, 0)
         return x, lengths
 
 
+def padding_mask(lengths: torch.Tensor, max_len: int, device=None) -> torch.Tensor:
+    """
+    :return: B x 1 x 1 x max_len, True where time-step >= length, broadcasts against BxCxDxT
+    built on device (default: the one of lengths), no per-sample loop -> no host-device sync
+    """
+    device = device if device is not None else lengths.device
+    steps = torch.arange(max_len, device=device)
+    lengths = lengths.to(device)
+    return (steps[None, :] >= lengths[:, None]).view(lengths.size(0), 1, 1, max_len)
+
+
 class InferenceBatchSoftmax(nn.Module):
     def forward(self, input_):
         if not self.training:
@@ -284,6 +292,53 @@ class DeepSpeech(nn.Module):
         return params
 
 
+def test_mask_conv_on_model_device():
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = DeepSpeech(161, vocab_size=29, hidden_size=32, nb_layers=1).to(device).eval()
+    x = torch.randn(3, 1, 161, 120, device=device)
+    lengths = torch.IntTensor([120, 80, 30])  # on cpu like from _collate_fn
+    with torch.no_grad():
+        out, output_sizes = model(x, lengths)
+        conv_out, _ = model.conv(x, model.get_seq_lens(lengths))
+    assert out.device.type == device.type
+    for b, l in enumerate(model.get_seq_lens(lengths).tolist()):
+        assert torch.all(conv_out[b, :, :, l:] == 0)
+
+
+def benchmark_mask_conv(batch_sizes=(1, 8, 32, 64), max_len=500, num_runs=5):
+    from time import time
+
+    def loop_masked_forward(mask_conv: MaskConv, x, lengths):
+        for module in mask_conv.seq_module:
+            x = module(x)
+            mask = torch.BoolTensor(x.size()).fill_(0)
+            if x.is_cuda:
+                mask = mask.cuda()
+            for i, length in enumerate(lengths):
+                length = length.item()
+                if (mask[i].size(2) - length) > 0:
+                    mask[i].narrow(2, length, mask[i].size(2) - length).fill_(1)
+            x = x.masked_fill(mask, 0)
+        return x, lengths
+
+    conv = DeepSpeech(161, vocab_size=29, hidden_size=64, nb_layers=1).conv.eval()
+    for batch_size in batch_sizes:
+        x = torch.randn(batch_size, 1, 161, max_len)
+        lengths = torch.randint(max_len // 4, max_len // 2 + 1, (batch_size,))
+        timings = {}
+        with torch.no_grad():
+            for name, fun in [("loop", loop_masked_forward), ("vectorized", MaskConv.forward)]:
+                start = time()
+                for _ in range(num_runs):
+                    out, _ = fun(conv, x, lengths)
+                timings[name] = (time() - start) / num_runs * 1000
+                assert torch.equal(out, loop_masked_forward(conv, x, lengths)[0])
+        print(
+            f"batch_size {batch_size}: loop {timings['loop']:.1f} ms, "
+            f"vectorized {timings['vectorized']:.1f} ms per forward"
+        )
+
+
 if __name__ == "__main__":
     import os.path
     import argparse
@@ -294,7 +349,11 @@ if __name__ == "__main__":
         default="models/deepspeech_final.pth",
         help="Path to model file created by training",
     )
+    parser.add_argument("--benchmark-maskconv", action="store_true")
     args = parser.parse_args()
+    if args.benchmark_maskconv:
+        benchmark_mask_conv()
+        exit()
     package = torch.load(args.model_path, map_location=lambda storage, loc: storage)
     model = DeepSpeech.load_model(args.model_path)
 
@@ -1,4 +1,5 @@
 import argparse
+from time import time
 
 import torch
 from tqdm import tqdm
@@ -11,6 +12,8 @@ from decoder import GreedyDecoder
 from lightning.lit_deepspeech import LitDeepSpeech
 from metrics_calculation import calc_num_word_errors, calc_num_char_erros
 from deepspeech_model import DeepSpeech
+from data_related.feature_store import read_manifest
+from quantization import quantize_deepspeech, model_size_mb
 from transcribing.transcribe_util import build_decoder, transcribe_batch
 from utils import (
     HOME,
@@ -126,8 +129,8 @@ def calc_errors(
         output_data.append((out.cpu().numpy(), output_sizes.numpy(), target_strings))
     for x in range(len(target_strings)):
         transcript, reference = decoded_output[x][0], target_strings[x][0]
-        wer_inst = calc_num_word_errors(transcript, reference)
-        cer_inst = calc_num_char_erros(transcript, reference)
+        wer_inst, _ = calc_num_word_errors(transcript, reference)
+        cer_inst, _ = calc_num_char_erros(transcript, reference)
         total_wer += wer_inst
         total_cer += cer_inst
         num_tokens += len(reference.split())
@@ -149,11 +152,15 @@ def calc_errors(
 parser = argparse.ArgumentParser(description="args")
 parser.add_argument("--model", type=str,default='libri_960_1024_32_11_04_2020/deepspeech_9.pth.tar')
 parser.add_argument("--datasets", type=str,nargs='+', default='test-clean')
+parser.add_argument("--manifest", type=str, default=None, help="held-out manifest.jsonl instead of librispeech datasets")
+parser.add_argument("--quantize", action="store_true", help="dynamic int8 quantization (cpu only)")
+parser.add_argument("--compare-quantized", action="store_true", help="WER-vs-speed report of fp32 and int8")
 # fmt: on
 
 if __name__ == "__main__":
     """
     python evaluation.py --model libri_960_1024_32_11_04_2020/deepspeech_9.pth.tar --datasets test-clean
+    python evaluation.py --model libri_960_1024_32_11_04_2020/deepspeech_9.pth.tar --manifest held_out/manifest.jsonl --compare-quantized
     :returns 
     BeamCTCDecoder: Test Summary    Average WER 8.936       Average CER 2.962
     GreedyDecoder: Test Summary    Average WER 9.059       Average CER 2.998
@@ -161,7 +168,8 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     torch.set_grad_enabled(False)
-    device = torch.device("cuda" if USE_GPU else "cpu")
+    use_cpu = args.quantize or args.compare_quantized
+    device = torch.device("cuda" if USE_GPU and not use_cpu else "cpu")
     use_half = False
     checkpoint_file = HOME + "/data/asr_data/checkpoints/%s" % args.model
 
@@ -176,6 +184,8 @@ if __name__ == "__main__":
         checkpoint_file
     )
     model = model.to(device)
+    if args.quantize:
+        model = quantize_deepspeech(model)
 
     char2idx = dict([(data_conf.labels[i], i) for i in range(len(data_conf.labels))])
 
@@ -183,14 +193,32 @@ if __name__ == "__main__":
 
     target_decoder = GreedyDecoder(char2idx)
 
-    asr_path = HOME + "/data/asr_data"
-    raw_data_path = asr_path + "/ENGLISH/LibriSpeech"
-    samples = build_librispeech_corpus(
-        raw_data_path, "_".join(args.datasets), args.datasets
-    )
+    if args.manifest is not None:
+        samples = list(read_manifest(args.manifest))
+    else:
+        asr_path = HOME + "/data/asr_data"
+        raw_data_path = asr_path + "/ENGLISH/LibriSpeech"
+        samples = build_librispeech_corpus(
+            raw_data_path, "_".join(args.datasets), args.datasets
+        )
 
     test_dataset = CharSTTDataset(samples, conf=data_conf, audio_conf=audio_conf,)
     test_loader = AudioDataLoader(test_dataset, batch_size=20, num_workers=4)
+
+    if args.compare_quantized:
+        audio_secs = sum(s.duration for s in test_dataset.samples)
+        print("model\tWER\tCER\tsecs\tRTF\tMB")
+        for name, m in [("fp32", model), ("int8", quantize_deepspeech(model))]:
+            start = time()
+            wer, cer, _ = evaluate(test_loader, device, m, decoder, target_decoder)
+            duration = time() - start
+            print(
+                f"{name}\t{wer:.3f}\t{cer:.3f}\t{duration:.1f}\t"
+                f"{duration / audio_secs:.4f}\t{model_size_mb(m):.1f}"
+            )
+        decoder.close()
+        exit()
+
     wer, cer, output_data = evaluate(
         test_loader=test_loader,
         device=device,
@@ -201,6 +229,7 @@ if __name__ == "__main__":
         verbose=False,
         half=use_half,
     )
+    decoder.close()
 
     print(
         "Test Summary \t"
@@ -0,0 +1,263 @@
+import argparse
+import inspect
+import json
+import os
+from time import time
+from typing import Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from deepspeech_model import DeepSpeech, BatchRNN
+
+"""
+export of DeepSpeech to TorchScript (trace) and ONNX
+packed sequences are not traceable with dynamic lengths -> BatchRNN is replaced by
+two unidirectional LSTMs on padded input, the backward one runs on length-wise
+reversed sequences, which gives the same outputs as pack_padded_sequence
+"""
+
+EXPORT_META_FILE = "export_meta.json"
+TORCHSCRIPT_FILE = "deepspeech.pt"
+ONNX_FILE = "deepspeech.onnx"
+
+
+def reverse_padded(x: torch.Tensor, lengths: torch.Tensor) -> torch.Tensor:
+    """
+    reverses the first lengths[b] time-steps of each sequence in T x B x H, padding stays in place
+    """
+    steps = torch.arange(x.size(0), device=x.device)[:, None]  # T x 1
+    lengths = lengths.to(x.device).long()[None, :]  # 1 x B
+    idx = torch.where(steps < lengths, lengths - 1 - steps, steps)
+    return x.gather(0, idx[:, :, None].expand_as(x))
+
+
+def _unidirectional_lstm(lstm: nn.LSTM, suffix: str) -> nn.LSTM:
+    uni = nn.LSTM(lstm.input_size, lstm.hidden_size, bias=True)
+    for name in ["weight_ih", "weight_hh", "bias_ih", "bias_hh"]:
+        getattr(uni, f"{name}_l0").data.copy_(getattr(lstm, f"{name}_l0{suffix}").data)
+    return uni
+
+
+class ExportableBatchRNN(nn.Module):
+    def __init__(self, batch_rnn: BatchRNN):
+        super(ExportableBatchRNN, self).__init__()
+        self.batch_norm = batch_rnn.batch_norm
+        self.bidirectional = batch_rnn.bidirectional
+        self.forward_rnn = _unidirectional_lstm(batch_rnn.rnn, "")
+        self.backward_rnn = (
+            _unidirectional_lstm(batch_rnn.rnn, "_reverse") if self.bidirectional else None
+        )
+
+    def forward(self, x, output_lengths):
+        if self.batch_norm is not None:
+            x = self.batch_norm(x)
+        out, _ = self.forward_rnn(x)
+        if self.backward_rnn is not None:
+            backward, _ = self.backward_rnn(reverse_padded(x, output_lengths))
+            out = out + reverse_padded(backward, output_lengths)  # sum like BatchRNN
+        steps = torch.arange(x.size(0), device=x.device)[:, None, None]
+        padding = steps >= output_lengths.to(x.device)[None, :, None]
+        return out.masked_fill(padding, 0)  # pad_packed_sequence pads with zeros
+
+
+class ExportableDeepSpeech(nn.Module):
+    """
+    same outputs as DeepSpeech in eval-mode (for inputs whose longest sequence fills the
+    time-dimension, which is what _collate_fn produces)
+    with_softmax: exported graph outputs probabilities (like InferenceBatchSoftmax)
+    """
+
+    def __init__(self, model: DeepSpeech, with_softmax: bool = False):
+        super(ExportableDeepSpeech, self).__init__()
+        self.model = model.eval()
+        self.rnns = nn.ModuleList([ExportableBatchRNN(rnn) for rnn in model.rnns])
+        self.with_softmax = with_softmax
+
+    def forward(self, x, lengths) -> Tuple[torch.Tensor, torch.Tensor]:
+        output_lengths = self.model.get_seq_lens(lengths.int())
+        x, _ = self.model.conv(x, output_lengths)
+        sizes = x.size()
+        x = x.view(sizes[0], sizes[1] * sizes[2], sizes[3])
+        x = x.permute(2, 0, 1).contiguous()  # TxNxH
+
+        for rnn in self.rnns:
+            x = rnn(x, output_lengths)
+
+        if not self.model.bidirectional:
+            x = self.model.lookahead(x)
+
+        x = self.model.fc(x)
+        x = x.transpose(0, 1)
+        if self.with_softmax:
+            x = F.softmax(x, dim=-1)
+        return x, output_lengths
+
+
+def _dummy_inputs(model: DeepSpeech, batch_size=2, max_len=300):
+    x = torch.randn(batch_size, 1, model.input_feature_dim, max_len)
+    lengths = torch.IntTensor([max_len] + [max_len // 2] * (batch_size - 1))
+    return x, lengths
+
+
+def _legacy_onnx_exporter_kwargs():
+    # newer torch defaults to the torch.export-based exporter
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        return {"dynamo": False}
+    return {}
+
+
+def export_model(
+    model: DeepSpeech, export_dir: str, with_softmax=False, onnx=True, opset_version=11
+):
+    os.makedirs(export_dir, exist_ok=True)
+    exportable = ExportableDeepSpeech(model, with_softmax).eval()
+    dummy = _dummy_inputs(model)
+    with torch.no_grad():
+        traced = torch.jit.trace(exportable, dummy, check_trace=False)
+    traced = torch.jit.freeze(traced)
+    traced.save(f"{export_dir}/{TORCHSCRIPT_FILE}")
+
+    output_name = "probs" if with_softmax else "logits"
+    if onnx:
+        torch.onnx.export(
+            exportable,
+            dummy,
+            f"{export_dir}/{ONNX_FILE}",
+            input_names=["inputs", "input_sizes"],
+            output_names=[output_name, "output_sizes"],
+            dynamic_axes={
+                "inputs": {0: "batch", 3: "time"},
+                "input_sizes": {0: "batch"},
+                output_name: {0: "batch", 1: "time"},
+                "output_sizes": {0: "batch"},
+            },
+            opset_version=opset_version,
+            **_legacy_onnx_exporter_kwargs(),
+        )
+    with open(f"{export_dir}/{EXPORT_META_FILE}", "w") as f:
+        json.dump(
+            {
+                "with_softmax": with_softmax,
+                "input_feature_dim": model.input_feature_dim,
+                "vocab_size": model.vocab_size,
+            },
+            f,
+        )
+
+
+class ExportedDeepSpeech:
+    """
+    callable like DeepSpeech: model(inputs, input_sizes) -> (out, output_sizes)
+    -> usable with transcribe_batch/transcribe_single and all Decoder classes
+    if exported with_softmax out already are probabilities, use transcribe
+    """
+
+    def __init__(self, export_dir: str, runtime: str = "torchscript", num_threads=None):
+        with open(f"{export_dir}/{EXPORT_META_FILE}") as f:
+            meta = json.load(f)
+        self.with_softmax: bool = meta["with_softmax"]
+        self.runtime = runtime
+        if runtime == "torchscript":
+            if num_threads is not None:
+                torch.set_num_threads(num_threads)
+            self.model = torch.jit.load(f"{export_dir}/{TORCHSCRIPT_FILE}")
+        elif runtime == "onnx":
+            import onnxruntime
+
+            options = onnxruntime.SessionOptions()
+            if num_threads is not None:
+                options.intra_op_num_threads = num_threads
+            self.session = onnxruntime.InferenceSession(
+                f"{export_dir}/{ONNX_FILE}", options, providers=["CPUExecutionProvider"]
+            )
+        else:
+            raise NotImplementedError(runtime)
+
+    def __call__(self, inputs, input_sizes) -> Tuple[torch.Tensor, torch.Tensor]:
+        with torch.no_grad():
+            if self.runtime == "torchscript":
+                return self.model(inputs.cpu().float(), input_sizes.cpu().int())
+            out, output_sizes = self.session.run(
+                None,
+                {
+                    "inputs": inputs.cpu().float().numpy(),
+                    "input_sizes": input_sizes.cpu().int().numpy(),
+                },
+            )
+            return torch.from_numpy(out), torch.from_numpy(output_sizes)
+
+    def transcribe(self, decoder, inputs, input_sizes):
+        out, output_sizes = self(inputs, input_sizes)
+        probs = out if self.with_softmax else F.softmax(out, dim=-1)
+        decoded_output, _ = decoder.decode(probs, output_sizes)
+        return decoded_output
+
+
+def _build_random_model(bidirectional=True) -> DeepSpeech:
+    model = DeepSpeech(
+        161, vocab_size=29, hidden_size=32, nb_layers=3, bidirectional=bidirectional
+    )
+    for m in model.modules():  # non-trivial batch-norm statistics
+        if isinstance(m, (nn.BatchNorm1d, nn.BatchNorm2d)):
+            m.running_mean.uniform_(-0.5, 0.5)
+            m.running_var.uniform_(0.5, 2.0)
+    return model.eval()
+
+
+def test_export_parity(tmp_path):
+    from importlib.util import find_spec
+
+    runtimes = ["torchscript"] + (["onnx"] if find_spec("onnxruntime") else [])
+    traced_batch_size = _dummy_inputs(_build_random_model())[0].size(0)
+    for bidirectional in [True, False]:
+        model = _build_random_model(bidirectional)
+        export_dir = f"{tmp_path}/export_{bidirectional}"
+        export_model(model, export_dir)
+
+        # other batch-sizes and lengths than traced with
+        for lengths in [[421, 300, 57], [421], [421, 421, 300, 200, 57]]:
+            assert len(lengths) != traced_batch_size
+            x = torch.randn(len(lengths), 1, 161, 421)
+            lengths = torch.IntTensor(lengths)
+            with torch.no_grad():
+                expected, expected_sizes = model(x, lengths)
+
+            for runtime in runtimes:
+                out, output_sizes = ExportedDeepSpeech(export_dir, runtime)(x, lengths)
+                assert output_sizes.shape == expected_sizes.shape, runtime
+                assert torch.equal(output_sizes.int(), expected_sizes)
+                for b, l in enumerate(expected_sizes):
+                    assert torch.allclose(out[b, :l], expected[b, :l], atol=1e-4), runtime
+
+
+# fmt: off
+parser = argparse.ArgumentParser(description="export DeepSpeech to TorchScript and ONNX")
+parser.add_argument("--model", type=str, required=True, help="lightning-checkpoint")
+parser.add_argument("--export-dir", type=str, required=True)
+parser.add_argument("--softmax", action="store_true", help="export probabilities instead of logits")
+parser.add_argument("--no-onnx", action="store_true")
+# fmt: on
+
+if __name__ == "__main__":
+    """
+    python export_model.py --model $HOME/data/checkpoints/epoch=9.ckpt --export-dir /tmp/deepspeech_export
+    """
+    from lightning.lit_deepspeech import LitDeepSpeech
+
+    args = parser.parse_args()
+    model = LitDeepSpeech.load_from_checkpoint(args.model).model.cpu().eval()
+    export_model(model, args.export_dir, with_softmax=args.softmax, onnx=not args.no_onnx)
+
+    x, lengths = _dummy_inputs(model, batch_size=8, max_len=1000)
+    runtimes = ["torchscript"] + ([] if args.no_onnx else ["onnx"])
+    with torch.no_grad():
+        for name in ["eager"] + runtimes:
+            start = time()
+            m = model if name == "eager" else ExportedDeepSpeech(args.export_dir, name)
+            load_secs = time() - start
+            m(x, lengths)  # warm-up
+            start = time()
+            m(x, lengths)
+            print(f"{name}: load {load_secs:.2f}s, forward {(time() - start) * 1000:.0f} ms")
@@ -14,6 +14,7 @@ from torch import Tensor
 from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data.dataloader import DataLoader
 
+from data_related.data_augmentation.batch_spec_augment import batch_spec_augment
 from decoder import Decoder, convert_to_strings
 from lightning.litutil import add_generic_args, build_args
 from metrics_calculation import calc_num_word_errors, calc_num_char_erros
@@ -30,7 +31,9 @@ def collate(batch):
     targets = [torch.IntTensor(target) for target in targets]
     padded_target = pad_sequence(targets, batch_first=True)
     input_sizes = torch.LongTensor([x.size(1) for x in inputs])
-    padded_inputs = pad_sequence([i.transpose(1, 0) for i in inputs], batch_first=True)
+    padded_inputs = pad_sequence(
+        [i.transpose(1, 0) for i in inputs], batch_first=True
+    ).float()  # features from MemmapFeatureStore are float16
     return padded_inputs, padded_target, input_sizes, target_sizes
 
 
@@ -67,6 +70,8 @@ class LitSTTModel(pl.LightningModule):
     def training_step(self, batch, batch_nb):
 
         inputs, targets, input_sizes, target_sizes = batch
+        if getattr(self.hparams, "batch_spec_augment", False):
+            inputs = self._augment_batch(inputs, input_sizes)
 
         out, output_sizes = self(inputs, input_sizes)
 
@@ -77,6 +82,10 @@ class LitSTTModel(pl.LightningModule):
         )
         return output
 
+    def _augment_batch(self, inputs, input_sizes):
+        # inputs as from collate: B x T x F
+        return batch_spec_augment(inputs.transpose(1, 2), input_sizes).transpose(1, 2)
+
     @abstractmethod
     def _supply_trainset(self):
         raise NotImplementedError
@@ -182,6 +191,7 @@ class LitSTTModel(pl.LightningModule):
         parser.add_argument("--num_workers", default=4, type=int)
         parser.add_argument("--vocab_size", type=int)
         parser.add_argument("--audio_feature_dim", type=int)
+        parser.add_argument("--batch_spec_augment", action="store_true", help="SpecAugment on the padded batch (on gpu)")
         return parser
 
 
@@ -4,6 +4,7 @@ from warnings import filterwarnings
 import torch
 from torch.nn.utils.rnn import pad_sequence
 
+from data_related.data_augmentation.batch_spec_augment import batch_spec_augment
 from data_related.datasets.librispeech import build_dataset, LIBRI_VOCAB
 from lightning.lightning_model import LitSTTModel, collate
 from lightning.litutil import generic_train, build_args
@@ -35,6 +36,9 @@ class LitDeepSpeech(LitSTTModel):
         parser.add_argument("--hidden_size", default=1024, type=int)
         return parser
 
+    def _augment_batch(self, inputs, input_sizes):
+        return batch_spec_augment(inputs, input_sizes)  # B x 1 x F x T
+
     @staticmethod
     def _collate_fn(batch):
         padded_inputs, padded_target, input_sizes, target_sizes = collate(batch)
@@ -1,5 +1,7 @@
 import Levenshtein
-from typing import List, Tuple
+import numpy
+from multiprocessing import Pool
+from typing import List, Tuple, Dict, NamedTuple
 
 """
 nemo is using [editdistance](https://github.com/roy-ht/editdistance)
@@ -56,3 +58,123 @@ def calc_rate(errors_lens):
     num_tokens = sum([l for _, l in errors_lens])
     errors = sum([s for s, _ in errors_lens])
     return float(errors) / float(num_tokens)
+
+
+ERRORS_DTYPE = numpy.dtype(
+    [
+        ("word_errors", numpy.int32),
+        ("word_sub", numpy.int32),
+        ("word_ins", numpy.int32),
+        ("word_del", numpy.int32),
+        ("num_words", numpy.int32),
+        ("char_errors", numpy.int32),
+        ("char_sub", numpy.int32),
+        ("char_ins", numpy.int32),
+        ("char_del", numpy.int32),
+        ("num_chars", numpy.int32),
+    ]
+)
+
+
+class CorpusScores(NamedTuple):
+    wer: float
+    cer: float
+    per_utterance: numpy.ndarray  # structured array of ERRORS_DTYPE
+
+    def summary(self) -> Dict[str, float]:
+        u = self.per_utterance
+        num_words, num_chars = max(1, u["num_words"].sum()), max(
+            1, u["num_chars"].sum()
+        )
+        return {
+            "wer": self.wer,
+            "word_sub": u["word_sub"].sum() / num_words,
+            "word_ins": u["word_ins"].sum() / num_words,
+            "word_del": u["word_del"].sum() / num_words,
+            "cer": self.cer,
+            "char_sub": u["char_sub"].sum() / num_chars,
+            "char_ins": u["char_ins"].sum() / num_chars,
+            "char_del": u["char_del"].sum() / num_chars,
+        }
+
+
+def _to_unichr(i: int) -> str:
+    return chr(i if i < 0xD800 else i + 0x800)  # skip surrogates
+
+
+def _count_edit_ops(ref: str, hyp: str) -> Tuple[int, int, int]:
+    sub, ins, dele = 0, 0, 0
+    for op, _, _ in Levenshtein.editops(ref, hyp):
+        if op == "replace":
+            sub += 1
+        elif op == "insert":  # hyp contains something that is not in ref
+            ins += 1
+        else:
+            dele += 1
+    return sub, ins, dele
+
+
+def _score_chunk(encoded_pairs: List[Tuple[str, str, str, str, int]]) -> numpy.ndarray:
+    errors = numpy.zeros(len(encoded_pairs), dtype=ERRORS_DTYPE)
+    for k, (hyp_words, ref_words, hyp_chars, ref_chars, num_words) in enumerate(
+        encoded_pairs
+    ):
+        w_sub, w_ins, w_del = _count_edit_ops(ref_words, hyp_words)
+        c_sub, c_ins, c_del = _count_edit_ops(ref_chars, hyp_chars)
+        errors[k] = (
+            w_sub + w_ins + w_del,
+            w_sub,
+            w_ins,
+            w_del,
+            num_words,
+            c_sub + c_ins + c_del,
+            c_sub,
+            c_ins,
+            c_del,
+            len(ref_chars),
+        )
+    return errors
+
+
+def calc_corpus_scores(
+    hypos: List[str], targets: List[str], num_processes=4, chunk_size=1000
+) -> CorpusScores:
+    """
+    tokenizes the whole corpus once (one token-vocabulary for all utterances),
+    edit-distances are calculated in a process-pool,
+    wer/cer are identical to calc_wer/calc_cer
+    """
+    token2idx: Dict[str, int] = {}
+
+    def encode(tokens: List[str]) -> str:
+        return "".join(
+            _to_unichr(token2idx.setdefault(t, len(token2idx))) for t in tokens
+        )
+
+    encoded_pairs = [
+        (
+            encode(hyp.split()),
+            encode(ref.split()),
+            hyp.replace(" ", ""),
+            ref.replace(" ", ""),
+            len(ref.split(" ")),
+        )
+        for hyp, ref in zip(hypos, targets)
+    ]
+    chunks = [
+        encoded_pairs[k : k + chunk_size]
+        for k in range(0, len(encoded_pairs), chunk_size)
+    ]
+    if num_processes > 1 and len(chunks) > 1:
+        with Pool(num_processes) as pool:
+            per_utterance = numpy.concatenate(pool.map(_score_chunk, chunks))
+    else:
+        per_utterance = numpy.concatenate([_score_chunk(c) for c in chunks])
+
+    wer = float(per_utterance["word_errors"].sum()) / float(
+        per_utterance["num_words"].sum()
+    )
+    cer = float(per_utterance["char_errors"].sum()) / float(
+        per_utterance["num_chars"].sum()
+    )
+    return CorpusScores(wer, cer, per_utterance)
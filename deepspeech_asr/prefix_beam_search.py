@@ -0,0 +1,344 @@
+import math
+from collections import defaultdict
+from multiprocessing import Pool
+from time import time
+from typing import Dict, List, Tuple, Optional, NamedTuple
+
+import numpy
+import torch
+
+from decoder import Decoder
+
+"""
+pure python/numpy CTC prefix beam search with a word-level n-gram LM (ARPA),
+alternative to BeamCTCDecoder which needs the ctcdecode C++ package
+scoring like ctcdecode: log P_ctc + alpha * ln P_lm + beta * num_words
+"""
+
+NEG_INF = -float("inf")
+LOG10_TO_LN = math.log(10)
+UNK = "<unk>"
+OOV_LOG10_PROB = -10.0  # if the LM has no <unk>
+
+
+def _logsumexp(a: float, b: float) -> float:
+    if a == NEG_INF:
+        return b
+    if b == NEG_INF:
+        return a
+    m = max(a, b)
+    return m + math.log1p(math.exp(-abs(a - b)))
+
+
+class ArpaLanguageModel:
+    """
+    n-grams are stored in a trie: node-ids index into numpy-arrays of log10-probs and
+    back-off weights, edges are a single dict: parent_node * vocab_size + word_id -> child
+    """
+
+    def __init__(self, arpa_file: str):
+        self.word2id: Dict[str, int] = {}
+        ngrams: List[Tuple[Tuple[str, ...], float, float]] = []
+        order = 0
+        with open(arpa_file, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if len(line) == 0 or line.startswith("ngram "):
+                    continue
+                if line.startswith("\\"):
+                    if line.endswith("-grams:"):
+                        order = int(line[1:].split("-")[0])
+                    continue
+                if order == 0:
+                    continue
+                fields = line.split()
+                words = tuple(fields[1 : 1 + order])
+                backoff = float(fields[1 + order]) if len(fields) > 1 + order else 0.0
+                ngrams.append((words, float(fields[0]), backoff))
+                if order == 1:
+                    self.word2id.setdefault(words[0], len(self.word2id))
+
+        self.order = max(len(w) for w, _, _ in ngrams)
+        self.vocab_size = len(self.word2id)
+        self.edges: Dict[int, int] = {}
+        self.log10_probs = numpy.zeros(len(ngrams) + 1, dtype=numpy.float32)
+        self.backoffs = numpy.zeros(len(ngrams) + 1, dtype=numpy.float32)
+        for node, (words, log10_prob, backoff) in enumerate(ngrams, start=1):
+            parent = self._lookup(words[:-1])
+            assert parent is not None, f"missing prefix of {words}"
+            self.edges[parent * self.vocab_size + self.word2id[words[-1]]] = node
+            self.log10_probs[node] = log10_prob
+            self.backoffs[node] = backoff
+        self.unk_id = self.word2id.get(UNK)
+
+    def _lookup(self, words: Tuple[str, ...]) -> Optional[int]:
+        node = 0
+        for w in words:
+            word_id = self.word2id.get(w)
+            if word_id is None:
+                return None
+            node = self.edges.get(node * self.vocab_size + word_id)
+            if node is None:
+                return None
+        return node
+
+    def log10_prob(self, context: Tuple[str, ...], word: str) -> float:
+        """
+        back-off: P(w|h) = P(w|h) if seen else bow(h) * P(w|h[1:])
+        """
+        if word not in self.word2id:
+            if self.unk_id is None:
+                return OOV_LOG10_PROB
+            word = UNK
+        context = context[-(self.order - 1) :] if self.order > 1 else ()
+        backoff = 0.0
+        for k in range(len(context) + 1):
+            node = self._lookup(context[k:] + (word,))
+            if node is not None:
+                return float(self.log10_probs[node]) + backoff
+            context_node = self._lookup(context[k:])
+            if context_node is not None:
+                backoff += float(self.backoffs[context_node])
+        return OOV_LOG10_PROB
+
+
+class _PrefixState(NamedTuple):
+    lm_score: float  # ln
+    num_words: int
+    words: Tuple[str, ...]  # completed words, only last order-1 are kept
+    word_start: int  # index in prefix where the current (unfinished) word starts
+    offsets: Tuple[int, ...]
+
+
+class BeamSearchParams(NamedTuple):
+    blank_index: int
+    space_index: int
+    beam_width: int
+    cutoff_top_n: int
+    cutoff_prob: float
+    alpha: float
+    beta: float
+
+
+def prefix_beam_search(
+    log_probs: numpy.ndarray,
+    idx2char: Dict[int, str],
+    params: BeamSearchParams,
+    lm: Optional[ArpaLanguageModel] = None,
+) -> Tuple[str, List[int]]:
+    """
+    :param log_probs: T x vocab_size natural-log probabilities of a single utterance
+    :return: best transcript, time-step of each of its characters
+    """
+    lm_cache: Dict[Tuple[Tuple[str, ...], str], float] = {}
+
+    def lm_word_score(words: Tuple[str, ...], word: str) -> float:
+        key = (words, word)
+        if key not in lm_cache:
+            lm_cache[key] = lm.log10_prob(words, word) * LOG10_TO_LN
+        return lm_cache[key]
+
+    def extend_state(prefix: Tuple[int, ...], state: _PrefixState, c: int, t: int):
+        offsets = state.offsets + (t,)
+        if lm is None or c != params.space_index:
+            return state._replace(offsets=offsets)
+        word = "".join(idx2char[i] for i in prefix[state.word_start :])
+        if len(word) == 0:
+            return state._replace(word_start=len(prefix) + 1, offsets=offsets)
+        return _PrefixState(
+            state.lm_score + lm_word_score(state.words, word),
+            state.num_words + 1,
+            (state.words + (word,))[-max(1, lm.order - 1) :],
+            len(prefix) + 1,
+            offsets,
+        )
+
+    def total_score(prefix, p_b, p_nb, final=False) -> float:
+        score = _logsumexp(p_b, p_nb)
+        if lm is not None:
+            state = states[prefix]
+            lm_score, num_words = state.lm_score, state.num_words
+            word = "".join(idx2char[i] for i in prefix[state.word_start :])
+            if final and len(word) > 0:
+                lm_score += lm_word_score(state.words, word)
+                num_words += 1
+            score += params.alpha * lm_score + params.beta * num_words
+        return score
+
+    empty = ()
+    beams = {empty: (0.0, NEG_INF)}  # prefix -> (log P ending in blank, log P ending in non-blank)
+    states = {empty: _PrefixState(0.0, 0, (), 0, ())}
+
+    for t in range(log_probs.shape[0]):
+        frame = log_probs[t]
+        candidates = numpy.argsort(-frame)[: params.cutoff_top_n]
+        if params.cutoff_prob < 1.0:
+            cumulative = numpy.cumsum(numpy.exp(frame[candidates]))
+            candidates = candidates[: numpy.searchsorted(cumulative, params.cutoff_prob) + 1]
+
+        next_beams = defaultdict(lambda: [NEG_INF, NEG_INF])
+        for prefix, (p_b, p_nb) in beams.items():
+            for c in candidates:
+                c = int(c)
+                p = float(frame[c])
+                if c == params.blank_index:
+                    nb = next_beams[prefix]
+                    nb[0] = _logsumexp(nb[0], _logsumexp(p_b, p_nb) + p)
+                    continue
+
+                new_prefix = prefix + (c,)
+                if new_prefix not in states:
+                    states[new_prefix] = extend_state(prefix, states[prefix], c, t)
+                nb_new = next_beams[new_prefix]
+                if len(prefix) > 0 and c == prefix[-1]:
+                    # repeated char only counts as new char if separated by blank
+                    nb_new[1] = _logsumexp(nb_new[1], p_b + p)
+                    nb = next_beams[prefix]
+                    nb[1] = _logsumexp(nb[1], p_nb + p)
+                else:
+                    nb_new[1] = _logsumexp(nb_new[1], _logsumexp(p_b, p_nb) + p)
+
+        scored = sorted(
+            next_beams.items(), key=lambda x: total_score(x[0], *x[1]), reverse=True
+        )
+        beams = {prefix: tuple(p) for prefix, p in scored[: params.beam_width]}
+        states = {prefix: states[prefix] for prefix in beams}  # pruned ones are not extended
+
+    best = max(beams.items(), key=lambda x: total_score(x[0], *x[1], final=True))[0]
+    transcript = "".join(idx2char[i] for i in best)
+    return transcript, list(states[best].offsets)
+
+
+_worker_lm: Optional[ArpaLanguageModel] = None
+
+
+def _init_worker(lm_path: Optional[str]):
+    global _worker_lm
+    _worker_lm = ArpaLanguageModel(lm_path) if lm_path is not None else None
+
+
+def _decode_in_worker(args) -> Tuple[str, List[int]]:
+    log_probs, idx2char, params = args
+    return prefix_beam_search(log_probs, idx2char, params, _worker_lm)
+
+
+class PrefixBeamCTCDecoder(Decoder):
+    """
+    same arguments as BeamCTCDecoder (blank_index is taken from char2idx),
+    utterances of a batch are decoded in parallel by num_processes processes
+    """
+
+    def __init__(
+        self,
+        char2idx,
+        lm_path=None,
+        alpha=0,
+        beta=0,
+        cutoff_top_n=40,
+        cutoff_prob=1.0,
+        beam_width=100,
+        num_processes=4,
+        blank_index=0,
+    ):
+        super(PrefixBeamCTCDecoder, self).__init__(char2idx)
+        self.lm_path = lm_path
+        self.lm = ArpaLanguageModel(lm_path) if lm_path is not None else None
+        self.params = BeamSearchParams(
+            self.blank_index,
+            self.space_index,
+            beam_width,
+            cutoff_top_n,
+            cutoff_prob,
+            alpha,
+            beta,
+        )
+        self.num_processes = num_processes
+        self._pool: Optional[Pool] = None
+        self.num_frames_decoded = 0
+        self.decode_secs = 0.0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_pool"] = None
+        return state
+
+    def close(self):
+        if getattr(self, "_pool", None) is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def __del__(self):
+        self.close()
+
+    @property
+    def frames_per_second(self) -> float:
+        return self.num_frames_decoded / max(self.decode_secs, 1e-9)
+
+    def _decode_utterances(self, log_probs: List[numpy.ndarray]):
+        if self.num_processes > 1 and len(log_probs) > 1:
+            if self._pool is None:
+                self._pool = Pool(
+                    self.num_processes, initializer=_init_worker, initargs=(self.lm_path,)
+                )
+            return self._pool.map(
+                _decode_in_worker, [(lp, self.idx2char, self.params) for lp in log_probs]
+            )
+        else:
+            return [
+                prefix_beam_search(lp, self.idx2char, self.params, self.lm)
+                for lp in log_probs
+            ]
+
+    def decode(self, probs, sizes=None):
+        """
+        Arguments:
+            probs: Tensor of character probabilities, batch x seq_length x output_dim
+            sizes: Size of each sequence in the mini-batch
+        Returns:
+            strings: best transcription for each utterance (only one path)
+            offsets: time step per character
+        """
+        start = time()
+        log_probs = torch.log(probs.cpu().float().clamp_min(1e-30)).numpy()
+        lengths = (
+            [int(s) for s in sizes] if sizes is not None else [probs.size(1)] * probs.size(0)
+        )
+        results = self._decode_utterances(
+            [lp[:l] for lp, l in zip(log_probs, lengths)]
+        )
+        strings = [[transcript] for transcript, _ in results]
+        offsets = [[torch.tensor(o, dtype=torch.int)] for _, o in results]
+
+        self.num_frames_decoded += sum(lengths)
+        self.decode_secs += time() - start
+        return strings, offsets
+
+
+if __name__ == "__main__":
+    import argparse
+    from decoder import GreedyDecoder
+    from utils import BLANK_SYMBOL, SPACE
+
+    parser = argparse.ArgumentParser(description="prefix beam search throughput")
+    parser.add_argument("--lm-path", type=str, default=None, help="ARPA file")
+    parser.add_argument("--beam-width", type=int, default=10)
+    parser.add_argument("--num-processes", type=int, default=4)
+    args = parser.parse_args()
+
+    labels = [BLANK_SYMBOL, "'"] + [chr(ord("A") + k) for k in range(26)] + [SPACE]
+    char2idx = {l: k for k, l in enumerate(labels)}
+    probs = torch.softmax(torch.randn(16, 300, len(labels)) * 4, dim=-1)
+
+    with PrefixBeamCTCDecoder(
+        char2idx,
+        lm_path=args.lm_path,
+        alpha=0.5,
+        beta=1.0,
+        beam_width=args.beam_width,
+        num_processes=args.num_processes,
+    ) as decoder:
+        strings, _ = decoder.decode(probs)
+    print(f"decoded {decoder.num_frames_decoded} frames with {decoder.frames_per_second:.0f} frames/sec")
+    print(f"beam:   {strings[0][0]}")
+    print(f"greedy: {GreedyDecoder(char2idx).decode(probs)[0][0][0]}")
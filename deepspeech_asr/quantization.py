@@ -0,0 +1,134 @@
+import copy
+import io
+from time import time
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from deepspeech_model import DeepSpeech, SequenceWise
+
+"""
+int8 inference for DeepSpeech on CPU: batch-norms are folded into the neighbouring
+conv/lstm/linear weights, then LSTMs and Linear are dynamically quantized
+(weights int8, activations quantized on the fly)
+"""
+
+
+def _bn_scale_shift(bn: nn.BatchNorm1d):
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias - bn.running_mean * scale
+    return scale, shift
+
+
+def _fold_conv_batch_norms(seq_module: nn.Sequential):
+    modules = list(seq_module)
+    for k in range(len(modules) - 1):
+        conv, bn = modules[k], modules[k + 1]
+        if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+            seq_module[k] = fuse_conv_bn_eval(conv, bn)
+            seq_module[k + 1] = nn.Identity()
+
+
+def _fold_batch_norm_into_lstm(batch_rnn):
+    """
+    lstm(bn(x)): W_ih (scale * x + shift) + b_ih = (W_ih * scale) x + (W_ih shift + b_ih)
+    """
+    scale, shift = _bn_scale_shift(batch_rnn.batch_norm.module)
+    suffixes = ["_l0", "_l0_reverse"] if batch_rnn.bidirectional else ["_l0"]
+    for suffix in suffixes:
+        weight_ih = getattr(batch_rnn.rnn, "weight_ih" + suffix)
+        bias_ih = getattr(batch_rnn.rnn, "bias_ih" + suffix)
+        bias_ih.data.add_(weight_ih.data @ shift)
+        weight_ih.data.mul_(scale[None, :])
+    batch_rnn.batch_norm = None
+
+
+def _fold_batch_norm_into_linear(bn: nn.BatchNorm1d, linear: nn.Linear) -> nn.Linear:
+    scale, shift = _bn_scale_shift(bn)
+    folded = nn.Linear(linear.in_features, linear.out_features, bias=True)
+    folded.weight.data.copy_(linear.weight.data * scale[None, :])
+    bias = linear.weight.data @ shift
+    if linear.bias is not None:
+        bias += linear.bias.data
+    folded.bias.data.copy_(bias)
+    return folded
+
+
+def fold_batch_norms(model: DeepSpeech) -> DeepSpeech:
+    """
+    returns a copy of the (eval-mode) model without any BatchNorm-layers
+    """
+    model = copy.deepcopy(model).eval()
+    with torch.no_grad():
+        _fold_conv_batch_norms(model.conv.seq_module)
+        for rnn in model.rnns:
+            if rnn.batch_norm is not None:
+                _fold_batch_norm_into_lstm(rnn)
+        bn, linear = model.fc[0].module
+        model.fc[0] = SequenceWise(_fold_batch_norm_into_linear(bn, linear))
+    return model
+
+
+def quantize_deepspeech(model: DeepSpeech) -> DeepSpeech:
+    """
+    CPU-only, the quantized model is used just like the fp32 one
+    """
+    folded = fold_batch_norms(model.cpu())
+    return torch.quantization.quantize_dynamic(
+        folded, {nn.LSTM, nn.Linear}, dtype=torch.qint8
+    )
+
+
+def model_size_mb(model: nn.Module) -> float:
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2 ** 20
+
+
+def benchmark_forward(model, batch_size=8, max_len=1000, num_runs=3) -> float:
+    x = torch.randn(batch_size, 1, model.input_feature_dim, max_len)
+    lengths = torch.IntTensor([max_len] * batch_size)
+    with torch.no_grad():
+        model(x, lengths)  # warm-up
+        start = time()
+        for _ in range(num_runs):
+            model(x, lengths)
+    return (time() - start) / num_runs
+
+
+def test_folding_and_quantization():
+    model = DeepSpeech(161, vocab_size=29, hidden_size=64, nb_layers=3)
+    for m in model.modules():  # non-trivial batch-norm statistics
+        if isinstance(m, (nn.BatchNorm1d, nn.BatchNorm2d)):
+            m.running_mean.uniform_(-0.5, 0.5)
+            m.running_var.uniform_(0.5, 2.0)
+            m.weight.data.uniform_(0.5, 1.5)
+            m.bias.data.uniform_(-0.5, 0.5)
+    model.eval()
+
+    x = torch.randn(3, 1, 161, 200)
+    lengths = torch.IntTensor([200, 150, 77])
+    with torch.no_grad():
+        expected, sizes = model(x, lengths)
+        folded, _ = fold_batch_norms(model)(x, lengths)
+        quantized, _ = quantize_deepspeech(model)(x, lengths)
+
+    assert not any(
+        isinstance(m, (nn.BatchNorm1d, nn.BatchNorm2d))
+        for m in fold_batch_norms(model).modules()
+    )
+    for b, l in enumerate(sizes):
+        assert torch.allclose(folded[b, :l], expected[b, :l], atol=1e-4)
+        error = (quantized[b, :l] - expected[b, :l]).abs().mean()
+        assert error < 0.1 * expected[b, :l].abs().mean()
+
+
+if __name__ == "__main__":
+    torch.set_grad_enabled(False)
+    model = DeepSpeech(161, vocab_size=29, hidden_size=1024, nb_layers=5).eval()
+    quantized = quantize_deepspeech(model)
+    for name, m in [("fp32", model), ("int8", quantized)]:
+        print(
+            f"{name}: {model_size_mb(m):.1f} MB, {benchmark_forward(m) * 1000:.0f} ms per forward"
+        )
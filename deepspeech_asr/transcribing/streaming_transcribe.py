@@ -0,0 +1,352 @@
+import argparse
+from typing import List, Optional, Iterator
+
+import numpy
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from data_related.audio_feature_extraction import (
+    AudioFeaturesConfig,
+    BatchStftExtractor,
+    calc_log_magnitude_frames,
+    load_audio,
+)
+from decoder import GreedyDecoder
+from deepspeech_model import DeepSpeech, Lookahead
+
+"""
+streaming inference for the unidirectional DeepSpeech (bidirectional=False + Lookahead)
+audio is fed in chunks, everything that is needed to continue (not yet framed samples,
+conv-context, LSTM-states, lookahead-buffer) is carried between calls
+-> memory is bounded by the chunk-size, not by the length of the recording
+"""
+
+
+class StreamingStft:
+    """
+    incremental version of calc_stft_batch, frames that need "future" samples are
+    postponed to the next chunk, the reflect-padding at the end is done by finalize
+    """
+
+    def __init__(self, audio_conf: AudioFeaturesConfig):
+        extractor = BatchStftExtractor(audio_conf)
+        self.window = extractor.window
+        self.hop_length = extractor.hop_length
+        self.pad = len(self.window) // 2
+        self.reset()
+
+    def reset(self):
+        self._buffer = numpy.zeros(0, dtype=numpy.float32)  # padded signal
+        self._buffer_start = 0  # position of _buffer[0] in the padded signal
+        self._num_samples = 0
+        self._num_frames = 0
+        self._tail = numpy.zeros(0, dtype=numpy.float32)  # needed for reflect at the end
+
+    def _calc_frames(self, padded_end: int) -> torch.Tensor:
+        n_fft = len(self.window)
+        num_frames = max(0, (padded_end - n_fft) // self.hop_length + 1 - self._num_frames)
+        if num_frames > 0:
+            spect = calc_log_magnitude_frames(
+                self._buffer[None], num_frames, self.window, self.hop_length
+            )[0]
+            self._num_frames += num_frames
+            consumed = self._num_frames * self.hop_length - self._buffer_start
+            self._buffer = self._buffer[consumed:]
+            self._buffer_start += consumed
+        else:
+            spect = numpy.zeros((0, len(self.window) // 2 + 1))
+        return torch.from_numpy(spect.astype(numpy.float32)).t()  # F x T
+
+    def process_chunk(self, chunk: numpy.ndarray) -> torch.Tensor:
+        chunk = chunk.astype(numpy.float32)
+        if self._num_samples == 0:
+            assert len(chunk) > self.pad, "first chunk too short for reflect-padding"
+            chunk = numpy.concatenate([chunk[self.pad : 0 : -1], chunk])
+        self._buffer = numpy.concatenate([self._buffer, chunk])
+        self._num_samples = self._buffer_start + len(self._buffer) - self.pad
+        self._tail = numpy.concatenate([self._tail, chunk])[-(self.pad + 1) :]
+        return self._calc_frames(self._buffer_start + len(self._buffer))
+
+    def finalize(self) -> torch.Tensor:
+        self._buffer = numpy.concatenate(
+            [self._buffer, self._tail[-2 : -(self.pad + 2) : -1]]
+        )
+        return self._calc_frames(self._buffer_start + len(self._buffer))
+
+
+class StreamingConvStage:
+    """
+    one Conv2d of MaskConv + following point-wise modules (BatchNorm, Hardtanh)
+    time-axis gets zero-padded "manually": at start of stream and on finalize
+    """
+
+    def __init__(self, conv: nn.Conv2d, pointwise: List[nn.Module]):
+        assert conv.dilation[1] == 1
+        self.conv = conv
+        self.pointwise = pointwise
+        self.reset()
+
+    def reset(self):
+        self._buffer: Optional[torch.Tensor] = None
+
+    def _zeros(self, like: torch.Tensor, num_frames: int) -> torch.Tensor:
+        return like.new_zeros(like.shape[:-1] + (num_frames,))
+
+    def process(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        :param x: 1 x C x D x T
+        """
+        if self._buffer is None:
+            self._buffer = self._zeros(x, self.conv.padding[1])
+        self._buffer = torch.cat([self._buffer, x], dim=3)
+        kernel, stride = self.conv.kernel_size[1], self.conv.stride[1]
+        num_out = (self._buffer.size(3) - kernel) // stride + 1
+        if num_out <= 0:
+            freq_dim = (
+                x.size(2) + 2 * self.conv.padding[0] - self.conv.kernel_size[0]
+            ) // self.conv.stride[0] + 1
+            return x.new_zeros(1, self.conv.out_channels, freq_dim, 0)
+
+        x = F.conv2d(
+            self._buffer[:, :, :, : (num_out - 1) * stride + kernel],
+            self.conv.weight,
+            self.conv.bias,
+            stride=self.conv.stride,
+            padding=(self.conv.padding[0], 0),
+        )
+        for module in self.pointwise:
+            x = module(x)
+        self._buffer = self._buffer[:, :, :, num_out * stride :]
+        return x
+
+    def finalize(self) -> torch.Tensor:
+        return self.process(self._zeros(self._buffer, self.conv.padding[1]))
+
+
+class StreamingDeepSpeech:
+    """
+    stateful wrapper around a DeepSpeech-model, process_features(spect) can be called
+    with arbitrary many frames and returns the logits of all frames that could be
+    computed so far
+    """
+
+    def __init__(self, model: DeepSpeech):
+        assert not model.bidirectional, "streaming needs unidirectional RNNs"
+        assert not model.training
+        self.model = model
+
+        self.conv_stages: List[StreamingConvStage] = []
+        for module in model.conv.seq_module:
+            if isinstance(module, nn.Conv2d):
+                self.conv_stages.append(StreamingConvStage(module, []))
+            else:
+                self.conv_stages[-1].pointwise.append(module)
+
+        self.lookahead: Lookahead = model.lookahead[0]
+        self.reset()
+
+    def reset(self):
+        for stage in self.conv_stages:
+            stage.reset()
+        self._rnn_states = [None for _ in self.model.rnns]
+        self._lookahead_buffer: Optional[torch.Tensor] = None
+
+    def _run_rnns(self, x: torch.Tensor) -> torch.Tensor:
+        sizes = x.size()
+        x = x.view(sizes[0], sizes[1] * sizes[2], sizes[3])
+        x = x.transpose(1, 2).transpose(0, 1).contiguous()  # TxNxH
+        for k, rnn in enumerate(self.model.rnns):
+            if rnn.batch_norm is not None:
+                x = rnn.batch_norm(x)
+            x, self._rnn_states[k] = rnn.rnn(x, self._rnn_states[k])
+        return x
+
+    def _run_lookahead(self, x: Optional[torch.Tensor], final=False) -> torch.Tensor:
+        """
+        Lookahead output t needs inputs t ... t+context-1, last context-1 inputs are
+        kept in the buffer, on finalize zeros are appended like F.pad does it offline
+        """
+        context = self.lookahead.context
+        if x is not None:
+            x = x.transpose(0, 1).transpose(1, 2)  # N x H x T
+            if self._lookahead_buffer is None:
+                self._lookahead_buffer = x
+            else:
+                self._lookahead_buffer = torch.cat([self._lookahead_buffer, x], dim=2)
+        buffer = self._lookahead_buffer
+        if buffer is None:
+            return None
+        if final:
+            buffer = F.pad(buffer, pad=self.lookahead.pad, value=0)
+
+        num_out = buffer.size(2) - context + 1
+        if num_out <= 0:
+            return None
+        x = self.lookahead.conv(buffer)
+        self._lookahead_buffer = buffer[:, :, num_out:]
+        x = x.transpose(1, 2).transpose(0, 1).contiguous()
+        for module in self.model.lookahead[1:]:
+            x = module(x)
+        return x
+
+    def _run_convs(self, x: torch.Tensor, final: bool) -> torch.Tensor:
+        for stage in self.conv_stages:
+            if final:
+                x = torch.cat([stage.process(x), stage.finalize()], dim=3)
+            else:
+                x = stage.process(x)
+        return x
+
+    def _forward(self, spect: torch.Tensor, final: bool) -> torch.Tensor:
+        x = spect.view(1, 1, spect.size(0), spect.size(1))
+        x = self._run_convs(x, final)
+        x = self._run_rnns(x) if x.size(3) > 0 else None
+        x = self._run_lookahead(x, final)
+        if x is None:
+            return torch.zeros(0, self.model.vocab_size)
+        x = self.model.fc(x)
+        return x.transpose(0, 1)[0]  # T x vocab_size
+
+    def process_features(self, spect: torch.Tensor) -> torch.Tensor:
+        """
+        :param spect: F x T
+        :return: logits T' x vocab_size
+        """
+        return self._forward(spect, final=False)
+
+    def finalize(self, spect: torch.Tensor) -> torch.Tensor:
+        return self._forward(spect, final=True)
+
+
+class StreamingTranscriber:
+    """
+    usage:
+        for chunk in chunks:
+            partial_transcript = transcriber.process_chunk(chunk)
+        transcript = transcriber.finalize()
+    """
+
+    def __init__(
+        self,
+        model: DeepSpeech,
+        decoder: GreedyDecoder,
+        audio_conf: AudioFeaturesConfig,
+        device=torch.device("cpu"),
+    ):
+        self.device = device
+        self.decoder = decoder
+        self.stft = StreamingStft(audio_conf)
+        self.model = StreamingDeepSpeech(model.to(device))
+        self.reset()
+
+    def reset(self):
+        self.stft.reset()
+        self.model.reset()
+        self._prev_idx: Optional[int] = None
+        self._chars: List[str] = []
+        self._num_output_frames = 0
+
+    def _greedy_decode(self, logits: torch.Tensor) -> str:
+        """
+        incremental version of process_string with remove_repetitions=True
+        """
+        self._num_output_frames += logits.size(0)
+        for idx in torch.argmax(logits, dim=-1).tolist():
+            if idx != self.decoder.blank_index and idx != self._prev_idx:
+                self._chars.append(self.decoder.idx2char[idx])
+            self._prev_idx = idx
+        return "".join(self._chars)
+
+    @torch.no_grad()
+    def process_chunk(self, chunk: numpy.ndarray) -> str:
+        spect = self.stft.process_chunk(chunk).to(self.device)
+        return self._greedy_decode(self.model.process_features(spect))
+
+    @torch.no_grad()
+    def finalize(self) -> str:
+        spect = self.stft.finalize().to(self.device)
+        return self._greedy_decode(self.model.finalize(spect))
+
+
+def iterate_chunks(signal: numpy.ndarray, chunk_size: int) -> Iterator[numpy.ndarray]:
+    for k in range(0, len(signal), chunk_size):
+        yield signal[k : k + chunk_size]
+
+
+def test_streaming_equals_offline():
+    """
+    pytest deepspeech_asr/transcribing/streaming_transcribe.py
+    """
+    from utils import BLANK_SYMBOL, SPACE
+
+    torch.manual_seed(42)
+    audio_conf = AudioFeaturesConfig()
+    labels = [BLANK_SYMBOL, SPACE] + [chr(ord("A") + k) for k in range(26)]
+    char2idx = {l: k for k, l in enumerate(labels)}
+    model = DeepSpeech(
+        audio_conf.feature_dim,
+        vocab_size=len(labels),
+        hidden_size=64,
+        nb_layers=2,
+        bidirectional=False,
+        context=7,
+    ).eval()
+    signal = numpy.random.RandomState(42).randn(16_000 * 3 + 123).astype(numpy.float32)
+
+    with torch.no_grad():
+        spects, lengths = BatchStftExtractor(audio_conf)([signal])
+        offline_logits, _ = model(spects.unsqueeze(1), lengths)
+    offline_logits = offline_logits[0]
+
+    for chunk_size in [1234, 4000, 16_000]:
+        streaming = StreamingDeepSpeech(model)
+        stft = StreamingStft(audio_conf)
+        with torch.no_grad():
+            logits = [
+                streaming.process_features(stft.process_chunk(c))
+                for c in iterate_chunks(signal, chunk_size)
+            ]
+            logits.append(streaming.finalize(stft.finalize()))
+        logits = torch.cat(logits)
+        assert logits.shape == offline_logits.shape
+        assert torch.allclose(logits, offline_logits, atol=1e-5)
+
+        transcriber = StreamingTranscriber(model, GreedyDecoder(char2idx), audio_conf)
+        for c in iterate_chunks(signal, chunk_size):
+            transcriber.process_chunk(c)
+        transcript = transcriber.finalize()
+        offline_transcript = GreedyDecoder(char2idx).decode(
+            F.softmax(offline_logits, dim=-1).unsqueeze(0)
+        )[0][0][0]
+        assert transcript == offline_transcript
+
+
+# fmt: off
+parser = argparse.ArgumentParser(description="streaming transcription")
+parser.add_argument("--model", type=str, required=True, help="lightning-checkpoint of unidirectional DeepSpeech")
+parser.add_argument("--audio-file", type=str, required=True)
+parser.add_argument("--chunk-secs", type=float, default=0.5)
+# fmt: on
+
+if __name__ == "__main__":
+    from time import time
+    from data_related.char_stt_dataset import DataConfig
+    from lightning.lit_deepspeech import LitDeepSpeech
+    from data_related.datasets.librispeech import LIBRI_VOCAB
+
+    args = parser.parse_args()
+    audio_conf = AudioFeaturesConfig()
+    model: DeepSpeech = LitDeepSpeech.load_from_checkpoint(args.model).model.eval()
+    data_conf = DataConfig(LIBRI_VOCAB)
+    char2idx = dict([(data_conf.labels[i], i) for i in range(len(data_conf.labels))])
+    transcriber = StreamingTranscriber(model, GreedyDecoder(char2idx), audio_conf)
+
+    signal = load_audio(args.audio_file)
+    start = time()
+    for k, chunk in enumerate(
+        iterate_chunks(signal, int(args.chunk_secs * audio_conf.sample_rate))
+    ):
+        partial = transcriber.process_chunk(chunk)
+        print(f"{time() - start:.2f}s chunk {k}: {partial[-80:]}")
+    print(transcriber.finalize())
@@ -0,0 +1,261 @@
+import argparse
+import asyncio
+import json
+import threading
+from collections import deque, defaultdict
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from tempfile import NamedTemporaryFile
+from time import time
+from typing import Dict, List, NamedTuple, Deque
+
+import numpy as np
+import torch
+
+from data_related.audio_feature_extraction import (
+    AudioFeaturesConfig,
+    AudioFeatureExtractor,
+    AUDIOFEATUREEXTRACTORS,
+)
+from data_related.data_loader import _collate_fn
+from decoder import Decoder
+from transcribing.transcribe_util import transcribe_batch, build_decoder
+
+"""
+local inference service: requests are queued, grouped into length-bucketed batches
+(flushed when full or when the oldest request waited max_wait_ms) and run through
+transcribe_batch, decoded strings are fanned back to the waiting callers
+
+POST /transcribe  body: raw audio-bytes (?format=wav|mp3|flac) or json {"audio_file": path}
+GET  /stats       throughput + latency percentiles
+"""
+
+FRAMES_PER_SECOND = 100  # stft with window_stride of 10ms
+
+
+class _Request(NamedTuple):
+    features: torch.Tensor  # F x T
+    future: Future
+    arrival: float
+
+
+class InferenceStats:
+    def __init__(self, num_latencies: int = 10_000):
+        self.lock = threading.Lock()
+        self.latencies: Deque[float] = deque(maxlen=num_latencies)
+        self.start = time()
+        self.num_requests = 0
+        self.num_batches = 0
+        self.audio_secs = 0.0
+
+    def add_batch(self, latencies: List[float], audio_secs: float):
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.num_requests += len(latencies)
+            self.num_batches += 1
+            self.audio_secs += audio_secs
+
+    def summary(self) -> Dict[str, float]:
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            duration = time() - self.start
+            d = {
+                "num_requests": self.num_requests,
+                "num_batches": self.num_batches,
+                "avg_batch_size": self.num_requests / max(1, self.num_batches),
+                "requests_per_sec": self.num_requests / duration,
+                "audio_secs_per_sec": self.audio_secs / duration,
+            }
+        if len(latencies) > 0:
+            for p in [50, 95, 99]:
+                d[f"p{p}_latency_ms"] = float(np.percentile(latencies, p))
+        return d
+
+
+class DynamicBatcher:
+    def __init__(
+        self,
+        model,
+        decoder: Decoder,
+        audio_fe: AudioFeatureExtractor,
+        device=torch.device("cpu"),
+        half: bool = False,
+        max_batch_size: int = 32,
+        max_wait_ms: float = 50,
+        bucket_width_secs: float = 2.0,
+    ):
+        self.model = model
+        self.decoder = decoder
+        self.audio_fe = audio_fe
+        self.device = device
+        self.half = half
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.bucket_width = int(bucket_width_secs * FRAMES_PER_SECOND)
+
+        self.stats = InferenceStats()
+        self._buckets: Dict[int, List[_Request]] = defaultdict(list)
+        self._cond = threading.Condition()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, audio_file: str) -> Future:
+        # featurization happens in the calling (http-handler) thread -> in parallel
+        features = self.audio_fe.process(audio_file)
+        request = _Request(features, Future(), time())
+        with self._cond:
+            self._buckets[features.size(1) // self.bucket_width].append(request)
+            self._cond.notify()
+        return request.future
+
+    async def transcribe(self, audio_file: str) -> str:
+        loop = asyncio.get_event_loop()
+        future = await loop.run_in_executor(None, self.submit, audio_file)
+        return await asyncio.wrap_future(future)
+
+    def _pop_batch(self) -> List[_Request]:
+        """
+        full bucket first, otherwise the bucket with the oldest request once its deadline passed
+        """
+        with self._cond:
+            while True:
+                buckets = [(b, r) for b, r in self._buckets.items() if len(r) > 0]
+                full = [b for b, r in buckets if len(r) >= self.max_batch_size]
+                if len(full) > 0:
+                    bucket = full[0]
+                    break
+                if len(buckets) > 0:
+                    bucket, requests = min(buckets, key=lambda x: x[1][0].arrival)
+                    wait = requests[0].arrival + self.max_wait - time()
+                    if wait <= 0:
+                        break
+                    self._cond.wait(timeout=wait)
+                else:
+                    self._cond.wait()
+            requests = self._buckets[bucket]
+            batch = requests[: self.max_batch_size]
+            self._buckets[bucket] = requests[self.max_batch_size :]
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._pop_batch()
+            try:
+                with torch.no_grad():
+                    transcripts = self._transcribe(batch)
+            except Exception as e:
+                for r in batch:
+                    r.future.set_exception(e)
+                continue
+
+            now = time()
+            for r, transcript in zip(batch, transcripts):
+                r.future.set_result(transcript)
+            self.stats.add_batch(
+                [now - r.arrival for r in batch],
+                sum(r.features.size(1) for r in batch) / FRAMES_PER_SECOND,
+            )
+
+    def _transcribe(self, batch: List[_Request]) -> List[str]:
+        # sorted like _collate_fn sorts (stable) -> same order as batch
+        batch.sort(key=lambda r: r.features.size(1), reverse=True)
+        inputs, _, input_len_proportions, _ = _collate_fn(
+            [(r.features, []) for r in batch]
+        )
+        decoded_output, _, _ = transcribe_batch(
+            self.decoder,
+            self.device,
+            self.half,
+            input_len_proportions,
+            inputs,
+            self.model,
+        )
+        return [d[0] for d in decoded_output]
+
+
+def build_request_handler(batcher: DynamicBatcher):
+    class TranscribeHandler(BaseHTTPRequestHandler):
+        def _send_json(self, d: Dict, status=200):
+            body = json.dumps(d).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._send_json(batcher.stats.summary())
+            else:
+                self._send_json({"error": "not found"}, 404)
+
+        def do_POST(self):
+            if not self.path.startswith("/transcribe"):
+                self._send_json({"error": "not found"}, 404)
+                return
+            start = time()
+            try:
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+            except (TypeError, ValueError) as e:  # missing or malformed Content-Length
+                self._send_json({"error": f"bad Content-Length: {e}"}, 400)
+                return
+            try:
+                if self.headers.get("Content-Type") == "application/json":
+                    transcript = batcher.submit(json.loads(body)["audio_file"]).result()
+                else:
+                    suffix = self.path.split("format=")[-1] if "format=" in self.path else "wav"
+                    with NamedTemporaryFile(suffix=f".{suffix}") as f:
+                        f.write(body)
+                        f.flush()
+                        transcript = batcher.submit(f.name).result()
+            except Exception as e:
+                self._send_json({"error": str(e)}, 500)
+                return
+            self._send_json(
+                {"transcript": transcript, "latency_ms": (time() - start) * 1000}
+            )
+
+        def log_message(self, format, *args):
+            pass
+
+    return TranscribeHandler
+
+
+# fmt: off
+parser = argparse.ArgumentParser(description="dynamic batching transcription server")
+parser.add_argument("--model", type=str, required=True, help="lightning-checkpoint")
+parser.add_argument("--port", type=int, default=8000)
+parser.add_argument("--max-batch-size", type=int, default=32)
+parser.add_argument("--max-wait-ms", type=float, default=50)
+parser.add_argument("--bucket-width-secs", type=float, default=2.0)
+# fmt: on
+
+if __name__ == "__main__":
+    """
+    curl -X POST --data-binary @some.wav "localhost:8000/transcribe?format=wav"
+    curl localhost:8000/stats
+    """
+    from data_related.char_stt_dataset import DataConfig
+    from data_related.datasets.librispeech import LIBRI_VOCAB
+    from lightning.lit_deepspeech import LitDeepSpeech
+    from utils import USE_GPU
+
+    args = parser.parse_args()
+    device = torch.device("cuda" if USE_GPU else "cpu")
+    model = LitDeepSpeech.load_from_checkpoint(args.model).model.eval().to(device)
+    data_conf = DataConfig(LIBRI_VOCAB)
+    audio_conf = AudioFeaturesConfig()
+    char2idx = dict([(data_conf.labels[i], i) for i in range(len(data_conf.labels))])
+
+    batcher = DynamicBatcher(
+        model,
+        build_decoder(char2idx, use_beam_decoder=False),
+        AUDIOFEATUREEXTRACTORS[audio_conf.feature_type](audio_conf, []),
+        device=device,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+        bucket_width_secs=args.bucket_width_secs,
+    )
+    server = ThreadingHTTPServer(("localhost", args.port), build_request_handler(batcher))
+    print(f"serving on localhost:{args.port}")
+    server.serve_forever()
@@ -13,8 +13,8 @@ from decoder import GreedyDecoder, DecoderConfig, Decoder
 import torch
 
 def transcribe_batch(decoder:Decoder, device, half:bool, input_len_proportions, inputs, model):
-    input_sizes = input_len_proportions.mul_(int(inputs.size(3))).int()
-    inputs = inputs.to(device)
+    input_sizes = input_len_proportions.mul(int(inputs.size(3))).int()
+    inputs = inputs.to(device, non_blocking=True)
     if half:
         inputs = inputs.half()
     out, output_sizes = model(inputs, input_sizes)
@@ -42,7 +42,13 @@ def build_decoder(char2idx, use_beam_decoder=False, config=DecoderConfig()):
     if use_beam_decoder:
         from decoder import BeamCTCDecoder
 
-        decoder = BeamCTCDecoder(char2idx, **config._asdict())
+        try:
+            decoder = BeamCTCDecoder(char2idx, **config._asdict())
+        except ImportError:
+            from prefix_beam_search import PrefixBeamCTCDecoder
+
+            print("no ctcdecode package, falling back to PrefixBeamCTCDecoder")
+            decoder = PrefixBeamCTCDecoder(char2idx, **config._asdict())
     else:
         decoder = GreedyDecoder(char2idx)
     return decoder